@@ -32,6 +32,12 @@ DEFAULTS = {
         "sound_adjust_method":      "lufs",
         "volume_curve":             3.0,
         "metadata_concurrency":     1,
+        "metadata_batch":           1,
+        "library_watch":            False,
+        "metadata_backend":         "jsonl",
+        "library_mode":             "full",
+        "retrieval_k":              200,
+        "song_ids":                 False,
     },
 }
 
@@ -49,6 +55,12 @@ FIELD_META = {
     "sound_adjust_method":  ("str",  "Volume adjust method: lufs or linear", "lufs"),
     "volume_curve":      ("float","Volume curve multiplier", "3.0"),
     "metadata_concurrency":  ("int","Parallel workers for metadata sync (1-16)", "1"),
+    "metadata_batch":    ("int",  "Max songs per LLM metadata request (1 = off)", "1"),
+    "library_watch":     ("bool", "Watch music folders and auto-ingest new files", "false"),
+    "metadata_backend":  ("str",  "Metadata store: jsonl or sqlite", "jsonl"),
+    "library_mode":      ("str",  "Library in prompt: full or retrieval (top-K per request)", "full"),
+    "retrieval_k":       ("int",  "Candidate songs sent per request in retrieval mode (20-2000)", "200"),
+    "song_ids":          ("bool", "Numeric song IDs in prompts; AI replies with IDs", "false"),
 }
 
 # sidebar sections: (label, section_key, mode)
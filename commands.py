@@ -14,10 +14,12 @@ from rich.align import Align
 from rich.panel import Panel
 import questionary
 from rapidfuzz import process, fuzz
-from core.config import save_config, PLAYLIST_DIR, SEPARATOR, LANGUAGE, LYRICS_DIR, NCM_BASE_URL, load_frequency, save_frequency, bump_frequency
+from core.config import save_config, PLAYLIST_DIR, SEPARATOR, LANGUAGE, LYRICS_DIR, load_frequency, save_frequency, record_plays
 from core.player import execute_player_command
 from core.command_handler import registry, console, Context
 from core.loudness import LoudnessCache
+from core import ncm
+from core.metrics import llm_metrics
 import core.ui as ui
 
 # --- Helper Logic ---
@@ -34,7 +36,7 @@ def _update_playlist_and_trigger(ctx: Context, new_playlist, intro, title_desc,
     ctx.play_list = new_playlist
 
     # Print UI
-    ui.print_playlist(new_playlist, ctx.aidj.metadata, title_desc)
+    ui.print_playlist(new_playlist, ctx.aidj.metadata, title_desc, durations=ctx.aidj.durations)
 
     # Auto Trigger — counts as a "send" (tracks are being played)
     if not skip_auto:
@@ -42,14 +44,13 @@ def _update_playlist_and_trigger(ctx: Context, new_playlist, intro, title_desc,
         if trigger:
             console.print(f"[yellow]⚡ Auto-Executing: {trigger}[/]")
             execute_player_command(trigger, ctx.play_list, ctx.dbus)
-            _bump_freq(ctx)
+            _bump_freq(ctx, "trigger")
 
-def _bump_freq(ctx):
-    """Bump frequency for current playlist (called on send or auto-trigger)."""
+def _bump_freq(ctx, source="send"):
+    """Log a play event for the current playlist (called on send or auto-trigger)."""
     if ctx.config['preferences'].get('record_freq', False) and ctx._freq is not None:
         song_names = [t['name'] for t in ctx.play_list]
-        if bump_frequency(ctx._freq, song_names):
-            save_frequency(ctx._freq)
+        if record_plays(ctx._freq, song_names, source):
             console.print(f"[dim]📊 Frequency updated for {len(song_names)} tracks[/]")
 
 def _player_helper(ctx, cmd):
@@ -179,37 +180,41 @@ def cmd_discover(ctx: Context, *args):
 
 @registry.register("freqtop", "ftop")
 def cmd_freqtop(ctx: Context, *args):
-    """Show top N most-played songs: freqtop <N> (default 20)."""
+    """Show top N most-played songs: freqtop [N] [recent] (default 20, all-time)."""
     if not ctx._freq:
         ctx._freq = load_frequency()
         if not ctx._freq:
             console.print("[yellow]No frequency data yet. Enable [bold]record_freq[/] first.[/]")
             return
 
-    sorted_freq = sorted(ctx._freq.items(), key=lambda x: x[1], reverse=True)
-    limit = min(int(args[0]), len(sorted_freq)) if args and args[0].isdigit() else min(20, len(sorted_freq))
+    recent = any(a.lower() in ("recent", "decay", "r") for a in args)
+    nums = [a for a in args if a.isdigit()]
+    limit = int(nums[0]) if nums else 20
 
-    playlist = []
-    for name, count in sorted_freq[:limit]:
-        if name in ctx.aidj.music_paths:
-            playlist.append({"name": name, "path": ctx.aidj.music_paths[name]})
+    # 只取库中存在的曲目：多取一些再过滤，避免整表排序
+    paths = ctx.aidj.music_paths
+    ranked = [r for r in ctx._freq.top(limit * 2 + 10, recent=recent) if r[0] in paths][:limit]
+    if len(ranked) < limit:
+        ranked = [r for r in ctx._freq.top(len(ctx._freq), recent=recent) if r[0] in paths][:limit]
 
+    playlist = [{"name": name, "path": paths[name]} for name, _, _ in ranked]
     if not playlist:
         console.print("[yellow]No matching tracks in library.[/]")
         return
 
+    label = "recently hot" if recent else "most played"
     _update_playlist_and_trigger(
         ctx, playlist, None,
-        f"Top {len(playlist)} (most played)"
+        f"Top {len(playlist)} ({label})"
     )
-    for i, (name, count) in enumerate(sorted_freq[:limit], 1):
-        if name in ctx.aidj.music_paths:
-            console.print(f"  [dim]#{i}[/] [bold]{name}[/] [dim]({count}x)[/]")
+    for i, (name, count, score) in enumerate(ranked, 1):
+        extra = f", score {score:.1f}" if recent else ""
+        console.print(f"  [dim]#{i}[/] [bold]{name}[/] [dim]({count}x{extra})[/]")
 
 @registry.register("analyse", "stats")
 def cmd_analyse(ctx: Context, *args):
-    """Analyse metadata distribution: analyse <language|emotion|genre>."""
-    from core.analyse import load_metadata, compute_distribution
+    """Analyse metadata distribution: analyse <language|emotion|genre> [tag]."""
+    from core.analyse import tag_distribution, names_with_tag
 
     field = args[0].lower() if args else "language"
     valid = {"language", "emotion", "genre", "lang", "emo", "gen"}
@@ -220,12 +225,30 @@ def cmd_analyse(ctx: Context, *args):
         console.print(f"[red]Unknown field: '{field}'. Choose language/emotion/genre.[/]")
         return
 
-    entries = load_metadata()
-    if not entries:
-        console.print("[red]No metadata found.[/]")
+    metadata = ctx.aidj.metadata
+
+    # analyse <field> <tag> → 列出库中带该标签的歌曲
+    if len(args) > 1:
+        tag = " ".join(args[1:])
+        paths = ctx.aidj.music_paths
+        names = sorted(n for n in names_with_tag(metadata, field, tag) if n in paths)
+        if not names:
+            console.print(f"[yellow]No tracks tagged {field}={tag}.[/]")
+            return
+        ui.print_playlist([{"name": n, "path": paths[n]} for n in names], metadata, f"{field.title()}: {tag}", durations=ctx.aidj.durations)
         return
 
-    items, total = compute_distribution(entries, field)
+    if hasattr(metadata, "distribution"):
+        # SQLite backend: 直接在索引列上做聚合
+        items, total = metadata.distribution(field)
+    else:
+        # 写入时已预计算规范化标签，这里只做计数
+        with ctx.aidj.lock:
+            items, total = tag_distribution(metadata, field)
+
+    if not items:
+        console.print("[red]No metadata found.[/]")
+        return
 
     # Build bar chart
     max_bar_width = 30
@@ -245,13 +268,14 @@ def cmd_analyse(ctx: Context, *args):
 
 @registry.register("concurrency", "conc")
 def cmd_concurrency(ctx: Context, *args):
-    """Set metadata sync concurrency: concurrency <count> (default 1)."""
+    """Set starting metadata sync concurrency: concurrency <count> (default 1, adapts during sync)."""
     current = ctx.config['preferences'].get('metadata_concurrency', 1)
 
     if not args:
         console.print(f"[cyan]Metadata sync concurrency: [bold]{current}[/][/]")
         console.print("Usage: concurrency <number>")
-        console.print("  [dim]Higher values = faster sync, but more API load[/]")
+        console.print("  [dim]Starting value for the LLM stage; sync raises it while the API keeps up[/]")
+        console.print("  [dim]and halves it on 429 / 5xx / timeouts (max 16)[/]")
         return
 
     if not args[0].isdigit():
@@ -270,9 +294,81 @@ def cmd_concurrency(ctx: Context, *args):
     save_config(ctx.config)
     console.print(f"[green]⚙️  Metadata sync concurrency: [bold]{count}[/][/]")
 
+@registry.register("batch", "mbatch")
+def cmd_batch(ctx: Context, *args):
+    """Set songs per LLM metadata request: batch <count> (1 = one song per request)."""
+    current = ctx.config['preferences'].get('metadata_batch', 1)
+
+    if not args:
+        console.print(f"[cyan]Metadata batch size: [bold]{current}[/] songs/request[/]")
+        console.print("Usage: batch <number>")
+        console.print("  [dim]Larger batches = fewer requests; trimmed automatically to fit the model context[/]")
+        return
+
+    if not args[0].isdigit() or int(args[0]) < 1:
+        console.print(f"[red]Invalid batch size: '{args[0]}'. Must be a positive integer.[/]")
+        return
+
+    count = int(args[0])
+    if count > 32:
+        console.print("[yellow]⚠️  Capped at 32 songs per request.[/]")
+        count = 32
+
+    ctx.config['preferences']['metadata_batch'] = count
+    save_config(ctx.config)
+    console.print(f"[green]⚙️  Metadata batch size: [bold]{count}[/] songs/request[/]")
+
+@registry.register("retrieval", "rag")
+def cmd_retrieval(ctx: Context, *args):
+    """Send only top-K matching songs per request: retrieval <on|off|K>."""
+    from core.retrieval import MIN_K, MAX_K
+
+    prefs = ctx.config['preferences']
+    mode = prefs.get('library_mode', 'full')
+    k = prefs.get('retrieval_k', 200)
+
+    if not args:
+        state = f"[bold]on[/] (top {k})" if mode == "retrieval" else "[bold]off[/] (full library pinned on turn 1)"
+        console.print(f"[cyan]Library retrieval: {state}[/]")
+        console.print("Usage: retrieval <on|off|K>")
+        console.print("  [dim]on: each request gets the K best BM25 matches instead of the whole library[/]")
+        return
+
+    arg = args[0].lower()
+    if arg in ("on", "off"):
+        prefs['library_mode'] = "retrieval" if arg == "on" else "full"
+    elif arg.isdigit():
+        k = max(MIN_K, min(MAX_K, int(arg)))
+        if k != int(arg):
+            console.print(f"[yellow]⚠️  Clamped to {k} (range {MIN_K}-{MAX_K}).[/]")
+        prefs['retrieval_k'] = k
+        prefs['library_mode'] = "retrieval"
+    else:
+        console.print(f"[red]Invalid argument '{args[0]}'. Use: on, off, or a number.[/]")
+        return
+
+    save_config(ctx.config)
+    if prefs['library_mode'] == "retrieval":
+        console.print(f"[green]🔎 Library retrieval: [bold]on[/] (top {prefs['retrieval_k']} per request)[/]")
+    else:
+        console.print("[green]📚 Library retrieval: [bold]off[/] (full library)[/]")
+    if ctx.aidj.turn_count:
+        console.print("[dim]Takes effect after `reset` (this conversation keeps its current mode).[/]")
+
+@registry.register("ids", "songids")
+def cmd_ids(ctx: Context, *args):
+    """Toggle the numeric song ID protocol (AI replies with IDs instead of titles)."""
+    curr = ctx.config['preferences'].get('song_ids', False)
+    ctx.config['preferences']['song_ids'] = not curr
+    save_config(ctx.config)
+    state = "ON" if not curr else "OFF"
+    console.print(f"[green]🔢 Song ID Protocol: {state}[/]")
+    if ctx.aidj.turn_count:
+        console.print("[dim]Takes effect after `reset` (this conversation keeps its current protocol).[/]")
+
 @registry.register("token", "tokens")
 def cmd_token(ctx: Context, *args):
-    """Show current session token usage (from API response data)."""
+    """Show session token usage, prompt cache hits and LLM latency (p50/p95)."""
     aidj = ctx.aidj
     p = aidj.prompt_tokens
     c = aidj.completion_tokens
@@ -284,7 +380,7 @@ def cmd_token(ctx: Context, *args):
             return f"{n/1_000:.1f}k"
         return str(n)
 
-    if p == 0 and c == 0:
+    if p == 0 and c == 0 and not llm_metrics:
         console.print("[dim]📊 No tokens used yet this session.[/]")
         return
 
@@ -295,6 +391,17 @@ def cmd_token(ctx: Context, *args):
         f"[yellow]{_fmt(c)}[/] completion = "
         f"[bold green]{_fmt(total)}[/] total"
     )
+    if aidj.cache_prompt_tokens:
+        rate = aidj.cached_tokens / aidj.cache_prompt_tokens
+        console.print(
+            f"[cyan]💾 Prompt cache:[/] [yellow]{_fmt(aidj.cached_tokens)}[/] of "
+            f"[yellow]{_fmt(aidj.cache_prompt_tokens)}[/] prompt tokens hit "
+            f"([bold green]{rate:.0%}[/])"
+        )
+
+    if llm_metrics:
+        ui.print_llm_latency("⏱️ LLM Latency by Model", llm_metrics.by_model(), "Model")
+        ui.print_llm_latency("⏱️ LLM Latency by Command", llm_metrics.by_command(), "Command")
 
 @registry.register("injects", "inj")
 def cmd_injects(ctx: Context, *args):
@@ -341,14 +448,45 @@ def cmd_injects(ctx: Context, *args):
 @registry.register("sync")
 def cmd_sync(ctx: Context, *args):
     """Sync missing song metadata via AI API."""
-    from core.config import scan_music_files
-    # Re-scan folders to pick up newly added files
-    fresh = scan_music_files(ctx.config.get('music_folders', []))
+    from core.library import LibraryIndex, diff_summary
+    # Incremental re-scan: only directories whose mtime changed are re-listed
+    if ctx.library is None:
+        ctx.library = LibraryIndex.load()
+    from core.catalog import reconcile, reconcile_summary
+    diff = ctx.library.rescan(ctx.config.get('music_folders', []))
+    report = reconcile(ctx.library, ctx.aidj.metadata, ctx._freq)
+    from core.tags import index_tags
+    index_tags(ctx.library)
+    ctx.library.save()
+    fresh = ctx.library.music_files()
     ctx.aidj.music_paths = fresh
+    ctx.aidj.durations = ctx.library.durations(fresh)
 
-    missing = {k: v for k, v in fresh.items() if k not in ctx.aidj.metadata}
+    summary = diff_summary(diff)
+    if summary:
+        console.print(summary)
+        for old_p, new_p in diff["moved"][:10]:
+            console.print(f"  [dim]↪ {os.path.basename(old_p)} → {new_p}[/]")
+    else:
+        console.print(f"[dim]📂 Library unchanged ({diff['listed']} dirs re-listed).[/]")
+    for line in reconcile_summary(report):
+        console.print(line)
+
+    job = ctx.sync_job
+    if job and job.running:
+        console.print(f"[cyan]⟳ Background sync: {job.done}/{job.total} processed[/] [dim]{job.postfix}[/]")
+
+    ledger = _failure_ledger(ctx)
+    ledger.prune(fresh)
+    missing, known_bad = ledger.split({k: v for k, v in fresh.items() if k not in ctx.aidj.metadata})
     if not missing:
-        console.print(f"[green]✅ All {len(fresh)} tracks have metadata — nothing to sync.[/]")
+        if known_bad:
+            console.print(
+                f"[green]✅ Nothing to sync.[/] [dim]{len(known_bad)} tracks failed recently and are "
+                f"skipped — see [bold]failed[/bold].[/]"
+            )
+        else:
+            console.print(f"[green]✅ All {len(fresh)} tracks have metadata — nothing to sync.[/]")
         return
 
     if not args or args[0] not in ("run", "go"):
@@ -356,20 +494,221 @@ def cmd_sync(ctx: Context, *args):
             f"[yellow]📋 {len(missing)} tracks missing metadata (out of {len(fresh)} total).[/] "
             f"Use [bold]sync run[/] to start syncing."
         )
+        if known_bad:
+            console.print(f"[dim]   {len(known_bad)} more failed recently and are skipped (see [bold]failed[/bold]).[/]")
         return
 
+    _run_sync(ctx, missing)
+
+
+def _failure_ledger(ctx):
+    if ctx.failures is None:
+        from core.failures import FailureLedger
+        ctx.failures = FailureLedger.load()
+    return ctx.failures
+
+
+def _run_sync(ctx, targets):
+    """对 targets {name: path} 跑元数据同步并报告结果（sync run / failed retry 共用）"""
     from core.dj_core import sync_metadata as _do_sync
 
+    job = ctx.sync_job
+    if job and job.running:
+        console.print(
+            f"[yellow]⟳ Background sync still running ({job.done}/{job.total}).[/] "
+            f"[dim]Run this again once it finishes.[/]"
+        )
+        return
+
     model = ctx.config['ai_settings'].get('metadata_model', 'deepseek-chat')
     conc = ctx.config['preferences'].get('metadata_concurrency', 1)
-    _do_sync(ctx.aidj.client, missing, ctx.aidj.metadata, model, concurrency=conc)
+    tags = {k: ctx.library.tags(p) for k, p in targets.items()}
+    batch = ctx.config['preferences'].get('metadata_batch', 1)
+    _do_sync(ctx.aidj.client, targets, ctx.aidj.metadata, model, concurrency=conc, tags=tags,
+             batch_size=batch, ledger=_failure_ledger(ctx), session=ctx.aidj)
 
-    leftover = sum(1 for k in fresh if k not in ctx.aidj.metadata)
+    leftover = sum(1 for k in targets if k not in ctx.aidj.metadata)
     console.print(
         f"[green]✅ Sync done.[/] "
-        f"{len(missing) - leftover}/{len(missing)} succeeded, {leftover} remaining."
+        f"{len(targets) - leftover}/{len(targets)} succeeded, {leftover} remaining."
     )
 
+
+@registry.register("failed", "fails")
+def cmd_failed(ctx: Context, *args):
+    """List songs that failed metadata sync: failed [retry|clear] [name...]."""
+    from core.failures import STAGE_LABELS
+
+    ledger = _failure_ledger(ctx)
+    action = args[0].lower() if args else "list"
+    query = " ".join(args[1:]).strip().lower()
+    names = sorted(n for n in ledger.entries if not query or query in n.lower())
+
+    if action in ("list", "ls"):
+        if not ledger.entries:
+            console.print("[green]✨ No recorded sync failures.[/]")
+            return
+        now = time.time()
+        by_stage = {}
+        for name in names:
+            by_stage.setdefault(ledger.entries[name]["stage"], []).append(name)
+        console.print(f"[cyan]🩹 {len(ledger.entries)} songs failed metadata sync:[/]")
+        for stage, group in sorted(by_stage.items()):
+            console.print(f"\n  [bold]{STAGE_LABELS.get(stage, stage)}[/] ({len(group)})")
+            for name in group[:20]:
+                e = ledger.entries[name]
+                left = e["expires"] - now
+                when = f"retry in {left / 3600:.0f}h" if left > 0 else "retry next sync"
+                console.print(f"    [white]{name}[/] [dim]× {e['count']}, {when} — {e['reason']}[/]")
+            if len(group) > 20:
+                console.print(f"    [dim]... and {len(group) - 20} more[/]")
+        console.print("\n[dim]failed retry [name] — sync them now; failed clear [name] — forget them[/]")
+        return
+
+    if action not in ("retry", "clear"):
+        console.print("Usage: failed [retry|clear] [name...]")
+        return
+    if not names:
+        console.print("[yellow]No matching failures.[/]")
+        return
+    for name in names:
+        ledger.clear(name)
+    ledger.save()
+
+    if action == "clear":
+        console.print(f"[green]🧹 Cleared {len(names)} failure records; they will be retried on the next sync.[/]")
+        return
+
+    targets = {n: ctx.aidj.music_paths[n] for n in names
+               if n in ctx.aidj.music_paths and n not in ctx.aidj.metadata}
+    if not targets:
+        console.print("[dim]Nothing left to retry (already synced or no longer in the library).[/]")
+        return
+    if ctx.library is None:
+        from core.library import LibraryIndex
+        ctx.library = LibraryIndex.load()
+    _run_sync(ctx, targets)
+
+@registry.register("dupes", "dup")
+def cmd_dupes(ctx: Context, *args):
+    """List duplicate tracks (same audio content hash) in the library."""
+    if ctx.library is None:
+        console.print("[yellow]Library index not loaded. Run [bold]sync[/] first.[/]")
+        return
+
+    groups = ctx.library.duplicates()
+    if not groups:
+        console.print(f"[green]✨ No duplicates among {len(ctx.library.files)} indexed files.[/]")
+        return
+
+    kept = set(ctx.aidj.music_paths.values())
+    console.print(f"[cyan]♊ {len(groups)} duplicate group(s):[/]")
+    for paths in groups:
+        console.print("")
+        for p in paths:
+            mark = "[green]● kept[/]   " if p in kept else "[dim]○ hidden[/] "
+            console.print(f"  {mark} {p}")
+    console.print("\n[dim]Hidden copies are excluded from the library; delete them to reclaim space.[/]")
+
+@registry.register("watch")
+def cmd_watch(ctx: Context, *args):
+    """Live library watcher: watch [on|off] — auto-ingest new music files."""
+    from core.watcher import start_watcher
+
+    curr = ctx.config['preferences'].get('library_watch', False)
+    w = ctx.watcher
+
+    if not args:
+        if w and w.running:
+            console.print(
+                f"[cyan]👀 Library watch: [bold green]ON[/] — "
+                f"{w.watch_count} dirs, {w.backlog} queued, {w.ingested} ingested this session[/]"
+            )
+        else:
+            console.print(f"[cyan]👀 Library watch: [bold]{'ON (not running)' if curr else 'OFF'}[/][/]")
+        console.print("Usage: watch <on|off>")
+        return
+
+    state = args[0].lower()
+    if state in ("on", "true", "1", "yes"):
+        if w and w.running:
+            console.print("[yellow]Library watch is already running.[/]")
+        else:
+            if ctx.library is None:
+                from core.library import LibraryIndex
+                ctx.library = LibraryIndex.load()
+                ctx.library.rescan(ctx.config.get('music_folders', []))
+                ctx.library.save()
+            ctx.watcher = start_watcher(ctx.aidj, ctx.library, ctx.config, lambda: ctx._freq)
+            if ctx.watcher is None:
+                return
+        ctx.config['preferences']['library_watch'] = True
+    elif state in ("off", "false", "0", "no"):
+        if w:
+            w.stop()
+            ctx.watcher = None
+        ctx.config['preferences']['library_watch'] = False
+        console.print("[yellow]👀 Library watch: OFF[/]")
+    else:
+        console.print(f"[red]Invalid state '{state}'. Use on/off[/]")
+        return
+
+    save_config(ctx.config)
+
+@registry.register("backend", "metastore")
+def cmd_backend(ctx: Context, *args):
+    """Metadata storage backend: backend <jsonl|sqlite>."""
+    from core.config import load_cached_metadata
+
+    valid = {"jsonl", "sqlite"}
+    current = ctx.config['preferences'].get('metadata_backend', 'jsonl')
+
+    if not args:
+        console.print(f"[cyan]Metadata backend: [bold]{current}[/] ({len(ctx.aidj.metadata)} songs loaded)[/]")
+        console.print("  [dim]jsonl[/]  — parse music_metadata.jsonl into memory at startup")
+        console.print("  [dim]sqlite[/] — lazy, indexed store; analyse runs as SQL aggregates")
+        console.print("Usage: backend <jsonl|sqlite>")
+        return
+
+    choice = args[0].lower()
+    if choice not in valid:
+        console.print(f"[red]Invalid backend '{choice}'. Use: jsonl, sqlite[/]")
+        return
+
+    metadata = load_cached_metadata(choice)
+    if choice == "sqlite" and not hasattr(metadata, "distribution"):
+        return  # open_metadata_store 已打印原因，保持原 backend
+
+    with ctx.aidj.lock:
+        old = ctx.aidj.metadata
+        ctx.aidj.metadata = metadata
+    if old is not metadata and hasattr(old, "close"):
+        old.close()
+
+    ctx.config['preferences']['metadata_backend'] = choice
+    save_config(ctx.config)
+    console.print(f"[green]🗄️  Metadata backend: [bold]{choice}[/] ({len(metadata)} songs)[/]")
+
+@registry.register("compact")
+def cmd_compact(ctx: Context, *args):
+    """Compact music_metadata.jsonl: keep only the latest record per song."""
+    from core.config import compact_metadata_jsonl, compaction_summary
+
+    stats = compact_metadata_jsonl()
+    if stats is None:
+        console.print("[yellow]Nothing to compact (no metadata JSONL found).[/]")
+        return
+    if stats["lines_before"] == stats["lines_after"]:
+        console.print(f"[green]✅ Metadata JSONL already compact ({stats['lines_after']} songs).[/]")
+        return
+    console.print(compaction_summary(stats))
+
+    # SQLite store: 文件被重写 → 从新文件重建
+    metadata = ctx.aidj.metadata
+    if hasattr(metadata, "catch_up"):
+        metadata.catch_up()
+        metadata.load_names()
+
 @registry.register("adjmethod", "loudnorm")
 def cmd_adjmethod(ctx: Context, *args):
     """Set volume adjustment strategy: linear (RMS) or lufs (ITU-R BS.1770 perceptual)."""
@@ -578,7 +917,7 @@ def cmd_prompt_random(ctx: Context, *args):
         f"5. Write in {LANGUAGE}. 6. Intro BEFORE separator, keys AFTER."
     )
     
-    pl, intro = ctx.aidj.next_step(system_req)
+    pl, intro = ctx.aidj.next_step(system_req, command="pr")
     if not pl: 
          console.print("[yellow]AI curation failed, falling back to raw selection.[/]")
          pl = [{"name": k, "path": ctx.aidj.music_paths[k]} for k in random_keys]
@@ -642,7 +981,7 @@ def _c_vlc(ctx: Context, *args):
 def _c_send(ctx: Context, *args):
     """Send list to active DBus player."""
     _player_helper(ctx, "send")
-    _bump_freq(ctx)
+    _bump_freq(ctx, "send")
 
 @registry.register("ls", "players")
 def cmd_list_players(ctx: Context, *args):
@@ -738,7 +1077,7 @@ def cmd_remove(ctx: Context, *args):
         removed = ctx.play_list.pop(idx)
         ui.print_action_feedback(f"Removed: [bold]{removed['name']}[/]")
         # 只有当删除了东西，才打印新的列表，或者你可以选择只打印 feedback
-        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Updated List")
+        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Updated List", durations=ctx.aidj.durations)
     else:
         console.print(f"[red]❌ Index out of range (1-{len(ctx.play_list)}).[/]")
 
@@ -765,7 +1104,7 @@ def cmd_add(ctx: Context, *args):
         ctx.play_list.append({"name": name, "path": ctx.aidj.music_paths[name]})
         ui.print_action_feedback(f"Added: [bold]{name}[/]")
         # 自动滚动到最后一行显示
-        ui.print_playlist(ctx.play_list[-3:], ctx.aidj.metadata, "Added (Showing last 3)")
+        ui.print_playlist(ctx.play_list[-3:], ctx.aidj.metadata, "Added (Showing last 3)", durations=ctx.aidj.durations)
     else:
         console.print(f"[red]❌ Song '{query}' not found in library.[/]")
 
@@ -786,7 +1125,7 @@ def cmd_move(ctx: Context, *args):
         item = ctx.play_list.pop(src)
         ctx.play_list.insert(dst, item)
         ui.print_action_feedback(f"Moved '{item['name']}' to #{dst+1}")
-        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Reordered")
+        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Reordered", durations=ctx.aidj.durations)
     else:
         console.print("[red]❌ Index out of range.[/]")
 
@@ -803,7 +1142,7 @@ def cmd_swap(ctx: Context, *args):
     if 0 <= i1 < len(L) and 0 <= i2 < len(L):
         L[i1], L[i2] = L[i2], L[i1]
         ui.print_action_feedback(f"Swapped #{i1+1} and #{i2+1}")
-        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Swapped")
+        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Swapped", durations=ctx.aidj.durations)
     else:
         console.print("[red]❌ Index out of range.[/]")
 
@@ -813,7 +1152,7 @@ def cmd_shuffle(ctx: Context, *args):
     if not ctx.play_list: return
     random.shuffle(ctx.play_list)
     ui.print_action_feedback("Playlist shuffled locally.")
-    ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Shuffled")
+    ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Shuffled", durations=ctx.aidj.durations)
 
 @registry.register("reverse", "rev")
 def cmd_reverse(ctx: Context, *args):
@@ -821,7 +1160,7 @@ def cmd_reverse(ctx: Context, *args):
     if not ctx.play_list: return
     ctx.play_list.reverse()
     ui.print_action_feedback("Playlist reversed.")
-    ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Reversed")
+    ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Reversed", durations=ctx.aidj.durations)
 
 @registry.register("dedup", "unique")
 def cmd_dedup(ctx: Context, *args):
@@ -840,7 +1179,7 @@ def cmd_dedup(ctx: Context, *args):
 
     if removed_count > 0:
         ui.print_action_feedback(f"Removed {removed_count} duplicates.")
-        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Cleaned")
+        ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Cleaned", durations=ctx.aidj.durations)
     else:
         console.print("[yellow]✨ No duplicates found.[/]")
 
@@ -865,7 +1204,7 @@ def cmd_view(ctx: Context, *args):
         console.print("[yellow]⚠️ Playlist is empty.[/]")
         return
     # 复用 ui.py 里的打印函数
-    ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Current Queue")
+    ui.print_playlist(ctx.play_list, ctx.aidj.metadata, "Current Queue", durations=ctx.aidj.durations)
 
 def _parse_lrc(lrc_text):
     """Parse LRC text into [(seconds, text), ...]. Handles multi-timestamp lines."""
@@ -898,7 +1237,8 @@ def _get_lyrics_data(title, artist, file_url=None):
     title_safe = re.sub(r'[\\/*?:"<>|]', "", title.strip(" -"))
     artist_safe = re.sub(r'[\\/*?:"<>|]', "", artist.strip(" -"))
 
-    # 0. 优先用音频文件名查 LRC（tools/lyrics_sync.py 用文件名存的）
+    # 0. 优先用音频文件名查 LRC（tools/lyrics_sync.py 和 sync 用文件名存的）
+    file_basename = None
     if file_url and file_url.startswith("file://"):
         raw_path = file_url
         # Strip file:// prefix, then URL-decode (DBus encodes non-ASCII)
@@ -944,19 +1284,17 @@ def _get_lyrics_data(title, artist, file_url=None):
 
     try:
         kw = f"{title} {artist}".strip()
-        # 搜索
-        s_res = requests.get(f"{NCM_BASE_URL}/search", params={"keywords": kw, "limit": 1}, timeout=5).json()
-
-        raw = "[00:00.00] 暂无歌词"
-        if s_res.get('code') == 200 and s_res['result']['songCount'] > 0:
-            sid = s_res['result']['songs'][0]['id']
-            # 获取
-            l_res = requests.get(f"{NCM_BASE_URL}/lyric", params={"id": sid}, timeout=5).json()
-            if l_res.get('code') == 200:
-                raw = l_res.get('lrc', {}).get('lyric', "")
-                if not raw: raw = "[00:00.00] 纯音乐或无歌词"
-
-        # 写缓存
+        # 搜索（同步时按文件名解析过的 song id 直接复用）
+        sid = ncm.resolve(file_basename, [kw]) if file_basename else ncm.search_song(kw)
+
+        lyric = ncm.fetch_lyric(sid) if sid is not None else None
+        # 真歌词按文件名存，sync / ncm.cached_lyric 可直接复用
+        if lyric and file_basename and ncm.save_lyric(file_basename, lyric):
+            return _parse_lrc(lyric)
+
+        # 占位文本只写在 "title - artist" 名下（下次第 1 步命中，不再请求），
+        # 不能占用文件名那份，否则会被当成真歌词
+        raw = lyric or ("[00:00.00] 纯音乐或无歌词" if sid is not None else "[00:00.00] 暂无歌词")
         with open(fpath, 'w', encoding='utf-8') as f:
             f.write(raw)
         return _parse_lrc(raw)
@@ -1146,6 +1484,11 @@ def cmd_games(ctx: Context, *args):
     from wait_games import run_free_play
     run_free_play()
 
+# pc 预取：剩余可播时长 < 预计 LLM 耗时 + 余量 时才请求下一批
+PC_PREFETCH_MARGIN = 20         # 秒
+PC_DEFAULT_LATENCY = 45         # 还没有该模型的耗时样本时的估计（秒）
+PC_DEFAULT_TRACK_SECONDS = 210  # 时长未知的曲目按此估算
+
 @registry.register("pc")
 def cmd_pc(ctx: Context, *args):
     """
@@ -1192,10 +1535,10 @@ def cmd_pc(ctx: Context, *args):
     rolling_history = deque(list(ctx.aidj.played_songs), maxlen=100)
 
     pc_status = {'count': 0, 'working': False}
+    playing = {'name': None, 'started': 0.0}  # 当前曲目及开始时间，用于估算剩余可播时长
     fetch_lock = threading.RLock()  # 防止重复 spawn fetch 线程（可重入锁）
     stop_event = threading.Event()
     fetch_count = 0
-    pc_freq_count = 0  # PC 模式下的切歌计数，用于批量 flush
 
     # --- 2. Suspend Injectors (Disable Games) ---
     original_injects = ctx.aidj.wait_injects[:]
@@ -1210,10 +1553,11 @@ def cmd_pc(ctx: Context, *args):
             pc_status['working'] = True
         pc_status['count'] = 0
         try:
-            # Context Pruning (Keep last 10 messages)
+            # Context Pruning：超过 10 条时一次裁到最近 2 轮（system + 4 条），
+            # 而不是每轮都挪动窗口 —— 两次裁剪之间历史只追加，provider 的前缀缓存能一直命中
             with fetch_lock:
                 if len(ctx.aidj.chat_history) > 10:
-                    ctx.aidj.chat_history = [ctx.aidj.chat_history[0]] + ctx.aidj.chat_history[-9:]
+                    ctx.aidj.chat_history = [ctx.aidj.chat_history[0]] + ctx.aidj.chat_history[-4:]
 
                 # 将内部 deque 赋值给 dj session 对象，供 next_step 内部解析使用
                 ctx.aidj.played_songs = set(rolling_history)
@@ -1249,19 +1593,58 @@ def cmd_pc(ctx: Context, *args):
                 f"4. Use EXACT library keys. NO hallucination."
             )
 
+            # 流式解析：第一首歌一出现就挂进 buffer，消费端不必等整段回复结束；
+            # 之后到达的歌追加到同一个 list（可能已成为 current_queue）
+            batch = []
+            attached = False
+
+            def on_track(track):
+                nonlocal attached
+                batch.append(track)
+                rolling_history.append(track['name'])
+                if not attached:
+                    attached = True
+                    buffer.append(batch) # 仅存歌单，不存 Intro
+
             # 这里的 external_status 会解决字符计为 0 的问题
-            pl, _ = ctx.aidj.next_step(full_prompt, external_status=pc_status)
+            pl, _ = ctx.aidj.next_step(full_prompt, external_status=pc_status, on_track=on_track, command="pc")
 
             if pl:
-                buffer.append(pl) # 仅存歌单，不存 Intro
+                # 以完整解析结果为准，补上流式阶段没匹配到的歌
+                streamed = {t['name'] for t in batch}
                 for s in pl:
-                    rolling_history.append(s['name'])
+                    if s['name'] not in streamed:
+                        on_track(s)
                 fetch_count += 1
         except Exception as e:
             console.print(f"[red]⚠️ PC fetch error: {e}[/]")
         finally:
             pc_status['working'] = False
 
+    def queued_time():
+        """排队中（当前队列 + buffer）曲目的总时长；全都未知时不显示"""
+        tracks = current_queue + [t for batch in buffer for t in batch]
+        known = [ctx.aidj.durations[t['name']] for t in tracks if t['name'] in ctx.aidj.durations]
+        return f" | ⏱ {ui.fmt_duration(sum(known))} queued" if known else ""
+
+    def remaining_playtime():
+        """正在播放的曲目剩余时长（按开始播放时间估算）+ 排队中曲目总时长；未知时长按默认值计"""
+        durations = ctx.aidj.durations
+        tracks = current_queue + [t for batch in buffer for t in batch]
+        total = sum(durations.get(t['name'], PC_DEFAULT_TRACK_SECONDS) for t in tracks)
+        if playing['name'] is not None:
+            length = durations.get(playing['name'], PC_DEFAULT_TRACK_SECONDS)
+            total += max(0.0, length - (time.time() - playing['started']))
+        return total
+
+    def prefetch_lead():
+        """预计 LLM 耗时（本会话该模型 pc 请求的 p95，退而求其次用 p 的）+ 余量"""
+        model = ctx.config['preferences']['model']
+        latency = (llm_metrics.expected_latency(model, "pc")
+                   or llm_metrics.expected_latency(model, "p")
+                   or PC_DEFAULT_LATENCY)
+        return latency + PC_PREFETCH_MARGIN
+
     def make_pc_panel():
         p_status = ctx.dbus.get_status()
         track = ctx.dbus.get_current_track_name()
@@ -1278,7 +1661,9 @@ def cmd_pc(ctx: Context, *args):
             f"[bold green]🚦 Player Status:[/][yellow] {p_status}[/]",
             f"[bold magenta]🎵 Now Playing:[/][white] {track}[/]",
             "---",
-            f"📦 Queue: [bold]{len(current_queue)}[/] | Batch Buffer: [bold]{len(buffer)}/2[/]",
+            f"📦 Queue: [bold]{len(current_queue)}[/] | Batch Buffer: [bold]{len(buffer)}[/]{queued_time()}",
+            f"⏳ Prefetch: when < [bold]{ui.fmt_duration(prefetch_lead())}[/] left "
+            f"(~{ui.fmt_duration(remaining_playtime())} now)",
             f"🧠 AI Engine: {'[blink orange1]THINKING...[/]' if pc_status['working'] else '[dim]IDLE[/]'}",
             f"📝 Progress: [bold green]{pc_status['count']}[/] chars | Round: #{fetch_count + 1}",
             f"💾 Memory: [bold]{len(rolling_history)}[/]/100 tracks{vol_info}"
@@ -1325,8 +1710,9 @@ def cmd_pc(ctx: Context, *args):
     with Live(make_pc_panel(), console=console, transient=True) as live:
         try:
             while not stop_event.is_set():
-                # Producer: fetch_lock inside fetch_next_batch prevents double-spawn
-                if len(buffer) < 2 and not pc_status['working']:
+                # Producer: 剩余可播时长不够覆盖下一次 LLM 请求时才预取
+                # fetch_lock inside fetch_next_batch prevents double-spawn
+                if not pc_status['working'] and remaining_playtime() < prefetch_lead():
                     threading.Thread(target=fetch_next_batch, daemon=True).start()
 
                 # Consumer
@@ -1388,15 +1774,12 @@ def cmd_pc(ctx: Context, *args):
                                 vol_cache.pre_analyze(next_path)
 
                         ctx.dbus.send_files([next_track['path']])
+                        playing['name'], playing['started'] = next_track['name'], time.time()
 
                         # Record frequency on actual track switch (PC mode)
+                        # 追加一行到 play log，合并由 record_plays 按需完成
                         if ctx.config['preferences'].get('record_freq', False) and ctx._freq is not None:
-                            bump_frequency(ctx._freq, [next_track['name']])
-                            pc_freq_count += 1
-                            # Flush every 10 tracks to minimize IO
-                            if pc_freq_count >= 10:
-                                save_frequency(ctx._freq)
-                                pc_freq_count = 0
+                            record_plays(ctx._freq, [next_track['name']], "pc")
 
                         time.sleep(2)
                     elif buffer:
@@ -1421,7 +1804,4 @@ def cmd_pc(ctx: Context, *args):
         finally:
             stop_event.set()
             ctx.aidj.wait_injects = original_injects
-            # Flush remaining frequency changes before exit
-            if ctx.config['preferences'].get('record_freq', False) and ctx._freq is not None and pc_freq_count > 0:
-                save_frequency(ctx._freq)
             console.print("\n[yellow]🛑 PC Mode Exited. Restoring CLI...[/]")
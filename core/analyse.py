@@ -1,6 +1,7 @@
 """Metadata analyser — normalise & compute distributions for language / emotion / genre."""
 import json
 import re
+import hashlib
 from collections import Counter
 from core.log import log
 
@@ -338,37 +339,103 @@ def load_metadata(path: str | None = None) -> list[dict]:
     return entries
 
 
+# ── Precomputed canonical tags ─────────────────────────────
+#
+# Records are normalised once when they are written: the canonical tag lists
+# are stored next to the raw LLM values under ``meta["_norm"]`` together with
+# ``NORMALISER_VERSION``.  The version hashes the maps above, so editing
+# LANG_MAP / EMOTION_SYNONYMS / GENRE_MAP makes every record stale and the
+# next startup re-normalises them in bulk; otherwise nothing is recomputed.
+
+NORMALISER_REVISION = 1  # bump when the normalise_* code (not just the maps) changes
+TAG_FIELDS = ("language", "emotion", "genre")
+NORM_KEY = "_norm"
+
+NORMALISER_VERSION = hashlib.sha1(
+    json.dumps([NORMALISER_REVISION, LANG_MAP, EMOTION_SYNONYMS, GENRE_MAP],
+               ensure_ascii=False, sort_keys=True).encode("utf-8")
+).hexdigest()[:10]
+
+_NORMALISERS = {
+    "language": lambda raw: [normalise_language(raw)],
+    "emotion": normalise_emotion,
+    "genre": normalise_genre,
+}
+
+
+def canonical_tags(meta) -> dict:
+    """{field: [canonical tags]} for the fields present in *meta*."""
+    if not isinstance(meta, dict):
+        return {}
+    return {f: _NORMALISERS[f](meta[f]) for f in TAG_FIELDS if meta.get(f) is not None}
+
+
+def is_normalised(meta) -> bool:
+    norm = meta.get(NORM_KEY) if isinstance(meta, dict) else None
+    return isinstance(norm, dict) and norm.get("v") == NORMALISER_VERSION
+
+
+def normalise_record(meta):
+    """Store the canonical tags in *meta* (in place) and return it."""
+    if isinstance(meta, dict):
+        meta[NORM_KEY] = {**canonical_tags(meta), "v": NORMALISER_VERSION}
+    return meta
+
+
+def song_tags(meta, field: str) -> list[str]:
+    """Canonical tags of one record — precomputed when current, else computed on the fly."""
+    if field not in _NORMALISERS:
+        raise ValueError(f"Unknown field: {field}")
+    if is_normalised(meta):
+        return meta[NORM_KEY].get(field, [])
+    return canonical_tags(meta).get(field, [])
+
+
+def renormalise(metadata) -> list[str]:
+    """Bring every stale record up to NORMALISER_VERSION; returns the names that changed."""
+    changed = []
+    for name, meta in metadata.items():
+        if isinstance(meta, dict) and not is_normalised(meta):
+            normalise_record(meta)
+            changed.append(name)
+    return changed
+
+
+def _distribution(counter: Counter):
+    total = sum(counter.values())
+    items = [(label, count, round(count / total * 100, 1)) for label, count in counter.most_common()]
+    return items, total
+
+
+def tag_distribution(metadata, field: str):
+    """Distribution over an in-memory {name: meta} mapping, from the precomputed tags."""
+    counter: Counter = Counter()
+    for meta in metadata.values():
+        counter.update(song_tags(meta, field))
+    return _distribution(counter)
+
+
 def compute_distribution(entries: list[dict], field: str):
     """Compute normalised distribution for a metadata field.
 
     Returns (sorted_items, total_entries) where sorted_items is
     [(label, count, pct), ...] sorted by count descending.
     """
-    normaliser = {
-        "language": normalise_language,
-        "emotion": normalise_emotion,
-        "genre": normalise_genre,
-    }.get(field)
-
-    if not normaliser:
-        raise ValueError(f"Unknown field: {field}")
-
     counter: Counter = Counter()
     for entry in entries:
-        meta = entry.get("metadata", {})
-        raw = meta.get(field)
-        if raw is None:
-            continue
+        counter.update(song_tags(entry.get("metadata", {}), field))
+    return _distribution(counter)
 
-        norm = normaliser(raw)
-        if isinstance(norm, list):
-            # emotion & genre are multi-tag
-            for tag in norm:
-                counter[tag] += 1
-        else:
-            # language is single
-            counter[norm] += 1
 
-    total = sum(counter.values())
-    items = [(label, count, round(count / total * 100, 1)) for label, count in counter.most_common()]
-    return items, total
+def names_with_tag(metadata, field: str, tag: str) -> list[str]:
+    """Song names whose normalised *field* contains *tag* (case-insensitive).
+
+    Uses the indexed SQL lookup when *metadata* is a SQLite store,
+    otherwise scans the precomputed tags of the in-memory dict.
+    """
+    if hasattr(metadata, "names_with_tag"):
+        return metadata.names_with_tag(field, tag)
+
+    want = tag.lower()
+    return [name for name, meta in metadata.items()
+            if any(t.lower() == want for t in song_tags(meta, field))]
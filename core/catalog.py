@@ -0,0 +1,187 @@
+"""Content-hash catalog — deduplicate tracks and carry data across renames.
+
+Each indexed file gets a sampled BLAKE2 hash of its *audio payload* (ID3v2 /
+ID3v1 / FLAC metadata blocks are skipped, so re-tagging does not change it).
+``LibraryIndex.catalog`` remembers which song key every hash was last known
+under; when a file shows up under a new name, its metadata, play count and
+lyrics are moved over instead of being fetched again.
+"""
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from core.log import log
+from core.config import append_metadata_jsonl, load_frequency, save_frequency
+from core.ncm import lyric_path
+
+HASH_VERSION = "v1"
+SAMPLE_SIZE = 16 * 1024   # 头 / 中 / 尾各采样 16 KiB
+HASH_WORKERS = 8
+
+
+def _payload_range(f, size):
+    """返回音频数据的 [start, end)，跳过常见的标签区块"""
+    start, end = 0, size
+    head = f.read(10)
+    if head[:3] == b"ID3" and len(head) == 10:
+        # ID3v2: 28-bit syncsafe 长度，flags bit4 表示有 footer
+        tag_len = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        start = 10 + tag_len + (10 if head[5] & 0x10 else 0)
+    elif head[:4] == b"fLaC":
+        pos = 4
+        while pos + 4 <= size:
+            f.seek(pos)
+            block = f.read(4)
+            if len(block) < 4:
+                break
+            pos += 4 + int.from_bytes(block[1:4], "big")
+            if block[0] & 0x80:  # last-metadata-block flag
+                break
+        start = pos
+    if size >= 128:
+        f.seek(size - 128)
+        if f.read(3) == b"TAG":
+            end = size - 128
+    if start >= end:
+        return 0, size
+    return start, end
+
+
+def content_hash(path):
+    """采样哈希：payload 长度 + 头 / 中 / 尾三段；失败返回 None"""
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            start, end = _payload_range(f, size)
+            length = end - start
+            h = hashlib.blake2b(digest_size=16)
+            h.update(length.to_bytes(8, "little"))
+            if length <= SAMPLE_SIZE * 3:
+                offsets = [start]
+                read_len = length
+            else:
+                offsets = [start, start + (length - SAMPLE_SIZE) // 2, end - SAMPLE_SIZE]
+                read_len = SAMPLE_SIZE
+            for off in offsets:
+                f.seek(off)
+                h.update(f.read(read_len))
+        return f"{HASH_VERSION}:{h.hexdigest()}"
+    except OSError:
+        return None
+
+
+def hash_missing(library, workers=HASH_WORKERS):
+    """并行为索引中尚无 hash（或 hash 版本过期）的文件计算 hash，返回计算数量"""
+    prefix = HASH_VERSION + ":"
+    with library.lock:
+        todo = [p for p, st in library.files.items() if not st.get("hash", "").startswith(prefix)]
+    if not todo:
+        return 0
+    if len(todo) > 200:
+        log(f"[dim]🔑 Hashing {len(todo)} tracks (one-time, sampled)...[/]")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(content_hash, todo))
+
+    done = 0
+    with library.lock:
+        for p, h in zip(todo, hashes):
+            if h and p in library.files:
+                library.files[p]["hash"] = h
+                done += 1
+        if done:
+            library.dirty = True
+    return done
+
+
+def carry_over(old_name, new_name, metadata, freq):
+    """把 old_name 的 metadata / 播放次数 / 歌词迁移到 new_name，返回迁移了哪些"""
+    moved = []
+    if old_name in metadata and new_name not in metadata:
+        metadata[new_name] = metadata[old_name]
+        append_metadata_jsonl(new_name, metadata[new_name])
+        moved.append("metadata")
+    if freq is not None and old_name in freq:
+        if hasattr(freq, "rename"):
+            freq.rename(old_name, new_name)
+        else:
+            freq[new_name] = freq.get(new_name, 0) + freq.pop(old_name)
+        moved.append("plays")
+    old_lrc, new_lrc = lyric_path(old_name), lyric_path(new_name)
+    if os.path.exists(old_lrc) and not os.path.exists(new_lrc):
+        try:
+            os.replace(old_lrc, new_lrc)
+            moved.append("lyrics")
+        except OSError:
+            pass
+    return moved
+
+
+def reconcile(library, metadata, freq=None):
+    """
+    计算缺失的 hash，把改名 / 移动后的曲目接回原有数据，并更新 catalog。
+    freq 为 None 时直接读写 frequency.csv。
+    返回 {"hashed": n, "remapped": [(old, new, [what])], "duplicates": n_groups}
+    """
+    hashed = hash_missing(library)
+    music_files = library.music_files()
+
+    own_freq = freq is None
+    if own_freq:
+        freq = load_frequency()
+
+    remapped = []
+    with library.lock:
+        key_hash = {k: library.files[p].get("hash") for k, p in music_files.items() if p in library.files}
+        for key, h in key_hash.items():
+            if not h:
+                continue
+            old_name = library.catalog.get(h)
+            if old_name and old_name != key and old_name not in music_files and key not in metadata:
+                what = carry_over(old_name, key, metadata, freq)
+                if what:
+                    remapped.append((old_name, key, what))
+            if library.catalog.get(h) != key:
+                library.catalog[h] = key
+                library.dirty = True
+
+    if own_freq and any("plays" in what for _, _, what in remapped):
+        save_frequency(freq)
+
+    return {"hashed": hashed, "remapped": remapped, "duplicates": len(library.duplicates())}
+
+
+def adopt(library, path, name, metadata, freq=None, h=None):
+    """
+    单个新文件（watcher 用）：若内容 hash 已知且旧名已不在库中，迁移数据。
+    h 为调用方已算好的内容 hash。返回旧名或 None。
+    """
+    h = h or content_hash(path)
+    if not h:
+        return None
+    with library.lock:
+        if path in library.files:
+            library.files[path]["hash"] = h
+        old_name = library.catalog.get(h)
+        library.catalog[h] = name
+        library.dirty = True
+    if not old_name or old_name == name or name in metadata:
+        return None
+    own_freq = freq is None
+    if own_freq:
+        freq = load_frequency()
+    what = carry_over(old_name, name, metadata, freq)
+    if own_freq and "plays" in what:
+        save_frequency(freq)
+    return old_name if what else None
+
+
+def reconcile_summary(report):
+    """Rich summary lines for a reconcile report (empty list when nothing to say)."""
+    lines = []
+    for old, new, what in report["remapped"][:10]:
+        lines.append(f"  [dim]🔗 {old} → {new} ({', '.join(what)} carried over)[/]")
+    if len(report["remapped"]) > 10:
+        lines.append(f"  [dim]... and {len(report['remapped']) - 10} more renamed tracks[/]")
+    if report["duplicates"]:
+        lines.append(f"[yellow]♊ {report['duplicates']} duplicate track group(s) — see [bold]dupes[/].[/]")
+    return lines
@@ -10,11 +10,15 @@ class Context:
     上下文对象：持有所有系统组件的状态。
     被传递给每一个命令函数。
     """
-    def __init__(self, aidj, dbus, config, play_list=None):
+    def __init__(self, aidj, dbus, config, play_list=None, library=None):
         self.aidj = aidj
         self.dbus = dbus
         self.config = config
         self.play_list = play_list or [] # 全局播放列表
+        self.library = library # 持久化曲库索引 (core.library.LibraryIndex)
+        self.watcher = None # 后台曲库监视器 (core.watcher.LibraryWatcher)
+        self.failures = None # 同步失败记录 (core.failures.FailureLedger)
+        self.sync_job = None # 后台元数据同步 (core.metasync.BackgroundSync)
         self.console = console
 
 class CommandRegistry:
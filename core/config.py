@@ -1,18 +1,37 @@
 import os
 import json
 import csv
+import math
+import time
+import heapq
+import queue
+import atexit
+import threading
 from core.log import *
 
 CONFIG_PATH = "./data/config.json"
 METADATA_PATH = "./data/music_metadata.json"
 METADATA_JSONL_PATH = "./data/music_metadata.jsonl"
+METADATA_DB_PATH = "./data/music_metadata.db"
 FREQ_CSV_PATH = "./data/frequency.csv"
+PLAY_LOG_PATH = "./data/play_log.csv"
+LIBRARY_INDEX_PATH = "./data/library_index.json"
+SNAPSHOT_PATH = "./data/runtime_snapshot.pkl"
+NCM_CACHE_PATH = "./data/ncm_ids.jsonl"
+FAILURE_LEDGER_PATH = "./data/sync_failures.json"
+SONG_IDS_PATH = "./data/song_ids.json"
+PROMPT_PREFIX_PATH = "./data/prompt_prefix.json"
 PLAYLIST_DIR = "./data/playlists"
 LYRICS_DIR = "./data/lyrics"
 MUSIC_EXTS = ('.mp3', '.flac', '.wav', '.m4a')
 NCM_BASE_URL = "http://localhost:3000"
 CFG_KEY_MF = "music_folders"
 
+# 重复 / 损坏行占比超过阈值时，启动加载后自动压缩 JSONL
+JSONL_COMPACT_RATIO = 0.25
+JSONL_COMPACT_MIN_LINES = 200
+_jsonl_lock = threading.Lock()  # append 与 compaction 互斥
+
 SEPARATOR = "[---SONG_LIST---]"
 LANGUAGE = "简体中文"
 
@@ -48,6 +67,12 @@ def load_config():
         "sound_adjust_method": "lufs",
         "volume_curve": 3.0,
         "metadata_concurrency": 1,
+        "metadata_batch": 1,
+        "library_watch": False,
+        "metadata_backend": "jsonl",
+        "library_mode": "full",
+        "retrieval_k": 200,
+        "song_ids": False,
         "library_injects": {
             "genre": True,
             "emotion": True,
@@ -91,24 +116,54 @@ def save_config(config):
     except Exception as e:
         log(f"[red]❌ Failed to save config: {e}[/]")
 
-def load_cached_metadata():
+def load_cached_metadata(backend="jsonl"):
+    """backend="sqlite" 时返回 core.metastore 的惰性 store（自动从 JSONL 导入），失败则回退 JSONL"""
+    if backend == "sqlite":
+        if not os.path.exists(METADATA_JSONL_PATH) and os.path.exists(METADATA_PATH):
+            _load_metadata_jsonl()  # 先完成旧 JSON → JSONL 迁移
+        from core.metastore import open_metadata_store
+        store = open_metadata_store()
+        if store is not None:
+            if _should_compact(store.jsonl_lines, len(store)):
+                log_compaction(compact_metadata_jsonl())
+                store.catch_up()  # inode 已变 → 全量重建
+                store.load_names()
+            return store
+    return _load_metadata_jsonl()
+
+def _read_metadata_jsonl(path=METADATA_JSONL_PATH):
+    """返回 ({name: metadata}, 非空行数)；同名记录以最后一条为准，损坏行跳过"""
+    metadata = {}
+    lines = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            lines += 1
+            try:
+                record = json.loads(line)
+                if "name" in record and "metadata" in record:
+                    metadata.pop(record["name"], None)  # 保持"最后写入"的顺序
+                    metadata[record["name"]] = record["metadata"]
+            except json.JSONDecodeError:
+                continue
+    return metadata, lines
+
+def _should_compact(lines, unique):
+    return lines >= JSONL_COMPACT_MIN_LINES and (lines - unique) / lines > JSONL_COMPACT_RATIO
+
+def _load_metadata_jsonl():
     # 1. JSONL 存在 → 只读 JSONL
     if os.path.exists(METADATA_JSONL_PATH):
         metadata = {}
         try:
-            with open(METADATA_JSONL_PATH, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        record = json.loads(line)
-                        if "name" in record and "metadata" in record:
-                            metadata[record["name"]] = record["metadata"]
-                    except json.JSONDecodeError:
-                        continue
+            metadata, lines = _read_metadata_jsonl()
         except Exception as e:
             log(f"[yellow]⚠️ Failed to read {METADATA_JSONL_PATH}: {e}[/]")
+            return metadata
+        if _should_compact(lines, len(metadata)):
+            log_compaction(compact_metadata_jsonl())
         return metadata
 
     # 2. JSONL 不存在，但旧 JSON 存在 → 读取并迁移到 JSONL
@@ -136,64 +191,311 @@ def load_cached_metadata():
 
     return {}
 
+# JSONL 单写者：append 只入队，后台线程攒批写入（满 N 条或等待 T 秒即落盘）
+JSONL_FLUSH_RECORDS = 64
+JSONL_FLUSH_SECONDS = 1.0
+
+class JsonlWriter:
+    """
+    一个后台线程独占写 JSONL：每批只 open / write / close 一次（不长期持有 fd，
+    compaction 用 os.replace 换掉文件后下一批自然写进新文件）。
+    flush() 等待已入队的行落盘；close() 额外 fsync，退出时经 atexit 调用。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="jsonl-writer", daemon=True)
+                self._thread.start()
+
+    def append(self, line):
+        self._ensure_started()
+        self._queue.put(line)
+
+    def flush(self, fsync=False):
+        """阻塞直到此前入队的行都已写入（未启动时立即返回）"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put((done, fsync))
+        done.wait()
+
+    def close(self):
+        self.flush(fsync=True)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + JSONL_FLUSH_SECONDS
+            while len(batch) < JSONL_FLUSH_RECORDS and not isinstance(batch[-1], tuple):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            lines = [item for item in batch if isinstance(item, str)]
+            markers = [item for item in batch if isinstance(item, tuple)]
+            self._write(lines, fsync=any(fsync for _, fsync in markers))
+            for done, _ in markers:
+                done.set()
+
+    def _write(self, lines, fsync=False):
+        if not lines and not fsync:
+            return
+        try:
+            with _jsonl_lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.written += len(lines)
+        except Exception as e:
+            log(f"[red]❌ Failed to append {len(lines)} metadata records: {e}[/]")
+
+_jsonl_writer = JsonlWriter(METADATA_JSONL_PATH)
+
 def append_metadata_jsonl(song_name, metadata_dict):
-    """追加单条元数据到 JSONL 文件"""
+    """追加单条元数据到 JSONL 文件（交给单写者线程，最多延迟 JSONL_FLUSH_SECONDS 落盘）"""
     try:
         record = {"name": song_name, "metadata": metadata_dict}
-        with open(METADATA_JSONL_PATH, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        _jsonl_writer.append(json.dumps(record, ensure_ascii=False) + "\n")
         return True
     except Exception as e:
         log(f"[red]❌ Failed to append metadata: {e}[/]")
         return False
 
-# --- Frequency Tracking ---
+def flush_metadata_jsonl(fsync=False):
+    """等待所有已追加的元数据写入 JSONL（读文件 / compaction / 退出前调用）"""
+    _jsonl_writer.flush(fsync)
 
-def load_frequency():
-    """从 CSV 加载播放频率到 dict"""
-    freq = {}
-    if not os.path.exists(FREQ_CSV_PATH):
-        return freq
+def compact_metadata_jsonl(path=METADATA_JSONL_PATH):
+    """
+    只保留每首歌的最后一条记录，原子重写 JSONL。
+    返回 {"lines_before", "lines_after", "bytes_before", "bytes_after"}，失败返回 None。
+    """
+    if path == METADATA_JSONL_PATH:
+        flush_metadata_jsonl()
+    if not os.path.exists(path):
+        return None
+    try:
+        with _jsonl_lock:
+            bytes_before = os.path.getsize(path)
+            metadata, lines = _read_metadata_jsonl(path)
+            _write_metadata_jsonl(path, metadata)
+            bytes_after = os.path.getsize(path)
+    except Exception as e:
+        log(f"[red]❌ Failed to compact {path}: {e}[/]")
+        return None
+    return {
+        "lines_before": lines, "lines_after": len(metadata),
+        "bytes_before": bytes_before, "bytes_after": bytes_after,
+    }
+
+def _write_metadata_jsonl(path, metadata):
+    """每首歌一行，tmp + fsync + os.replace 原子重写；调用方持有 _jsonl_lock"""
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            for name, meta in metadata.items():
+                f.write(json.dumps({"name": name, "metadata": meta}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def renormalise_metadata(metadata):
+    """
+    标签映射表（core.analyse 的 NORMALISER_VERSION）变化后批量重算并重写 JSONL；
+    只有个别记录过期（旧版本写入、还没有预计算标签）时逐条追加，留给 compaction 合并。
+    返回 (重算的记录数, 是否整体重写)。SQLite 后端在 catch_up 中自行处理。
+    """
+    from core.analyse import renormalise
+    if not isinstance(metadata, dict):
+        return 0, False
+    changed = renormalise(metadata)
+    if not changed:
+        return 0, False
+    log(f"[dim]🏷️  Re-normalised tags of {len(changed)} metadata records.[/]")
+    # 没有任何记录已是当前版本 → 映射表本身变了（或首次预计算），整体重写
+    if len(changed) < sum(isinstance(meta, dict) for meta in metadata.values()):
+        for name in changed:
+            append_metadata_jsonl(name, metadata[name])
+        return len(changed), False
+    flush_metadata_jsonl()
     try:
-        with open(FREQ_CSV_PATH, "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) == 2 and row[1].isdigit():
-                    freq[row[0]] = int(row[1])
+        with _jsonl_lock:
+            _write_metadata_jsonl(METADATA_JSONL_PATH, metadata)
     except Exception as e:
-        log(f"[yellow]⚠️ Failed to read {FREQ_CSV_PATH}: {e}[/]")
+        log(f"[yellow]⚠️ Failed to persist normalised tags: {e}[/]")
+        return len(changed), False
+    return len(changed), True
+
+def compaction_summary(stats):
+    """Rich one-liner for compact_metadata_jsonl() stats."""
+    kb = lambda n: f"{n / 1024:,.1f} KB"
+    return (
+        f"[green]🧹 Compacted metadata JSONL:[/] {stats['lines_before']} → {stats['lines_after']} lines, "
+        f"{kb(stats['bytes_before'])} → {kb(stats['bytes_after'])} "
+        f"[dim](reclaimed {stats['lines_before'] - stats['lines_after']} lines, "
+        f"{kb(stats['bytes_before'] - stats['bytes_after'])})[/]"
+    )
+
+def log_compaction(stats):
+    if stats:
+        log(compaction_summary(stats))
+
+# --- Frequency Tracking ---
+
+# 播放记录先追加到 play_log.csv（time,name,source），累计到一定行数后
+# 再合并进 frequency.csv（name,times,last,score）并清空日志
+PLAY_LOG_COMPACT_EVERY = 500
+FREQ_HALF_LIFE_DAYS = 30.0  # freqtop recent：播放权重的半衰期
+
+class PlayCounts(dict):
+    """{name: times}，附带时间衰减信息 recent = {name: [last_ts, score_at_last]}"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recent = {}
+        self.pending = 0  # play_log.csv 中尚未合并的行数
+
+    def bump(self, name, ts, half_life_days=FREQ_HALF_LIFE_DAYS):
+        self[name] = self.get(name, 0) + 1
+        self.recent[name] = [ts, self.decayed(name, ts, half_life_days) + 1.0]
+
+    def decayed(self, name, now=None, half_life_days=FREQ_HALF_LIFE_DAYS):
+        """按半衰期衰减后的播放权重；无时间记录（旧数据）时为 0"""
+        entry = self.recent.get(name)
+        if not entry:
+            return 0.0
+        last, score = entry
+        age_days = max(0.0, ((now or time.time()) - last) / 86400)
+        return score * math.pow(0.5, age_days / half_life_days)
+
+    def top(self, k, recent=False, half_life_days=FREQ_HALF_LIFE_DAYS):
+        """heapq top-k：[(name, times, decayed_score)]，不对整个 dict 排序"""
+        now = time.time()
+        if recent:
+            names = heapq.nlargest(k, self.recent, key=lambda n: self.decayed(n, now, half_life_days))
+        else:
+            names = heapq.nlargest(k, self, key=self.__getitem__)
+        return [(n, self.get(n, 0), self.decayed(n, now, half_life_days)) for n in names]
+
+    def rename(self, old, new):
+        """catalog 改名迁移：次数累加，衰减记录跟随"""
+        self[new] = self.get(new, 0) + self.pop(old)
+        if old in self.recent:
+            entry = self.recent.pop(old)
+            if new not in self.recent:
+                self.recent[new] = entry
+
+def load_frequency():
+    """frequency.csv（合并后的计数表）+ 回放 play_log.csv 中尚未合并的播放记录"""
+    freq = PlayCounts()
+    if os.path.exists(FREQ_CSV_PATH):
+        try:
+            with open(FREQ_CSV_PATH, "r", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    # 兼容旧格式 name,times
+                    if len(row) >= 2 and row[1].isdigit():
+                        freq[row[0]] = int(row[1])
+                        if len(row) >= 4 and row[2] and row[3]:
+                            try:
+                                freq.recent[row[0]] = [float(row[2]), float(row[3])]
+                            except ValueError:
+                                pass
+        except Exception as e:
+            log(f"[yellow]⚠️ Failed to read {FREQ_CSV_PATH}: {e}[/]")
+    if os.path.exists(PLAY_LOG_PATH):
+        try:
+            with open(PLAY_LOG_PATH, "r", encoding="utf-8", newline="") as f:
+                for row in csv.reader(f):
+                    if len(row) >= 2:
+                        try:
+                            freq.bump(row[1], float(row[0]))
+                        except ValueError:
+                            continue
+                        freq.pending += 1
+        except Exception as e:
+            log(f"[yellow]⚠️ Failed to read {PLAY_LOG_PATH}: {e}[/]")
     return freq
 
 def save_frequency(freq):
-    """按降序写入 frequency.csv"""
+    """合并：把内存中的计数表按降序原子写入 frequency.csv，然后清空 play_log.csv"""
     if not freq:
         return
+    recent = getattr(freq, "recent", {})
+    tmp = FREQ_CSV_PATH + ".tmp"
     try:
         sorted_items = sorted(freq.items(), key=lambda x: x[1], reverse=True)
-        with open(FREQ_CSV_PATH, "w", encoding="utf-8", newline="") as f:
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
             writer = csv.writer(f)
-            writer.writerow(["name", "times"])
+            writer.writerow(["name", "times", "last", "score"])
             for name, times in sorted_items:
-                writer.writerow([name, times])
+                last, score = recent.get(name, ("", ""))
+                writer.writerow([name, times, f"{last:.0f}" if last != "" else "", f"{score:.4f}" if score != "" else ""])
+        os.replace(tmp, FREQ_CSV_PATH)
+        if os.path.exists(PLAY_LOG_PATH):
+            open(PLAY_LOG_PATH, "w").close()
+        if isinstance(freq, PlayCounts):
+            freq.pending = 0
     except Exception as e:
         log(f"[red]❌ Failed to save frequency: {e}[/]")
 
 def bump_frequency(freq, song_names):
     """内存中对指定歌曲的播放次数 +1，返回是否发生了变更"""
     changed = False
+    now = time.time()
     for name in song_names:
-        freq[name] = freq.get(name, 0) + 1
+        if isinstance(freq, PlayCounts):
+            freq.bump(name, now)
+        else:
+            freq[name] = freq.get(name, 0) + 1
         changed = True
     return changed
 
+def record_plays(freq, song_names, source):
+    """
+    追加播放事件到 play_log.csv（time,name,source）并更新内存计数；
+    未合并行数达到 PLAY_LOG_COMPACT_EVERY 时合并进 frequency.csv。
+    """
+    if not song_names:
+        return False
+    now = time.time()
+    try:
+        with open(PLAY_LOG_PATH, "a", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            for name in song_names:
+                writer.writerow([f"{now:.0f}", name, source])
+    except Exception as e:
+        log(f"[red]❌ Failed to append play log: {e}[/]")
+        return False
+    bump_frequency(freq, song_names)
+    if isinstance(freq, PlayCounts):
+        freq.pending += len(song_names)
+        if freq.pending >= PLAY_LOG_COMPACT_EVERY:
+            save_frequency(freq)
+    return True
+
 # --- Core Logic Functions ---
 def scan_music_files(folders):
+    """非增量全量扫描（并行 scandir），返回 {file stem: path}"""
+    from core.library import scan_audio_files
     music_files = {}
-    for folder in folders:
-        if not os.path.exists(folder): continue
-        for root, _, files in os.walk(folder):
-            for file in files:
-                if file.lower().endswith(MUSIC_EXTS):
-                    file_key = os.path.splitext(file)[0]
-                    music_files[file_key] = os.path.join(root, file)
+    for path in scan_audio_files(folders, MUSIC_EXTS):
+        file_key = os.path.splitext(os.path.basename(path))[0]
+        music_files[file_key] = path
     return music_files
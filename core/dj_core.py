@@ -1,81 +1,337 @@
 import re
-import requests
+import time
 import threading
 from core.log import *
-from tqdm import tqdm
 from rich.panel import Panel
-from rapidfuzz import process, fuzz
 from concurrent.futures import ThreadPoolExecutor
 
 from core.config import *
-
-def get_song_info(client, song_info, model_name):
+from core import ncm
+from core.analyse import TAG_FIELDS, NORMALISER_VERSION, song_tags
+from core.retrieval import Bm25Index, candidates, DEFAULT_K
+from core.songids import SongIdMap
+from core.matcher import PlaylistMatcher
+from core.promptcache import prefix_signature, stable_prefix, usage_cache_hits
+from core.metrics import llm_metrics
+
+METADATA_FIELDS = ["language", "emotion", "genre", "loudness", "review"]
+
+class LLMThrottled(Exception):
+    """LLM 服务端限流 / 过载（429、5xx、超时）；retry_after 为服务端建议的等待秒数"""
+    def __init__(self, reason, retry_after=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.partial = {}  # 批量提取中已拿到的结果
+
+def throttle_error(e):
+    """把 openai 异常归类为 LLMThrottled；其他错误返回 None"""
+    status = getattr(e, "status_code", None)
+    if status == 429 or (isinstance(status, int) and status >= 500):
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        try:
+            retry_after = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+        return LLMThrottled(f"HTTP {status}", retry_after)
+    if "Timeout" in type(e).__name__:
+        return LLMThrottled("timeout")
+    return None
+
+def _record_sync_request(model_name, start, response=None):
+    """元数据提取请求（非流式）计入 llm_metrics 的 "sync"；response 为 None 表示失败"""
+    usage = getattr(response, "usage", None)
+    llm_metrics.record(model_name, "sync", time.perf_counter() - start,
+                       completion_tokens=getattr(usage, "completion_tokens", None),
+                       cached=usage_cache_hits(usage) if usage else None,
+                       error=response is None)
+
+def get_song_info(client, song_info, model_name, fields=None):
+    start = time.perf_counter()
+    response = None
     try:
         response = client.chat.completions.create(
             model=model_name,
             messages=[
-                {"role": "system", "content": "提取歌曲信息JSON: language, emotion, genre, loudness, review"},
+                {"role": "system", "content": f"提取歌曲信息JSON: {', '.join(fields or METADATA_FIELDS)}"},
                 {"role": "user", "content": f"{song_info}"}
             ],
             response_format={'type': 'json_object'},
             stream=False,
             timeout=30.0
         )
+        _record_sync_request(model_name, start, response)
         return response.choices[0].message.content
     except KeyboardInterrupt: raise
     except Exception as e:
+        if response is None:
+            _record_sync_request(model_name, start)
+        throttled = throttle_error(e)
+        if throttled:
+            raise throttled from e
         return None
 
-def sync_metadata(client, targets, metadata, model_name, concurrency=1):
-    if not targets: return metadata
-    log(f"[cyan]🚀 Syncing {len(targets)} new songs using {model_name}... (Ctrl+C to skip)[/]")
-    log(f"[dim]⚙️  Concurrency: {concurrency} worker(s)[/]")
-    pbar = tqdm(targets.items(), unit="song")
-
-    def _process_one(item):
-        name, path = item
-        try:
-            res = requests.get(f"{NCM_BASE_URL}/search?keywords=\"{name}\"&limit=1", timeout=5).json()
-            if res.get('code')!=200 or res['result']['songCount']==0: return None
-            sid = res['result']['songs'][0]['id']
-            l_res = requests.get(f"{NCM_BASE_URL}/lyric", params={"id": sid}, timeout=5).json()
-            raw_lyric = l_res.get('lrc', {}).get('lyric', "暂无歌词")
-
-            info = {"title": name, "lyrics": raw_lyric[:500]}
-            resp = get_song_info(client, info, model_name)
-
-            if resp:
-                meta_dict = json.loads(resp)
-                metadata[name] = meta_dict
-                append_metadata_jsonl(name, meta_dict)
-                return name
-        except KeyboardInterrupt: raise
-        except: pass
-        return None
-
+# 批量提取：按模型上下文长度决定每个请求装多少首歌
+MODEL_CONTEXT_TOKENS = {"deepseek-chat": 64000, "deepseek-reasoner": 64000, "gpt-4o": 128000, "qwen": 32000}
+DEFAULT_CONTEXT_TOKENS = 32000
+MAX_OUTPUT_TOKENS = 8000      # 单次回复上限（多数 API 默认 4k-8k）
+OUTPUT_TOKENS_PER_SONG = 220  # 每首歌的 JSON 结果（含 review）大约占用
+LYRIC_CHARS = 500
+
+def model_context_tokens(model_name):
+    name = (model_name or "").lower()
+    for prefix, tokens in MODEL_CONTEXT_TOKENS.items():
+        if name.startswith(prefix):
+            return tokens
+    return DEFAULT_CONTEXT_TOKENS
+
+def estimate_tokens(text):
+    """粗估 token 数：CJK 约 1 字 1 token，其余约 4 字符 1 token"""
+    cjk = len(re.findall(r'[\u3040-\u30ff\u4e00-\u9fff\uac00-\ud7af]', text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def plan_batch_size(model_name, infos, limit):
+    """
+    从 infos 开头取多少首放进一个请求：不超过 limit，输入占上下文一半以内，
+    输出不超过 MAX_OUTPUT_TOKENS。至少 1。
+    """
+    input_budget = model_context_tokens(model_name) // 2
+    output_cap = max(1, MAX_OUTPUT_TOKENS // OUTPUT_TOKENS_PER_SONG)
+    used, n = 200, 0
+    for info in infos[:min(limit, output_cap)]:
+        cost = estimate_tokens(json.dumps(info, ensure_ascii=False))
+        if n and used + cost > input_budget:
+            break
+        used += cost
+        n += 1
+    return max(1, n)
+
+def get_songs_info_batch(client, song_infos, model_name, fields=None):
+    """
+    一个 JSON-mode 请求提取多首歌：song_infos = {id: info}，
+    fields = {id: [要提取的字段]}（缺省为全部 METADATA_FIELDS），
+    返回 {id: 元数据 dict}（模型漏掉的 id 不在其中），请求失败返回 {}。
+    """
+    fields = {i: list(fields[i] if fields and i in fields else METADATA_FIELDS) for i in song_infos}
+    wanted = [f for f in METADATA_FIELDS if any(f in fs for fs in fields.values())]
+    if all(fs == wanted for fs in fields.values()):
+        rule = f"输出 {{id: {{{', '.join(wanted)}}}}}"
+    else:
+        # 各首要的字段不同（例如部分歌的 genre 已由标签给出）：逐首写进输入
+        song_infos = {i: dict(info, fields=fields[i]) for i, info in song_infos.items()}
+        rule = "输出 {id: {该歌 fields 中列出的字段}}"
+    start = time.perf_counter()
+    response = None
     try:
-        if concurrency <= 1:
-            for name, path in pbar:
-                pbar.set_postfix_str(f"{name[:10]}...")
-                _process_one((name, path))
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {"role": "system", "content": (
+                    f"为每首歌提取歌曲信息JSON: {', '.join(wanted)}。"
+                    f"输入是 {{id: 歌曲}}，{rule}，保留每个 id，不要遗漏。"
+                )},
+                {"role": "user", "content": json.dumps(song_infos, ensure_ascii=False)}
+            ],
+            response_format={'type': 'json_object'},
+            max_tokens=min(MAX_OUTPUT_TOKENS, 200 + OUTPUT_TOKENS_PER_SONG * len(song_infos)),
+            stream=False,
+            timeout=30.0 + 5.0 * len(song_infos)
+        )
+        _record_sync_request(model_name, start, response)
+        data = json.loads(response.choices[0].message.content)
+    except KeyboardInterrupt: raise
+    except Exception as e:
+        if response is None:
+            _record_sync_request(model_name, start)
+        throttled = throttle_error(e)
+        if throttled:
+            raise throttled from e
+        return {}
+    if isinstance(data, dict) and len(data) == 1 and isinstance(next(iter(data.values())), (dict, list)) \
+            and next(iter(data)) not in song_infos:
+        data = next(iter(data.values()))  # {"songs": ...} 之类的外层包装
+    if isinstance(data, list):
+        data = {str(item.get("id")): item for item in data if isinstance(item, dict)}
+    if not isinstance(data, dict):
+        return {}
+    return {str(k): v for k, v in data.items() if str(k) in song_infos and isinstance(v, dict)}
+
+def search_song_id(name, tags=None):
+    """NCM 搜索：有 title + artist 标签时先按它们搜，再按文件名；找不到返回 None（结果会被缓存）"""
+    tags = tags or {}
+    keywords = [name]
+    if tags.get("title") and tags.get("artist"):
+        keywords.insert(0, f"{tags['title']} {tags['artist']}")
+    return ncm.resolve(name, [f'"{keyword}"' for keyword in keywords])
+
+def fetch_lyric(sid, name=None):
+    """完整歌词；给出 name 时顺便写入 LYRICS_DIR，供 lyrics 命令和 tools/lyrics_sync.py 复用"""
+    lyric = ncm.fetch_lyric(sid)
+    if lyric and name:
+        ncm.save_lyric(name, lyric)
+    return lyric or "暂无歌词"
+
+def song_info(name, lyric, tags=None):
+    """发给 LLM 的单曲信息 + 标签已知、无需 LLM 提取的字段"""
+    from core.tags import reliable_genre
+    tags = tags or {}
+    info = {"title": tags.get("title", name), "lyrics": lyric[:LYRIC_CHARS]}
+    if tags.get("artist"):
+        info["artist"] = tags["artist"]
+    known = {}
+    genre = reliable_genre(tags)
+    if genre:
+        known["genre"] = genre
+    return info, known
+
+def extract_metadata(client, name, model_name, lyric, tags=None):
+    """LLM 提取；可靠的 genre 标签直接采用、不再让 LLM 猜。失败返回 None"""
+    info, known = song_info(name, lyric, tags)
+    fields = [f for f in METADATA_FIELDS if f not in known]
+
+    resp = get_song_info(client, info, model_name, fields)
+    if not resp:
+        return None
+    meta = json.loads(resp)
+    meta.update(known)
+    return meta
+
+def extract_metadata_batch(client, jobs, model_name):
+    """
+    jobs = [(name, lyric, tags), ...] → {name: meta}。一个请求处理全部；
+    模型漏掉或格式不对的歌逐首用 extract_metadata 重试，仍失败的不在结果中。
+    限流时抛 LLMThrottled，已拿到的结果在其 partial 中。
+    """
+    if len(jobs) == 1:
+        name, lyric, tags = jobs[0]
+        meta = extract_metadata(client, name, model_name, lyric, tags)
+        return {name: meta} if meta else {}
+
+    infos, knowns, fields = {}, {}, {}
+    for i, (name, lyric, tags) in enumerate(jobs, 1):
+        infos[str(i)], knowns[str(i)] = song_info(name, lyric, tags)
+        fields[str(i)] = [f for f in METADATA_FIELDS if f not in knowns[str(i)]]
+    batch = get_songs_info_batch(client, infos, model_name, fields)
+
+    results = {}
+    for i, (name, lyric, tags) in enumerate(jobs, 1):
+        meta = batch.get(str(i))
+        if meta:
+            meta.pop("id", None)
+            meta.update(knowns[str(i)])
         else:
-            items = list(targets.items())
-            with ThreadPoolExecutor(max_workers=concurrency) as executor:
-                futures = {executor.submit(_process_one, item): item for item in items}
-                completed = 0
-                for future in futures:
-                    try:
-                        future.result()
-                        completed += 1
-                        pbar.update(1)
-                        name = futures[future][0]
-                        pbar.set_postfix_str(f"{name[:10]}...")
-                    except KeyboardInterrupt: raise
-                    except: pass
-    except KeyboardInterrupt:
-        log("\n[yellow]⚠️ Sync skipped.[/]")
-
-    return metadata
+            try:
+                meta = extract_metadata(client, name, model_name, lyric, tags)
+            except KeyboardInterrupt: raise
+            except LLMThrottled as e:
+                e.partial = results
+                raise
+            except Exception:
+                meta = None
+        if meta:
+            results[name] = meta
+    return results
+
+def fetch_song_metadata(client, name, model_name, path=None, tags=None):
+    """
+    NCM 搜索 → 歌词 → LLM 提取，返回元数据 dict；任何一步失败返回 None。
+    tags（core.tags.read_tags 的结果）可用时：有内嵌歌词则不再搜索 NCM；
+    LYRICS_DIR 里已有歌词时同样跳过搜索。
+    批量同步走 core.metasync 的分阶段流水线，这里是单曲串行版本（watcher 用）。
+    """
+    from core.tags import embedded_lyrics
+    tags = tags or {}
+    try:
+        lyric = embedded_lyrics(path) if path and tags.get("has_lyrics") else None
+        if lyric is None:
+            lyric = ncm.cached_lyric(name)
+        if lyric is None:
+            sid = search_song_id(name, tags)
+            if sid is None: return None
+            lyric = fetch_lyric(sid, name)
+        return extract_metadata(client, name, model_name, lyric, tags)
+    except KeyboardInterrupt: raise
+    except: pass
+    return None
+
+def sync_metadata(client, targets, metadata, model_name, concurrency=1, tags=None, batch_size=1,
+                  ledger=None, session=None):
+    """
+    targets: {name: path}；tags: 可选 {name: 内嵌标签}。
+    concurrency 为 LLM 阶段的起始并发数，batch_size > 1 时每个 LLM 请求最多装这么多首歌。
+    ledger: 可选 core.failures.FailureLedger，记录失败曲目供下次跳过。
+    session: metadata 属于运行中的 DJSession 时传入，写入时持有其 lock。
+    """
+    from core.metasync import run_pipeline
+    return run_pipeline(client, targets, metadata, model_name, llm_concurrency=concurrency,
+                        tags=tags, batch_size=batch_size, ledger=ledger, session=session)
+
+_THINK_BLOCK = re.compile(r'<think>.*?</think>', flags=re.DOTALL)
+
+
+class PlaylistStream:
+    """
+    边接收流式回复边解析歌单：在（<think> 之外的）SEPARATOR 之后，每收到一整行
+    就匹配一次，新匹配到的歌立即以 {"name", "path"} 交给 on_track。
+    流结束后 next_step 仍会完整解析一遍，返回值以那次为准；这里只负责“提前开播”。
+    """
+
+    def __init__(self, session, on_track):
+        self.session = session
+        self.on_track = on_track
+        self.text = ""
+        self.payload_at = None  # SEPARATOR 之后第一个字符在 self.text 中的位置
+        self.consumed = 0       # payload 中已处理到的位置
+        self.emitted = set()
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self.payload_at is None:
+            if SEPARATOR not in self.text:
+                return
+            visible = _THINK_BLOCK.sub('', self.text)
+            if '<think>' in visible or SEPARATOR not in visible:
+                return  # 分隔符出现在推理内容里，或推理尚未结束
+            self.payload_at = self._first_visible_separator() + len(SEPARATOR)
+        payload = self.text[self.payload_at:]
+        end = payload.rfind('\n')
+        if end < self.consumed:
+            return
+        self._emit(payload[self.consumed:end].split('\n'))
+        self.consumed = end + 1
+
+    def _first_visible_separator(self):
+        """第一个不在 <think> 块内的 SEPARATOR（与 parse_raw_playlist 取的是同一个）"""
+        at = self.text.find(SEPARATOR)
+        while at != -1:
+            head = self.text[:at]
+            if head.count('<think>') == head.count('</think>'):
+                return at
+            at = self.text.find(SEPARATOR, at + 1)
+        return at
+
+    def finish(self):
+        """流结束：处理最后一行（没有换行结尾）"""
+        if self.payload_at is not None:
+            self._emit(self.text[self.payload_at + self.consumed:].split('\n'))
+            self.consumed = len(self.text) - self.payload_at
+
+    def _emit(self, lines):
+        lines = [l.strip() for l in lines if l.strip()]
+        if not lines:
+            return
+        for name in self.session._match_lines(lines):
+            if name in self.emitted:
+                continue
+            path = self.session.music_paths.get(name)
+            if path is None:
+                continue
+            self.emitted.add(name)
+            try:
+                self.on_track({"name": name, "path": path})
+            except Exception as e:
+                log(f"[red]⚠️ on_track callback failed: {e}[/]")
+
 
 class DJSession:
     def __init__(self, client, metadata, music_paths, config , wait_inject_prepare , wait_inject_main , wait_inject_after):
@@ -89,44 +345,158 @@ class DJSession:
         self.wait_injects = [wait_inject_prepare,wait_inject_main,wait_inject_after]
         self.prompt_tokens = 0
         self.completion_tokens = 0
+        # provider 端 prompt cache：cached_tokens / cache_prompt_tokens 即命中率
+        # （只统计 usage 中带缓存字段的请求）
+        self.cached_tokens = 0
+        self.cache_prompt_tokens = 0
+        self.durations = {}  # {name: seconds}，来自 core.tags（曲库索引）
+        # 后台线程（watcher / sync）会改写 metadata 与 music_paths
+        self.lock = threading.Lock()
+        self.pending_additions = []
+        # library_mode 在每段对话的首轮确定："full" 首轮注入完整曲库，"retrieval" 每轮只发 top-K 候选
+        self.library_mode = "full"
+        self.retrieval = None       # Bm25Index，首次检索时建立，之后增量更新
+        self.last_request = None
+        # song_ids 同样在首轮确定：曲库行带 "#ID"，AI 只回 ID
+        self.id_protocol = False
+        self.song_ids = None        # SongIdMap，首次使用时载入
+        # 曲库键集合变化时 +1（新增经 announce_additions，watcher 删除歌曲时在 lock 内自增）
+        self.library_version = 0
+        self._matcher_cache = None  # (曲库指纹, PlaylistMatcher)
+
+    def announce_additions(self, names):
+        """记录会话中途新增的歌曲，下一轮请求时告知 AI（首轮会直接注入完整曲库）"""
+        with self.lock:
+            self.library_version += 1
+            for name in names:
+                if name not in self.pending_additions:
+                    self.pending_additions.append(name)
+
+    def _valid_keys(self):
+        with self.lock:
+            return set(self.metadata.keys()) & set(self.music_paths.keys())
 
     def refresh(self, clear_history=False):
         self.played_songs.clear()
         if clear_history:
             self.chat_history = []
             self.turn_count = 0
+            self.last_request = None
             log("[yellow]🧹 Cleared History[/]")
         else:
             log("[yellow]🧹 Cleared Played Songs[/]")
 
-    def _format_library(self):
+    def _song_ids(self):
+        if self.song_ids is None:
+            self.song_ids = SongIdMap.load()
+        return self.song_ids
+
+    def _label(self, name):
+        """发给 AI 的歌曲标识：ID 协议下为 "#ID | name"，否则就是 name"""
+        return f"#{self._song_ids().id_for(name)} | {name}" if self.id_protocol else name
+
+    def _format_entry(self, name, injects):
+        info = self.metadata.get(name)
+        if not isinstance(info, dict):
+            return f"- {self._label(name)}"
+        parts = [self._label(name)]
+        for field in ("genre", "emotion", "language", "loudness", "review"):
+            if not injects.get(field):
+                continue
+            if field in TAG_FIELDS:
+                # 预计算的规范化标签：比 LLM 原始值更短、更一致
+                tags = [t for t in song_tags(info, field) if t not in ("Unknown", "Other")]
+                if tags:
+                    parts.append(", ".join(tags))
+            elif info.get(field):
+                val = info[field]
+                if isinstance(val, list):
+                    val = ", ".join(str(v) for v in val)
+                parts.append(str(val))
+        return " | ".join(parts)
+
+    def _render_entries(self, names):
+        """{name: 曲库中的一行}"""
         injects = self.config['preferences'].get('library_injects', {})
-        lines = []
-        available = set(self.metadata.keys()) & set(self.music_paths.keys())
-        for name in sorted(available):
-            info = self.metadata.get(name)
-            if not isinstance(info, dict):
-                lines.append(f"- {name}")
+        entries = {name: self._format_entry(name, injects) for name in names}
+        if self.id_protocol:
+            self._song_ids().save()  # 新分配的 ID 立即落盘，保证跨会话稳定
+        return entries
+
+    def _format_entries(self, names):
+        entries = self._render_entries(names)
+        return "\n".join(entries[name] for name in names)
+
+    def _retrieve(self, user_request):
+        """retrieval 模式：当前请求（+ 上一轮请求，便于“再来点类似的”）的 BM25 top-K 候选"""
+        if self.retrieval is None:
+            self.retrieval = Bm25Index()
+        available = self._valid_keys()
+        with self.lock:
+            self.retrieval.sync(available, self.metadata)
+        k = self.config['preferences'].get('retrieval_k', DEFAULT_K)
+        query = user_request if not self.last_request else f"{user_request} {self.last_request}"
+        names, hits = candidates(self.retrieval, query, k, exclude=self.played_songs)
+        if self.config['preferences']['verbose']:
+            log(f"[dim]🔎 Retrieval: {hits} matched, {len(names)}/{len(available)} songs sent.[/]")
+        return names
+
+    def _matcher(self):
+        """当前曲库的 PlaylistMatcher；曲库变化（版本号 / 对象 / 数量）后才重建"""
+        with self.lock:
+            key = (self.library_version, id(self.metadata), id(self.music_paths),
+                   len(self.metadata), len(self.music_paths))
+        if self._matcher_cache is None or self._matcher_cache[0] != key:
+            self._matcher_cache = (key, PlaylistMatcher(self._valid_keys()))
+        return self._matcher_cache[1]
+
+    def _match_lines(self, lines, source="AI", verbose=False):
+        """payload 行 → 曲库歌名（按行序，可能重复；匹配不上的行被丢弃）"""
+        matcher = self._matcher()
+        use_ids = self.id_protocol and source == "AI"
+
+        # 先按行定位：ID 行直接确定，其余行收集起来一次性交给 matcher
+        slots = []      # 每行一个：歌名 或 待匹配的 clean 文本下标
+        queries = []
+        for line in lines:
+            if use_ids:
+                # ID 协议：精确查表，O(1)；不是已知 ID 的行再走文本匹配
+                name = self._song_ids().lookup(line)
+                if name is not None:
+                    if name in matcher.exact:
+                        slots.append(name)
+                    elif verbose:
+                        log(f"[dim]❌ ID no longer in library: {line}[/]")
+                    continue
+            if line.startswith("#"): continue
+            clean = line.replace('"', '').replace("'", "").strip()
+            if len(clean) < 2: continue
+            slots.append(len(queries))
+            queries.append(line if line in matcher.exact else clean)
+
+        names = []
+        matches = matcher.match(queries)
+        for slot in slots:
+            if isinstance(slot, str):
+                names.append(slot)
                 continue
-            parts = [name]
-            for field in ("genre", "emotion", "language", "loudness", "review"):
-                if injects.get(field) and info.get(field):
-                    val = info[field]
-                    if isinstance(val, list):
-                        val = ", ".join(str(v) for v in val)
-                    parts.append(str(val))
-            lines.append(" | ".join(parts))
-        return "\n".join(lines)
+            clean = queries[slot]
+            match, how = matches[slot]
+            if match:
+                if verbose and how != "exact": log(f"[dim]🔍 Match ({how}): {clean} -> [green]{match}[/][/]")
+                names.append(match)
+            elif verbose:
+                log(f"[dim]❌ Ignored line: {clean}[/]")
+        return names
 
     def parse_raw_playlist(self, raw_text, source="AI"):
-        playlist_names = []
         intro_text = ""
         is_verbose = self.config['preferences']['verbose']
 
         if SEPARATOR in raw_text:
-            parts = raw_text.split(SEPARATOR)
-            intro_text = parts[0].strip()
-            raw_list_block = parts[1]
+            # 只按第一个分隔符切分，与 PlaylistStream 一致
+            intro_text, raw_list_block = raw_text.split(SEPARATOR, 1)
+            intro_text = intro_text.strip()
             if is_verbose: log(f"[dim]✅ Separator found. Parsing list...[/]")
         else:
             if is_verbose and source == "AI":
@@ -135,38 +505,24 @@ class DJSession:
             raw_list_block = ""
 
         lines = [l.strip() for l in raw_list_block.split('\n') if l.strip()]
-        valid_keys = list(set(self.metadata.keys()) & set(self.music_paths.keys()))
-
-        for line in lines:
-            if line.startswith("#"): continue
-            clean = line.replace('"', '').replace("'", "").strip()
-            if len(clean) < 2: continue
-
-            match = None
-            result = process.extractOne(
-                clean, valid_keys, scorer=fuzz.token_sort_ratio, score_cutoff=80
-            )
-
-            if result:
-                match_name = result[0]
-                if is_verbose: log(f"[dim]🔍 Match: {clean} -> [green]{match_name}[/][/]")
-                match = match_name
-
-            if match:
-                playlist_names.append(match)
-            else:
-                if is_verbose and SEPARATOR in raw_text:
-                     log(f"[dim]❌ Ignored line: {clean}[/]")
+        playlist_names = self._match_lines(lines, source, verbose=is_verbose)
 
         playlist_names = list(dict.fromkeys(playlist_names))
         playlist = []
         for name in playlist_names:
+            path = self.music_paths.get(name)
+            if path is None: continue  # 已被 watcher 移除
             if source == "AI": self.played_songs.add(name)
-            playlist.append({"name": name, "path": self.music_paths[name]})
+            playlist.append({"name": name, "path": path})
 
         return playlist, intro_text
 
-    def next_step(self, user_request,external_status = None):
+    def next_step(self, user_request,external_status = None, on_track=None, command="p"):
+        """
+        一轮对话：返回 (playlist, intro)。command 为发起的命令（p / pr / pc），用于 llm_metrics 分组。
+        on_track：可选回调，流式回复中每解析出一首歌就调用一次（在请求线程中），
+        用于在回复结束前开始播放；返回的 playlist 仍是完整解析结果。
+        """
         # --- 1. 配置与状态更新 ---
         self.turn_count += 1
         model = self.config['preferences']['model']
@@ -213,26 +569,75 @@ Imagine
 
         # --- 3. 注入上下文 (Context Injection) ---
         # 只在首轮注入一次 Library，之后 AI 可通过 attention 持续引用
+        # retrieval 模式则不固定曲库，每轮把检索出的候选歌随用户消息发送
         if self.turn_count == 1:
-            library_str = self._format_library()
-            system_content = f"{base_prompt}\n\n### CURRENT MUSIC LIBRARY (Exact Keys Only):\n{library_str}"
+            with self.lock:
+                self.pending_additions = []
+            self.library_mode = self.config['preferences'].get('library_mode', 'full')
+            self.id_protocol = bool(self.config['preferences'].get('song_ids', False))
+            if self.id_protocol:
+                base_prompt += f"""
+### SONG ID PROTOCOL (overrides the Part 2 format above)
+Every library entry starts with a numeric ID, e.g. `#12 | Imagine | Pop`.
+In [Part 2] output ONLY the ID number of each song, one per line (e.g. `12`). Do NOT write titles there.
+"""
+            if self.library_mode == "retrieval":
+                system_content = (f"{base_prompt}\n\n### MUSIC LIBRARY\n"
+                                  f"Each user message carries its own 'Candidate Songs' list. "
+                                  f"Only keys from the latest list are valid.")
+                if is_verbose: log("[dim]🔎 Retrieval mode: candidates sent per request.[/]")
+            else:
+                # 复用上次持久化的前缀（逐字节相同 → provider 缓存命中），之后新增的歌走 additions
+                signature = prefix_signature(base_prompt, self.config['preferences'].get('library_injects', {}),
+                                             self.id_protocol, NORMALISER_VERSION)
+                system_content, missing, reused = stable_prefix(
+                    signature, self._render_entries(self._valid_keys()),
+                    lambda lines: f"{base_prompt}\n\n### CURRENT MUSIC LIBRARY (Exact Keys Only):\n{lines}")
+                with self.lock:
+                    self.pending_additions = missing
+                if is_verbose:
+                    state = f"reused, +{len(missing)} announced" if reused else "rebuilt"
+                    log(f"[dim]🔖 Library injected once (pinned in context, prefix {state}).[/]")
 
             self.chat_history.append({"role": "system", "content": system_content})
-            if is_verbose: log("[dim]🔖 Library injected once (pinned in context).[/]")
 
         # --- 4. 构建用户请求 (User Message) ---
         # 在这里再次强调“封闭集合”概念
-        forbidden_list = ', '.join(list(self.played_songs)) if self.played_songs else "None"
+        if not self.played_songs:
+            forbidden_list = "None"
+        elif self.id_protocol:
+            forbidden_list = ', '.join(str(self._song_ids().id_for(n)) for n in self.played_songs)
+        else:
+            forbidden_list = ', '.join(list(self.played_songs))
+
+        with self.lock:
+            additions, self.pending_additions = self.pending_additions, []
+        additions_note = ""
+        if self.library_mode == "retrieval":
+            # 新歌已进入检索索引，无需单独告知
+            library_note = f"Candidate Songs (Exact Keys Only):\n{self._format_entries(self._retrieve(user_request))}\n"
+            source_hint = "Pick from the Candidate Songs above. "
+        else:
+            library_note = ""
+            source_hint = "Check the Library in the first System message. "
+            if additions:
+                additions_note = f"Library Update: these songs were just added and are valid keys: [{', '.join(map(self._label, additions))}]\n"
+                if self.id_protocol:
+                    self._song_ids().save()
+        self.last_request = user_request
 
         full_req = (
             f"User Request: \"{user_request}\"\n"
+            f"{library_note}"
+            f"{additions_note}"
             f"Constraint: Don't repeat these songs: [{forbidden_list}]\n"
             f"Language Rule: Detect the language used in the 'User Request'. The [Intro] section MUST be written in that EXACT SAME language. (e.g. If user asks in Chinese, reply in Chinese).\n"
-            f"Instruction: Check the Library in the first System message. "
-            f"If matches found, output Intro + {SEPARATOR} + SongKeys. "
+            f"Instruction: {source_hint}"
+            f"If matches found, output Intro + {SEPARATOR} + {'SongIDs' if self.id_protocol else 'SongKeys'}. "
             f"If no matches, just Intro."
         )
-        self.chat_history.append({"role": "user", "content": full_req})
+        user_msg = {"role": "user", "content": full_req}
+        self.chat_history.append(user_msg)
 
         # --- 5. 🎮 交互式等待模式 (Streaming + Game) ---
 
@@ -241,6 +646,10 @@ Imagine
 
         def ask_ai_streaming():
             full_content = ""
+            parser = PlaylistStream(self, on_track) if on_track is not None else None
+            start = time.perf_counter()
+            ttft = None
+            usage = None
             try:
                 # 开启流式 stream=True
                 stream = self.client.chat.completions.create(
@@ -254,9 +663,15 @@ Imagine
                 for chunk in stream:
                     # 捕获 usage（某些厂商放在空 chunk，某些放在最后有内容的 chunk）
                     if hasattr(chunk, 'usage') and chunk.usage:
-                        u = chunk.usage
+                        u = usage = chunk.usage
                         self.prompt_tokens += (u.prompt_tokens or 0)
                         self.completion_tokens += (u.completion_tokens or 0)
+                        hits = usage_cache_hits(u)
+                        if hits is not None:
+                            self.cached_tokens += hits
+                            self.cache_prompt_tokens += (u.prompt_tokens or 0)
+                            if is_verbose:
+                                log(f"[dim]💾 Prompt cache: {hits}/{u.prompt_tokens or 0} tokens hit.[/]")
 
                     # [修复点 1] 必须先检查 choices 列表是否非空
                     if not chunk.choices:
@@ -264,6 +679,8 @@ Imagine
 
                     # [修复点 2] 获取 delta
                     delta = chunk.choices[0].delta
+                    if ttft is None and (getattr(delta, 'content', None) or getattr(delta, 'reasoning_content', None)):
+                        ttft = time.perf_counter() - start  # 推理模型的首个 reasoning token 也算
 
                     # [修复点 3] 确保 content 存在且不为 None
                     if getattr(delta, 'content', None):
@@ -272,10 +689,18 @@ Imagine
 
                         # 更新共享计数器，游戏线程会读取这个值
                         ai_status['count'] = len(full_content)
-
+                        if parser is not None:
+                            parser.feed(content)
+
+                if parser is not None:
+                    parser.finish()
+                llm_metrics.record(model, command, time.perf_counter() - start, ttft=ttft,
+                                   completion_tokens=getattr(usage, 'completion_tokens', None),
+                                   cached=usage_cache_hits(usage) if usage else None)
                 return full_content
 
             except Exception as e:
+                llm_metrics.record(model, command, time.perf_counter() - start, ttft=ttft, error=True)
                 return e
             finally:
                 # 无论成功失败，通知游戏停止
@@ -303,6 +728,10 @@ Imagine
 
             result = future.result()
 
+        if library_note:
+            # 候选列表只对本轮有效，请求发出后从历史中去掉，避免 prompt 随轮数线性增长
+            user_msg["content"] = full_req.replace(library_note, "", 1)
+
         # --- 6. 结果处理 ---
         if isinstance(result, Exception):
             err_msg = str(result)
@@ -0,0 +1,115 @@
+"""Sync failure ledger — songs that failed metadata sync and when to retry them.
+
+Every song the sync pipeline drops is recorded with the stage it failed in,
+a reason and an expiry time.  Until it expires the song is left out of the
+startup / ``sync run`` target list, so a track NCM does not know (or whose
+LLM reply never parses) no longer costs two NCM timeouts and an LLM call on
+every launch.  Repeated failures back off exponentially; a later success
+removes the entry.  ``failed`` lists the ledger, ``failed retry`` clears it.
+"""
+import os
+import json
+import time
+import threading
+from core.log import log
+from core.config import FAILURE_LEDGER_PATH
+
+LEDGER_VERSION = 1
+
+# 首次失败后多久再试（秒），之后每次失败翻倍，最多 MAX_TTL
+STAGE_TTL = {
+    "resolve": 7 * 86400,   # NCM 搜不到：短期内基本不会变
+    "lyric": 86400,
+    "llm": 86400,           # JSON 解析失败 / 模型漏掉
+}
+TRANSIENT_TTL = 3600        # 网络错误 / 限流：很快就值得再试
+DEFAULT_TTL = 86400
+MAX_TTL = 30 * 86400
+
+STAGE_LABELS = {"resolve": "not found on NCM", "lyric": "lyric fetch failed", "llm": "LLM extraction failed"}
+
+
+class FailureLedger:
+    """{name: {"stage", "reason", "count", "last", "expires"}}，原子写入 JSON"""
+
+    def __init__(self, path=FAILURE_LEDGER_PATH):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path=FAILURE_LEDGER_PATH):
+        ledger = cls(path)
+        if not os.path.exists(path):
+            return ledger
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == LEDGER_VERSION:
+                ledger.entries = data.get("entries", {})
+        except (OSError, json.JSONDecodeError, ValueError) as e:
+            log(f"[yellow]⚠️ Failed to read {path}: {e}[/]")
+        return ledger
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {"version": LEDGER_VERSION, "entries": dict(self.entries)}
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as e:
+            log(f"[red]❌ Failed to save sync failure ledger: {e}[/]")
+
+    # --- 记录 ---
+
+    def record(self, name, stage, reason=None, transient=False, now=None):
+        now = now or time.time()
+        with self.lock:
+            prev = self.entries.get(name)
+            count = prev["count"] + 1 if prev else 1
+            base = TRANSIENT_TTL if transient else STAGE_TTL.get(stage, DEFAULT_TTL)
+            ttl = min(MAX_TTL, base * 2 ** (count - 1))
+            self.entries[name] = {
+                "stage": stage,
+                "reason": reason or STAGE_LABELS.get(stage, stage),
+                "count": count,
+                "last": now,
+                "expires": now + ttl,
+            }
+            self.dirty = True
+
+    def clear(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.dirty = True
+
+    # --- 查询 ---
+
+    def blocked(self, name, now=None):
+        entry = self.entries.get(name)
+        return entry is not None and entry["expires"] > (now or time.time())
+
+    def split(self, targets, now=None):
+        """targets {name: path} → (需要同步的, 仍在冷却期被跳过的)"""
+        now = now or time.time()
+        todo, skipped = {}, {}
+        with self.lock:
+            for name, path in targets.items():
+                (skipped if self.blocked(name, now) else todo)[name] = path
+        return todo, skipped
+
+    def prune(self, names):
+        """删掉已不在曲库中的条目"""
+        with self.lock:
+            stale = [n for n in self.entries if n not in names]
+            for n in stale:
+                del self.entries[n]
+            if stale:
+                self.dirty = True
+        return len(stale)
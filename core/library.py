@@ -0,0 +1,454 @@
+"""Persistent library index — incremental rescans driven by directory mtimes.
+
+The index remembers, for every directory under ``music_folders``, its mtime
+plus the names of its audio files and sub-directories.  A rescan only lists
+directories whose mtime changed (a file was added / removed / renamed in it);
+everything else is taken straight from the index.
+"""
+import os
+import json
+import time
+import queue
+import threading
+from core.log import log
+from core.config import LIBRARY_INDEX_PATH, MUSIC_EXTS
+
+INDEX_VERSION = 1
+
+# 由文件内容派生、文件未变时可沿用的字段（core.catalog 的 hash、core.tags 的标签）
+DERIVED_KEYS = ("hash", "tags")
+
+# 目录 mtime 与扫描时刻过近时不信任缓存（同一时间粒度内的后续修改会被漏掉）
+RACY_WINDOW_NS = 2_000_000_000
+
+# 扫描线程数（I/O 密集，远大于 CPU 核数也无妨）与单个 root 无进展的容忍时长
+SCAN_WORKERS = min(32, (os.cpu_count() or 4) * 4)
+ROOT_STALL_TIMEOUT = 10.0
+
+
+def _ext_set(exts):
+    return {e.lower().lstrip(".") for e in exts}
+
+
+def _list_dir(d, exts, with_stat=False):
+    """
+    os.scandir 读取目录：返回 (subdirs, files, stats)。
+    is_dir() 使用 d_type 缓存（不跟随符号链接），只有音频文件在 with_stat 时才会额外 stat。
+    """
+    subdirs, files, stats = [], [], {}
+    with os.scandir(d) as it:
+        for entry in it:
+            try:
+                # 与 os.walk 一致：不跟随目录符号链接，避免 a/loop -> .. 之类的环
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                if not ext or ext[1:] not in exts:
+                    continue
+                files.append(entry.name)
+                if with_stat:
+                    st = entry.stat()
+                    stats[entry.path] = {"size": st.st_size, "mtime": st.st_mtime_ns}
+            except OSError:
+                continue
+    subdirs.sort()
+    files.sort()
+    return subdirs, files, stats
+
+
+def parallel_walk(roots, visit, workers=None, stall_timeout=ROOT_STALL_TIMEOUT):
+    """
+    在守护线程池中并行遍历多个根目录。
+
+    visit(d) -> (payload, child_dirs)，运行在工作线程上。
+    返回 ({root: {dir: payload}}, {被跳过的 root})。
+    某个 root 连续 stall_timeout 秒没有任何目录完成时放弃它并给出警告；
+    卡在 NFS 上的线程是 daemon，不会阻止进程退出。
+    """
+    tasks, results = queue.Queue(), queue.Queue()
+    abandoned = set()
+
+    def worker():
+        while True:
+            item = tasks.get()
+            if item is None:
+                return
+            root, d = item
+            if root in abandoned:
+                continue
+            try:
+                payload, children = visit(d)
+            except OSError as e:
+                payload, children = e, []
+            results.put((root, d, payload, children))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers or SCAN_WORKERS)]
+    for t in threads:
+        t.start()
+
+    out = {r: {} for r in roots}
+    pending, last_progress = {}, {}
+    now = time.monotonic()
+    for r in roots:
+        tasks.put((r, r))
+        pending[r] = 1
+        last_progress[r] = now
+
+    while any(pending[r] > 0 for r in roots if r not in abandoned):
+        try:
+            root, d, payload, children = results.get(timeout=0.2)
+        except queue.Empty:
+            root = None
+        now = time.monotonic()
+
+        if root is not None and root not in abandoned:
+            pending[root] -= 1
+            last_progress[root] = now
+            if isinstance(payload, OSError):
+                # 不存在的 root 与旧行为一致：静默跳过
+                if not (d == root and isinstance(payload, FileNotFoundError)):
+                    log(f"[yellow]⚠️ Cannot list {d}: {payload}[/]")
+            else:
+                out[root][d] = payload
+                for c in children:
+                    tasks.put((root, c))
+                    pending[root] += 1
+
+        for r in roots:
+            if r not in abandoned and pending[r] > 0 and now - last_progress[r] > stall_timeout:
+                abandoned.add(r)
+                log(f"[yellow]⚠️ {r} is not responding (>{stall_timeout:.0f}s) — skipped this scan.[/]")
+
+    for _ in threads:
+        tasks.put(None)
+    return out, abandoned
+
+
+def scan_audio_files(roots, exts=MUSIC_EXTS, workers=None, stall_timeout=ROOT_STALL_TIMEOUT):
+    """并行扫描 roots 下所有音频文件，返回路径列表（按目录 DFS 顺序）"""
+    ext_set = _ext_set(exts)
+
+    def visit(d):
+        subdirs, files, _ = _list_dir(d, ext_set)
+        return (files, subdirs), [os.path.join(d, s) for s in subdirs]
+
+    roots = list(dict.fromkeys(roots))
+    results, _ = parallel_walk(roots, visit, workers, stall_timeout)
+
+    paths, seen = [], set()
+    for root in roots:
+        visited = results[root]
+        stack = [root]
+        while stack:
+            d = stack.pop()
+            if d in seen or d not in visited:
+                continue
+            seen.add(d)
+            files, subdirs = visited[d]
+            paths.extend(os.path.join(d, f) for f in files)
+            stack.extend(os.path.join(d, s) for s in reversed(subdirs))
+    return paths
+
+
+class LibraryIndex:
+    """path / size / mtime of every track + per-directory listing cache."""
+
+    def __init__(self, path=LIBRARY_INDEX_PATH):
+        self.path = path
+        self.roots = []
+        self.dirs = {}    # dir -> {"mtime": int|None, "subdirs": [...], "files": [...]}
+        self.files = {}   # path -> {"size": int, "mtime": int, "hash": str (core.catalog)}
+        self.catalog = {} # content hash -> song key 上次使用的名字（改名/移动后据此迁移数据）
+        self.keys = {}    # path -> 已分配的 song key（持久化，新同名文件不会抢走旧文件的 key）
+        self.dirty = False
+        self.lock = threading.Lock()  # rescan (main thread) vs. watcher updates
+
+    @classmethod
+    def load(cls, path=LIBRARY_INDEX_PATH):
+        index = cls(path)
+        if not os.path.exists(path):
+            return index
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION:
+                log("[yellow]⚠️ Library index format changed, rebuilding.[/]")
+                return index
+            index.roots = data.get("roots", [])
+            index.dirs = data.get("dirs", {})
+            index.files = data.get("files", {})
+            index.catalog = data.get("catalog", {})
+            index.keys = data.get("keys", {})
+        except (OSError, json.JSONDecodeError, ValueError) as e:
+            log(f"[yellow]⚠️ Failed to read {path}: {e}, rebuilding.[/]")
+        return index
+
+    def save(self):
+        """原子写入（tmp + rename），无变更时不落盘"""
+        with self.lock:
+            if not self.dirty:
+                return
+            # 锁内序列化：ingest 线程会改 files[path] 里的 tags / hash；
+            # 之后到来的修改会重新置 dirty，不会被这次写入"吞掉"
+            text = json.dumps({
+                "version": INDEX_VERSION,
+                "roots": self.roots,
+                "dirs": self.dirs,
+                "files": self.files,
+                "catalog": self.catalog,
+                "keys": self.keys,
+            }, ensure_ascii=False)
+            self.dirty = False
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            with self.lock:
+                self.dirty = True
+            log(f"[red]❌ Failed to save library index: {e}[/]")
+
+    def rescan(self, folders, workers=None, stall_timeout=ROOT_STALL_TIMEOUT):
+        """
+        增量扫描，返回 diff:
+        {"added": [path], "removed": [path], "moved": [(old, new)],
+         "listed": n_dirs_listed, "skipped": [slow roots]}
+
+        各 root 及其子目录在线程池中并行处理；某个 root 卡住超过
+        stall_timeout 秒会被跳过，并沿用索引里它上一次的内容。
+        """
+        now_ns = time.time_ns()
+        exts = _ext_set(MUSIC_EXTS)
+        with self.lock:
+            old_dirs, old_files = self.dirs, self.files
+
+        def visit(d):
+            mtime = os.stat(d).st_mtime_ns
+            cached = old_dirs.get(d)
+            if cached and cached["mtime"] is not None and cached["mtime"] == mtime:
+                subdirs, files = list(cached["subdirs"]), list(cached["files"])
+                stats = {}
+                for name in files:
+                    p = os.path.join(d, name)
+                    if p in old_files:
+                        stats[p] = old_files[p]
+                was_listed = False
+            else:
+                subdirs, files, stats = _list_dir(d, exts, with_stat=True)
+                was_listed = True
+                # 目录被重新列出，但未变化的文件沿用已算好的 hash / 标签
+                for p, st in stats.items():
+                    prev = old_files.get(p)
+                    if prev and prev["size"] == st["size"] and prev["mtime"] == st["mtime"]:
+                        for key in DERIVED_KEYS:
+                            if key in prev:
+                                st[key] = prev[key]
+            trusted = mtime if now_ns - mtime > RACY_WINDOW_NS else None
+            entry = {"mtime": trusted, "subdirs": subdirs, "files": files}
+            return (entry, stats, was_listed), [os.path.join(d, s) for s in subdirs]
+
+        roots = list(dict.fromkeys(folders))
+        results, skipped = parallel_walk(roots, visit, workers, stall_timeout)
+
+        new_dirs, new_files = {}, {}
+        listed = 0
+        for root in roots:
+            if root in skipped:
+                # 慢速挂载点：保留上一次的索引内容，避免曲目凭空"消失"
+                prefix = root.rstrip(os.sep) + os.sep
+                for d, entry in old_dirs.items():
+                    if d == root or d.startswith(prefix):
+                        new_dirs.setdefault(d, entry)
+                for p, st in old_files.items():
+                    if p.startswith(prefix):
+                        new_files.setdefault(p, st)
+                continue
+
+            # 按 DFS 顺序组装，保证结果与串行扫描一致（同名文件后者覆盖前者）
+            visited = results[root]
+            stack = [root]
+            while stack:
+                d = stack.pop()
+                if d in new_dirs or d not in visited:
+                    continue
+                entry, stats, was_listed = visited[d]
+                new_dirs[d] = entry
+                new_files.update(stats)
+                listed += was_listed
+                stack.extend(os.path.join(d, s) for s in reversed(entry["subdirs"]))
+
+        with self.lock:
+            diff = self._diff(self.files, new_files)
+            diff["listed"] = listed
+            for old_p, new_p in diff["moved"]:
+                for key in DERIVED_KEYS:
+                    if key in self.files[old_p] and key not in new_files[new_p]:
+                        new_files[new_p][key] = self.files[old_p][key]
+            diff["skipped"] = sorted(skipped)
+
+            if (new_dirs != self.dirs or new_files != self.files or roots != self.roots):
+                self.dirty = True
+            self.roots = roots
+            self.dirs = new_dirs
+            self.files = new_files
+        return diff
+
+    def record_file(self, path):
+        """登记单个新文件（watcher 用），并让其所在目录下次扫描时重新列出"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        d, name = os.path.split(path)
+        with self.lock:
+            self.files[path] = {"size": st.st_size, "mtime": st.st_mtime_ns}
+            entry = self.dirs.setdefault(d, {"mtime": None, "subdirs": [], "files": []})
+            entry["mtime"] = None
+            if name not in entry["files"]:
+                entry["files"].append(name)
+            self.dirty = True
+        return True
+
+    def forget_file(self, path):
+        d, name = os.path.split(path)
+        with self.lock:
+            self.keys.pop(path, None)
+            if self.files.pop(path, None) is None:
+                return False
+            entry = self.dirs.get(d)
+            if entry:
+                entry["mtime"] = None
+                if name in entry["files"]:
+                    entry["files"].remove(name)
+            self.dirty = True
+        return True
+
+    def forget_tree(self, root):
+        """目录被删除 / 移出（watcher 用）：移除其下的目录与文件，返回被移除的文件路径"""
+        prefix = root.rstrip(os.sep) + os.sep
+        with self.lock:
+            gone = [p for p in self.files if p.startswith(prefix)]
+            for p in gone:
+                del self.files[p]
+                self.keys.pop(p, None)
+            for d in [d for d in self.dirs if d == root or d.startswith(prefix)]:
+                del self.dirs[d]
+            parent, name = os.path.split(root.rstrip(os.sep))
+            entry = self.dirs.get(parent)
+            if entry:
+                entry["mtime"] = None
+                if name in entry["subdirs"]:
+                    entry["subdirs"].remove(name)
+            self.dirty = True
+        return gone
+
+    @staticmethod
+    def _diff(old, new):
+        added = [p for p in new if p not in old]
+        removed = [p for p in old if p not in new]
+
+        # 同一 (size, mtime) 的 删除+新增 视为移动 / 重命名
+        by_sig = {}
+        for p in removed:
+            by_sig.setdefault((old[p]["size"], old[p]["mtime"]), []).append(p)
+        moved = []
+        still_added = []
+        for p in added:
+            candidates = by_sig.get((new[p]["size"], new[p]["mtime"]))
+            if candidates:
+                moved.append((candidates.pop(0), p))
+            else:
+                still_added.append(p)
+        moved_src = {old_p for old_p, _ in moved}
+        return {
+            "added": still_added,
+            "removed": [p for p in removed if p not in moved_src],
+            "moved": moved,
+        }
+
+    def music_files(self):
+        """
+        {song key: path}。key 通常是文件名 stem：
+        - 已分配过 key 的文件沿用原 key（self.keys），与扫描顺序无关；
+        - 内容完全相同的副本（同一 hash）只保留已有 key 的那份，都没有时保留第一份；
+        - 新文件的 stem 已被占用时使用 "stem (父目录名)"，不会改动已有歌曲的 key。
+        """
+        music_files = {}
+        seen_hashes = set()
+        with self.lock:
+            for gone in [p for p in self.keys if p not in self.files]:
+                del self.keys[gone]
+                self.dirty = True
+            # 先放已有 key 的文件，再给新文件分配
+            items = sorted(self.files.items(), key=lambda item: item[0] not in self.keys)
+            for p, st in items:
+                h = st.get("hash")
+                if h:
+                    if h in seen_hashes:
+                        continue
+                    seen_hashes.add(h)
+                key = self.keys.get(p)
+                if key is None or key in music_files:
+                    key = self.song_key(p, music_files)
+                    self.keys[p] = key
+                    self.dirty = True
+                music_files[key] = p
+        return music_files
+
+    def assign_key(self, path, taken=()):
+        """单个新文件（watcher 用）的 song key：沿用已分配的，否则按 song_key 分配并记录"""
+        with self.lock:
+            key = self.keys.get(path)
+            if key is None or key in taken:
+                key = self.song_key(path, set(taken) | set(self.keys.values()))
+                self.keys[path] = key
+                self.dirty = True
+            return key
+
+    @staticmethod
+    def song_key(path, taken=()):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if stem not in taken:
+            return stem
+        key = base = f"{stem} ({os.path.basename(os.path.dirname(path))})"
+        n = 2
+        while key in taken:
+            key, n = f"{base} {n}", n + 1
+        return key
+
+    def tags(self, path):
+        """core.tags 读到的内嵌标签（未读取过则为 {}）"""
+        with self.lock:
+            return dict(self.files.get(path, {}).get("tags") or {})
+
+    def durations(self, music_files):
+        """{song key: seconds}，只含已知时长的曲目"""
+        with self.lock:
+            return {
+                k: self.files[p]["tags"]["duration"]
+                for k, p in music_files.items()
+                if "duration" in (self.files.get(p, {}).get("tags") or {})
+            }
+
+    def duplicates(self):
+        """[[path, ...], ...] — 内容 hash 相同的文件组"""
+        groups = {}
+        with self.lock:
+            for p, st in self.files.items():
+                if st.get("hash"):
+                    groups.setdefault(st["hash"], []).append(p)
+        return [paths for paths in groups.values() if len(paths) > 1]
+
+
+def diff_summary(diff):
+    """One-line Rich summary of a rescan diff, or None when nothing changed."""
+    added, removed, moved = len(diff["added"]), len(diff["removed"]), len(diff["moved"])
+    if not (added or removed or moved):
+        return None
+    return (
+        f"[cyan]📂 Library changed:[/] "
+        f"[green]+{added}[/] added, [red]-{removed}[/] removed, [yellow]↪ {moved}[/] moved "
+        f"[dim]({diff['listed']} dirs re-listed)[/]"
+    )
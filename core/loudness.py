@@ -13,6 +13,10 @@ import pyloudnorm as pyln
 _meters = {}
 _meters_lock = threading.Lock()
 
+# Process-wide results warmed in the background (e.g. by the library watcher)
+_prewarmed = {}
+_prewarmed_lock = threading.Lock()
+
 
 def _get_meter(sr):
     with _meters_lock:
@@ -70,6 +74,17 @@ def analyze_loudness(filepath):
         return None
 
 
+def prewarm(filepath):
+    """Analyze a file ahead of time so later LoudnessCache lookups are instant."""
+    with _prewarmed_lock:
+        if filepath in _prewarmed:
+            return _prewarmed[filepath]
+    result = analyze_loudness(filepath)
+    with _prewarmed_lock:
+        _prewarmed[filepath] = result
+    return result
+
+
 def loudness_key(info, method):
     """Extract the loudness value to use for comparison, based on strategy."""
     if info is None:
@@ -129,7 +144,10 @@ class LoudnessCache:
         with self._lock:
             if filepath in self._cache:
                 return self._cache[filepath]
-        result = analyze_loudness(filepath)
+        with _prewarmed_lock:
+            result = _prewarmed.get(filepath)
+        if result is None:
+            result = analyze_loudness(filepath)
         with self._lock:
             if filepath not in self._cache:
                 self._cache[filepath] = result
@@ -0,0 +1,82 @@
+"""Playlist line → library key matcher, exact first.
+
+``parse_raw_playlist`` used to run a full ``extractOne`` scan over the
+library for every line.  Most lines are exact or near-exact keys, so the
+matcher resolves them in three passes:
+
+1. exact hash lookup;
+2. lookup by normalised key — NFKC (full/half width), casefold,
+   traditional → simplified (zhconv), punctuation and spacing dropped;
+3. only the lines still unmatched go through one batched
+   ``rapidfuzz.process.cdist`` call on all cores.
+
+A matcher is built once per library version and cached by ``DJSession``.
+"""
+import re
+import unicodedata
+import zhconv
+from rapidfuzz import process, fuzz
+
+FUZZY_CUTOFF = 80
+CDIST_CHUNK = 256   # 每次 cdist 的行数，限制得分矩阵大小（行数 × 曲库）
+
+_QUOTES = re.compile(r"[\"'‘’“”]")
+_PUNCT = re.compile(r"[\W_]+")
+
+
+def normalise_key(text):
+    """宽度 / 大小写 / 繁简 / 标点差异都不算差异"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = zhconv.convert(_QUOTES.sub("", text), "zh-cn")
+    return _PUNCT.sub(" ", text).strip()
+
+
+class PlaylistMatcher:
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.exact = set(self.keys)
+        self.normalised = {}
+        ambiguous = set()
+        for key in self.keys:
+            norm = normalise_key(key)
+            if not norm:
+                continue
+            if norm in self.normalised:
+                ambiguous.add(norm)  # 规范化后撞车的交给模糊匹配打分
+            else:
+                self.normalised[norm] = key
+        for norm in ambiguous:
+            del self.normalised[norm]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def match(self, lines, score_cutoff=FUZZY_CUTOFF):
+        """
+        lines → [(matched key 或 None, how)]，与 lines 一一对应。
+        how ∈ "exact" / "normalised" / "fuzzy" / None
+        """
+        results = [(None, None)] * len(lines)
+        pending = []
+        for i, line in enumerate(lines):
+            if line in self.exact:
+                results[i] = (line, "exact")
+                continue
+            key = self.normalised.get(normalise_key(line))
+            if key is not None:
+                results[i] = (key, "normalised")
+            else:
+                pending.append(i)
+
+        if pending and self.keys:
+            for start in range(0, len(pending), CDIST_CHUNK):
+                chunk = pending[start:start + CDIST_CHUNK]
+                scores = process.cdist(
+                    [lines[i] for i in chunk], self.keys,
+                    scorer=fuzz.token_sort_ratio, score_cutoff=score_cutoff, workers=-1,
+                )
+                for row, i in zip(scores, chunk):
+                    best = int(row.argmax())
+                    if row[best] > 0:  # cdist 把低于 cutoff 的分数置 0
+                        results[i] = (self.keys[best], "fuzzy")
+        return results
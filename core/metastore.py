@@ -0,0 +1,226 @@
+"""SQLite metadata backend — lazy, indexed mirror of ``music_metadata.jsonl``.
+
+Enabled with ``preferences.metadata_backend = "sqlite"``.  The JSONL file
+stays the append log (tools read it); the database imports only the bytes
+appended since the last run, so startup no longer re-parses every line.
+Normalised language / genre / emotion tags (``core.analyse``'s precomputed
+``_norm`` lists) live in indexed columns so ``analyse`` and tag filters run
+as SQL aggregates; a new ``NORMALISER_VERSION`` rebuilds them.
+"""
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from core.log import log
+from core.config import METADATA_DB_PATH, METADATA_JSONL_PATH
+from core.analyse import NORMALISER_VERSION, NORM_KEY, TAG_FIELDS, is_normalised, normalise_record
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    name     TEXT PRIMARY KEY,
+    data     TEXT NOT NULL,
+    language TEXT,
+    genres   TEXT,
+    emotions TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_songs_language ON songs(language);
+CREATE TABLE IF NOT EXISTS song_tags (
+    name  TEXT NOT NULL,
+    field TEXT NOT NULL,
+    tag   TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tags_field_tag ON song_tags(field, tag);
+CREATE INDEX IF NOT EXISTS idx_tags_name ON song_tags(name);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class SqliteMetadataStore(MutableMapping):
+    """dict-like {name: metadata}；值按需从数据库读取并缓存"""
+
+    def __init__(self, db_path=METADATA_DB_PATH, jsonl_path=METADATA_JSONL_PATH):
+        self.db_path = db_path
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._cache = {}
+        self._names = set()
+
+    # --- JSONL → SQLite ---
+
+    def _get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)", (key, str(value)))
+
+    def catch_up(self):
+        """导入 JSONL 中上次之后追加的记录；文件被重写（inode 变化或变短）时全量重建"""
+        if not os.path.exists(self.jsonl_path):
+            return 0
+        st = os.stat(self.jsonl_path)
+        offset = int(self._get_meta("jsonl_offset") or 0)
+        lines = int(self._get_meta("jsonl_lines") or 0)
+        inode = self._get_meta("jsonl_inode")
+        full = (
+            self._get_meta("schema_version") != str(SCHEMA_VERSION)
+            or self._get_meta("normaliser_version") != NORMALISER_VERSION  # 映射表变了：重算标签列
+            or inode != str(st.st_ino)
+            or st.st_size < offset
+        )
+        if full:
+            offset = lines = 0
+        elif st.st_size == offset:
+            return 0
+
+        imported = 0
+        with self._lock, self._conn:
+            if full:
+                self._conn.execute("DELETE FROM songs")
+                self._conn.execute("DELETE FROM song_tags")
+            with open(self.jsonl_path, "rb") as f:
+                f.seek(offset)
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break  # 半行（正在写入），下次再导入
+                    offset += len(raw)
+                    if not raw.strip():
+                        continue
+                    lines += 1
+                    try:
+                        record = json.loads(raw)
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        continue
+                    if "name" in record and "metadata" in record:
+                        self._upsert(record["name"], record["metadata"])
+                        imported += 1
+            self._set_meta("jsonl_offset", offset)
+            self._set_meta("jsonl_lines", lines)
+            self._set_meta("jsonl_inode", st.st_ino)
+            self._set_meta("schema_version", SCHEMA_VERSION)
+            self._set_meta("normaliser_version", NORMALISER_VERSION)
+        return imported
+
+    def _upsert(self, name, meta):
+        if isinstance(meta, dict) and not is_normalised(meta):
+            normalise_record(meta)
+        tags = {f: v for f, v in meta[NORM_KEY].items() if f in TAG_FIELDS} if isinstance(meta, dict) else {}
+        self._conn.execute(
+            "INSERT OR REPLACE INTO songs(name, data, language, genres, emotions) VALUES(?, ?, ?, ?, ?)",
+            (
+                name,
+                json.dumps(meta, ensure_ascii=False),
+                (tags.get("language") or [None])[0],
+                ", ".join(tags.get("genre", [])) or None,
+                ", ".join(tags.get("emotion", [])) or None,
+            ),
+        )
+        self._conn.execute("DELETE FROM song_tags WHERE name=?", (name,))
+        self._conn.executemany(
+            "INSERT INTO song_tags(name, field, tag) VALUES(?, ?, ?)",
+            [(name, field, tag) for field, values in tags.items() for tag in values],
+        )
+
+    @property
+    def jsonl_lines(self):
+        """已导入的 JSONL 非空行数（含重复记录），用于判断是否需要 compaction"""
+        with self._lock:
+            return int(self._get_meta("jsonl_lines") or 0)
+
+    def load_names(self):
+        with self._lock:
+            self._names = {row[0] for row in self._conn.execute("SELECT name FROM songs")}
+            self._cache.clear()
+
+    # --- MutableMapping ---
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name in self._cache:
+                return self._cache[name]
+            if name not in self._names:
+                raise KeyError(name)
+            row = self._conn.execute("SELECT data FROM songs WHERE name=?", (name,)).fetchone()
+            if row is None:
+                raise KeyError(name)
+            value = json.loads(row[0])
+            self._cache[name] = value
+            return value
+
+    def __setitem__(self, name, meta):
+        with self._lock, self._conn:
+            self._upsert(name, meta)
+            self._cache[name] = meta
+            self._names.add(name)
+
+    def __delitem__(self, name):
+        with self._lock, self._conn:
+            if name not in self._names:
+                raise KeyError(name)
+            self._conn.execute("DELETE FROM songs WHERE name=?", (name,))
+            self._conn.execute("DELETE FROM song_tags WHERE name=?", (name,))
+            self._names.discard(name)
+            self._cache.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def keys(self):
+        # set-like view（支持 & 运算），与 dict.keys() 的用法兼容
+        return set(self._names)
+
+    # --- SQL queries ---
+
+    def distribution(self, field):
+        """[(label, count, pct), ...], total — SQL 版 compute_distribution"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT tag, COUNT(*) AS n FROM song_tags WHERE field=? GROUP BY tag ORDER BY n DESC, tag",
+                (field,),
+            ).fetchall()
+        total = sum(n for _, n in rows)
+        items = [(label, n, round(n / total * 100, 1)) for label, n in rows] if total else []
+        return items, total
+
+    def names_with_tag(self, field, tag):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name FROM song_tags WHERE field=? AND tag=? COLLATE NOCASE",
+                (field, tag),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_metadata_store(db_path=METADATA_DB_PATH, jsonl_path=METADATA_JSONL_PATH):
+    """打开 / 自动迁移 SQLite 元数据库；失败返回 None（调用方回退到 JSONL）"""
+    try:
+        store = SqliteMetadataStore(db_path, jsonl_path)
+        first = not os.path.exists(db_path) or store._get_meta("jsonl_offset") is None
+        imported = store.catch_up()
+        store.load_names()
+    except (sqlite3.Error, OSError) as e:
+        log(f"[yellow]⚠️ SQLite metadata store unavailable ({e}), using JSONL.[/]")
+        return None
+    if first and imported:
+        log(f"[green]📦 Migrated {imported} JSONL records to SQLite ({db_path}).[/]")
+    return store
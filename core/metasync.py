@@ -0,0 +1,450 @@
+"""Pipelined metadata sync — asyncio stages with their own queue and concurrency.
+
+    resolve (tags / NCM search) → lyric (NCM) → llm (extraction) → write
+
+Each stage has a bounded queue and its own worker count, so the cheap NCM
+lookups run ahead and keep the slow LLM stage busy instead of every worker
+doing search → lyric → LLM in series.  The blocking NCM (``core.ncm``, one
+pooled keep-alive session) / OpenAI clients run on a dedicated thread pool
+via ``run_in_executor``; only the ``write`` stage touches ``metadata`` and
+the JSONL file.
+
+With ``batch_size > 1`` each LLM worker packs up to that many queued songs
+into one JSON-mode request (trimmed to fit the model's context); songs the
+model leaves out are retried one by one.
+
+The LLM stage's concurrency is adaptive (``AimdController``): it starts at
+``metadata_concurrency``, grows while per-song latency and the error rate
+stay healthy, and halves on 429 / 5xx / timeouts, pausing for the
+provider's ``Retry-After``.  Throttled songs are re-queued, not dropped.
+
+``BackgroundSync`` runs the same pipeline on a daemon thread so the REPL is
+usable at once: records land in ``DJSession.metadata`` (under its lock) as
+they are written, and the prompt shows ``[⟳ done/total]``.
+
+Lyrics already in ``LYRICS_DIR`` skip the NCM lookups; lyrics the lyric
+stage downloads are written there in full (the LLM only sees the first
+``LYRIC_CHARS``), and resolved song ids go to the ``core.ncm`` id cache.
+"""
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from core.log import log
+from core.config import append_metadata_jsonl
+from core.analyse import normalise_record
+from core.ncm import cached_lyric, latency_summary
+from core.dj_core import LLMThrottled
+
+NCM_SEARCH_CONCURRENCY = 8
+NCM_LYRIC_CONCURRENCY = 8
+QUEUE_DEPTH_PER_WORKER = 4  # 每个下游 worker 预取的条目数
+BATCH_LINGER_SECONDS = 0.5  # 攒批时最多为下一首多等多久
+CANCEL_POLL_SECONDS = 0.2   # 后台同步检查取消标志的间隔
+BACKGROUND_STOP_TIMEOUT = 5.0
+
+# LLM 阶段的自适应并发（AIMD）
+AIMD_MAX_CONCURRENCY = 16   # 上限；metadata_concurrency 是起始值
+AIMD_LATENCY_FACTOR = 2.0   # 单曲耗时超过基线的这么多倍就不再加并发
+AIMD_MAX_ERROR_RATE = 0.2   # 最近 AIMD_ERROR_WINDOW 个请求的失败率上限
+AIMD_ERROR_WINDOW = 20
+AIMD_RATE_WINDOW = 50       # 进度条速率按最近多少首计算
+AIMD_BASE_PAUSE = 2.0       # 没有 Retry-After 时的首次退避（秒）
+AIMD_MAX_PAUSE = 60.0
+AIMD_MAX_REQUEUE = 3        # 同一首歌被限流后最多重新排队几次
+
+_DONE = object()
+
+
+async def _stage(name, workers, inbox, outbox, fn, executor, on_drop):
+    """workers 个协程从 inbox 取条目，fn 在线程池中执行；返回 None 或抛异常表示该曲目失败"""
+    loop = asyncio.get_running_loop()
+
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                await inbox.put(_DONE)  # 让同阶段的其他 worker 也退出
+                return
+            error = None
+            try:
+                result = await loop.run_in_executor(executor, fn, item)
+            except Exception as e:
+                result, error = None, e
+            if result is None:
+                on_drop(item, name, error)
+            else:
+                await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    await outbox.put(_DONE)
+
+
+class AimdController:
+    """
+    LLM 阶段的 AIMD 并发控制（在事件循环线程里使用，无需加锁）：
+    请求成功、单曲耗时不超过基线的 AIMD_LATENCY_FACTOR 倍且近期失败率低时，
+    每完成一轮（limit 个请求）并发 +1；遇到 429 / 5xx / 超时则减半，
+    并暂停发新请求 Retry-After 秒（没有该头时指数退避）。
+    """
+
+    def __init__(self, start, ceiling=AIMD_MAX_CONCURRENCY):
+        self.ceiling = max(1, ceiling)
+        self.limit = float(max(1, min(start, self.ceiling)))
+        self.peak = int(self.limit)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.baseline = None       # 观测到的最快单曲耗时（秒）
+        self.throttled = 0
+        self._streak = 0           # 连续限流次数（决定退避时长）
+        self._hold_until = 0.0     # 同一波限流只减半一次
+        self._outcomes = deque(maxlen=AIMD_ERROR_WINDOW)
+        self._done = deque()       # (请求开始, 完成时间, 曲目数)，覆盖最近约 AIMD_RATE_WINDOW 首
+        self._done_songs = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def rate(self):
+        """最近完成的曲目 / 分钟"""
+        if not self._done:
+            return 0.0
+        # 窗口内的曲目数 / 从其中最早发出的请求到最后一次完成的时长
+        span = self._done[-1][1] - min(start for start, _, _ in self._done)
+        return self._done_songs / span * 60 if span > 0 else 0.0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._cond:
+            while True:
+                wait = self.paused_until - loop.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                try:
+                    await asyncio.wait_for(self._cond.wait(), wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def cancel(self):
+        """拿到名额但没有发请求"""
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    async def release(self, elapsed, songs, succeeded, throttle=None):
+        """songs：本次请求的曲目数；succeeded：其中拿到元数据的数量"""
+        now = asyncio.get_running_loop().time()
+        async with self._cond:
+            self.in_flight -= 1
+            if throttle is not None:
+                self.throttled += 1
+                if now >= self._hold_until:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._hold_until = now + (self.baseline or 1.0) * 2
+                pause = throttle.retry_after
+                if pause is None:
+                    pause = AIMD_BASE_PAUSE * (2 ** min(self._streak, 5))
+                self._streak += 1
+                self.paused_until = max(self.paused_until, now + min(pause, AIMD_MAX_PAUSE))
+                self._outcomes.append(False)
+            else:
+                self._streak = 0
+                self._outcomes.append(succeeded > 0)
+                if succeeded:
+                    per_song = elapsed / songs
+                    self.baseline = per_song if self.baseline is None else min(self.baseline, per_song)
+                    self._done.append((now - elapsed, now, succeeded))
+                    self._done_songs += succeeded
+                    while len(self._done) > 1 and self._done_songs - self._done[0][2] >= AIMD_RATE_WINDOW:
+                        self._done_songs -= self._done.popleft()[2]
+                    errors = self._outcomes.count(False) / len(self._outcomes)
+                    if per_song <= self.baseline * AIMD_LATENCY_FACTOR and errors <= AIMD_MAX_ERROR_RATE:
+                        self.limit = min(float(self.ceiling), self.limit + 1 / self.limit)
+                        self.peak = max(self.peak, int(self.limit))
+            self._cond.notify_all()
+
+
+async def _batch_stage(ctl, batch_size, inbox, outbox, plan, fn, executor, on_drop):
+    """
+    LLM 阶段：最多 ctl.ceiling 个 worker，同时在途的请求数由 ctl 决定。
+    每个 worker 拿到名额后从 inbox 攒一批（plan 决定实际装几首），fn(jobs) 返回 {name: meta}；
+    被限流的曲目放回本 worker 的待发列表，超过 AIMD_MAX_REQUEUE 次才算失败。
+    """
+    loop = asyncio.get_running_loop()
+
+    async def worker():
+        pending, done = [], False
+        while True:
+            await ctl.acquire()
+            while len(pending) < batch_size and not done:
+                try:
+                    if pending:
+                        item = await asyncio.wait_for(inbox.get(), BATCH_LINGER_SECONDS)
+                    else:
+                        item = await inbox.get()
+                except asyncio.TimeoutError:
+                    break
+                if item is _DONE:
+                    await inbox.put(_DONE)
+                    done = True
+                    break
+                pending.append(item)
+            if not pending:
+                await ctl.cancel()
+                return
+            n = plan(pending)
+            jobs, pending = pending[:n], pending[n:]
+            throttle = error = None
+            start = loop.time()
+            try:
+                results = await loop.run_in_executor(executor, fn, jobs)
+            except LLMThrottled as e:
+                throttle, results = e, e.partial
+            except Exception as e:
+                error, results = e, {}
+            await ctl.release(loop.time() - start, len(jobs), len(results), throttle)
+            for job in jobs:
+                meta = results.get(job["name"])
+                if meta is not None:
+                    job["meta"] = meta
+                    await outbox.put(job)
+                elif throttle is not None and job.get("requeued", 0) < AIMD_MAX_REQUEUE:
+                    job["requeued"] = job.get("requeued", 0) + 1
+                    pending.append(job)
+                else:
+                    on_drop(job, "llm", throttle or error)
+
+    await asyncio.gather(*(worker() for _ in range(ctl.ceiling)))
+    await outbox.put(_DONE)
+
+
+async def _pipeline(client, targets, metadata, model_name, llm_concurrency, tags, pbar, batch_size, ledger,
+                    session, cancel):
+    from core.dj_core import (search_song_id, fetch_lyric, extract_metadata_batch,
+                              plan_batch_size, song_info)
+    from core.tags import embedded_lyrics
+
+    ctl = AimdController(llm_concurrency)
+    stats = {"synced": 0, "failed": {"resolve": 0, "lyric": 0, "llm": 0}, "llm": ctl}
+
+    def resolve(item):
+        name, path = item
+        t = tags.get(name) or {}
+        if path and t.get("has_lyrics"):
+            lyric = embedded_lyrics(path)
+            if lyric:
+                return {"name": name, "tags": t, "lyric": lyric}
+        lyric = cached_lyric(name)  # tools/lyrics_sync.py 或上次同步已下载
+        if lyric:
+            return {"name": name, "tags": t, "lyric": lyric}
+        sid = search_song_id(name, t)
+        if sid is None:
+            return None
+        return {"name": name, "tags": t, "sid": sid}
+
+    def lyric(job):
+        if "lyric" not in job:
+            job["lyric"] = fetch_lyric(job["sid"], job["name"])
+        return job
+
+    def llm(jobs):
+        return extract_metadata_batch(
+            client, [(j["name"], j["lyric"], j["tags"]) for j in jobs], model_name
+        )
+
+    def plan(jobs):
+        infos = [song_info(j["name"], j["lyric"], j["tags"])[0] for j in jobs]
+        return plan_batch_size(model_name, infos, batch_size)
+
+    def on_drop(item, stage, error=None):
+        stats["failed"][stage] += 1
+        pbar.update(1)
+        if ledger is not None:
+            name = item[0] if isinstance(item, tuple) else item["name"]
+            if error is None:
+                ledger.record(name, stage)
+            else:
+                # 网络错误 / 限流很快就值得重试；LLM 回复解析失败按普通失败处理
+                transient = isinstance(error, LLMThrottled) or (
+                    stage != "llm" and not isinstance(error, (KeyError, IndexError, TypeError)))
+                ledger.record(name, stage, f"{type(error).__name__}: {error}"[:160], transient)
+
+    depth = max(4, ctl.ceiling * QUEUE_DEPTH_PER_WORKER * batch_size)
+    q_resolve = asyncio.Queue()
+    q_lyric = asyncio.Queue(maxsize=depth)
+    q_llm = asyncio.Queue(maxsize=depth)
+    q_write = asyncio.Queue()
+
+    async def feed():
+        for item in targets.items():
+            await q_resolve.put(item)
+        await q_resolve.put(_DONE)
+
+    async def write():
+        while True:
+            job = await q_write.get()
+            if job is _DONE:
+                return
+            normalise_record(job["meta"])  # 规范化标签只在写入时算一次
+            if session is not None:
+                # REPL / watcher 线程同时在读写 metadata
+                with session.lock:
+                    metadata[job["name"]] = job["meta"]
+                session.announce_additions([job["name"]])
+            else:
+                metadata[job["name"]] = job["meta"]
+            append_metadata_jsonl(job["name"], job["meta"])
+            if ledger is not None:
+                ledger.clear(job["name"])
+            stats["synced"] += 1
+            pbar.update(1)
+            pbar.set_postfix_str(
+                f"{job['name'][:10]}... | LLM ×{ctl.concurrency} · {ctl.rate():.1f} songs/min"
+            )
+
+    executor = ThreadPoolExecutor(
+        max_workers=NCM_SEARCH_CONCURRENCY + NCM_LYRIC_CONCURRENCY + ctl.ceiling,
+        thread_name_prefix="metasync",
+    )
+    stages = asyncio.gather(
+        feed(),
+        _stage("resolve", NCM_SEARCH_CONCURRENCY, q_resolve, q_lyric, resolve, executor, on_drop),
+        _stage("lyric", NCM_LYRIC_CONCURRENCY, q_lyric, q_llm, lyric, executor, on_drop),
+        _batch_stage(ctl, batch_size, q_llm, q_write, plan, llm, executor, on_drop),
+        write(),
+    )
+
+    async def watch_cancel():
+        while not cancel.is_set():
+            await asyncio.sleep(CANCEL_POLL_SECONDS)
+        stages.cancel()
+
+    watcher = asyncio.ensure_future(watch_cancel()) if cancel is not None else None
+    try:
+        await stages
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        # Ctrl+C 时不等待仍在进行的 HTTP 请求
+        executor.shutdown(wait=False, cancel_futures=True)
+    return stats
+
+
+def run_pipeline(client, targets, metadata, model_name, llm_concurrency=1, tags=None, batch_size=1,
+                 ledger=None, session=None, progress=None, cancel=None):
+    """
+    同步入口：跑完整条流水线后返回 metadata（Ctrl+C 跳过剩余曲目）。
+    给出 ledger（core.failures.FailureLedger）时记录失败曲目、清除成功曲目并落盘。
+    session（DJSession）：metadata 属于运行中的会话时传入，写入时持有其 lock 并
+    announce_additions。后台运行（BackgroundSync）时另外传入 progress（代替 tqdm
+    进度条）和 cancel（threading.Event）。JSONL 追加由 core.config 的单写者线程攒批完成。
+    """
+    if not targets:
+        return metadata
+    llm_concurrency = max(1, llm_concurrency)
+    batch_size = max(1, batch_size)
+    if progress is None:
+        log(f"[cyan]🚀 Syncing {len(targets)} new songs using {model_name}... (Ctrl+C to skip)[/]")
+        log(
+            f"[dim]⚙️  Pipeline: search ×{NCM_SEARCH_CONCURRENCY} → lyric ×{NCM_LYRIC_CONCURRENCY} "
+            f"→ LLM ×{llm_concurrency} (adaptive, ≤{AIMD_MAX_CONCURRENCY})"
+            + (f" (≤{batch_size} songs/request)" if batch_size > 1 else "") + "[/]"
+        )
+    pbar = progress or tqdm(total=len(targets), unit="song")
+    try:
+        stats = asyncio.run(_pipeline(
+            client, targets, metadata, model_name, llm_concurrency, tags or {}, pbar, batch_size, ledger,
+            session, cancel
+        ))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        log("\n[yellow]⚠️ Sync skipped.[/]")
+        return metadata
+    finally:
+        pbar.close()
+        if ledger is not None:
+            ledger.save()
+
+    failed = stats["failed"]
+    if any(failed.values()):
+        log(
+            f"[dim]   NCM search failures: {failed['resolve']}, lyric errors: {failed['lyric']}, "
+            f"LLM failures: {failed['llm']}[/]"
+        )
+        if ledger is not None:
+            log("[dim]   failed songs are skipped until they expire — see [bold]failed[/bold][/]")
+    ctl = stats["llm"]
+    log(
+        f"[dim]   LLM concurrency: settled at {ctl.concurrency} (peak {ctl.peak})"
+        + (f", throttled {ctl.throttled}×" if ctl.throttled else "") + "[/]"
+    )
+    latency = latency_summary()
+    if latency:
+        log(f"[dim]   NCM latency: {latency}[/]")
+    return metadata
+
+
+class BackgroundSync:
+    """
+    在后台线程里跑 run_pipeline，REPL 同时可用：新元数据写入 DJSession.metadata
+    后立即可点播（并通过 announce_additions 告知 AI）。prompt_prefix() 给出进度。
+    """
+
+    def __init__(self, aidj, targets, model_name, concurrency=1, tags=None, batch_size=1, ledger=None):
+        self.aidj = aidj
+        self.targets = targets
+        self.model_name = model_name
+        self.concurrency = concurrency
+        self.tags = tags
+        self.batch_size = batch_size
+        self.ledger = ledger
+        self.total = len(targets)
+        self.done = 0           # 已处理（成功 + 失败）
+        self.postfix = ""
+        self._cancel = threading.Event()
+        self._thread = None
+
+    # tqdm 接口的子集，供 _pipeline 更新进度
+    def update(self, n=1):
+        self.done += n
+
+    def set_postfix_str(self, text):
+        self.postfix = text
+
+    def close(self):
+        pass
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metasync-bg", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        log(f"[cyan]🚀 Syncing {self.total} new songs in the background using {self.model_name}...[/]")
+        run_pipeline(
+            self.aidj.client, self.targets, self.aidj.metadata, self.model_name,
+            llm_concurrency=self.concurrency, tags=self.tags, batch_size=self.batch_size,
+            ledger=self.ledger, session=self.aidj, progress=self, cancel=self._cancel,
+        )
+        if not self._cancel.is_set():
+            log(f"[green]✅ Background sync finished ({self.done}/{self.total} processed).[/]")
+
+    def stop(self, timeout=BACKGROUND_STOP_TIMEOUT):
+        """取消剩余曲目并等待线程退出（已写入的记录保留）"""
+        if not self.running:
+            return
+        self._cancel.set()
+        self._thread.join(timeout)
+
+    def prompt_prefix(self):
+        """例如 "[⟳ 120/500] "；未在运行时返回空串"""
+        if not self.running:
+            return ""
+        return f"[⟳ {self.done}/{self.total}] "
@@ -0,0 +1,83 @@
+"""Per-request LLM latency / throughput metrics.
+
+Every chat request (``next_step``) and metadata extraction request
+(``get_song_info`` / ``get_songs_info_batch``) records one sample:
+time to first token, total latency, completion tokens per second, cached
+prompt tokens and whether it failed.  Samples are kept per (model, command)
+for the session; ``token`` shows p50 / p95 per model and per command.
+"""
+import threading
+from collections import deque
+
+SAMPLES_PER_KEY = 200   # 每个 (model, command) 保留最近多少次请求
+
+
+def percentile(samples, pct):
+    """最近邻插值的百分位数；samples 为空时返回 None"""
+    samples = [s for s in samples if s is not None]
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class LlmMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}  # (model, command) -> deque[dict]
+
+    def record(self, model, command, total, ttft=None, completion_tokens=None, cached=None, error=False):
+        """记录一次请求；流式请求给出 ttft，非流式请求的首 token 即整段回复"""
+        tps = None
+        if completion_tokens and total:
+            # 吞吐按生成阶段算（去掉等待首 token 的时间）
+            gen = total - (ttft or 0)
+            tps = completion_tokens / gen if gen > 0 else None
+        sample = {
+            "ttft": ttft if ttft is not None else (None if error else total),
+            "total": total, "tps": tps, "cached": cached or 0, "error": error,
+        }
+        with self._lock:
+            self._samples.setdefault((model or "?", command), deque(maxlen=SAMPLES_PER_KEY)).append(sample)
+
+    def _group(self, key_index):
+        with self._lock:
+            groups = {}
+            for key, samples in self._samples.items():
+                groups.setdefault(key[key_index], []).extend(samples)
+        return groups
+
+    @staticmethod
+    def _stats(samples):
+        ok = [s for s in samples if not s["error"]]
+        return {
+            "calls": len(samples),
+            "errors": len(samples) - len(ok),
+            "ttft_p50": percentile([s["ttft"] for s in ok], 50),
+            "ttft_p95": percentile([s["ttft"] for s in ok], 95),
+            "total_p50": percentile([s["total"] for s in ok], 50),
+            "total_p95": percentile([s["total"] for s in ok], 95),
+            "tps_p50": percentile([s["tps"] for s in ok], 50),
+            "cached": sum(s["cached"] for s in ok),
+        }
+
+    def by_model(self):
+        """{model: stats}"""
+        return {model: self._stats(samples) for model, samples in sorted(self._group(0).items())}
+
+    def by_command(self):
+        """{command: stats}"""
+        return {cmd: self._stats(samples) for cmd, samples in sorted(self._group(1).items())}
+
+    def expected_latency(self, model, command, pct=95):
+        """该 model + command 的历史总耗时百分位（秒）；没有成功样本时返回 None"""
+        with self._lock:
+            samples = list(self._samples.get((model or "?", command), ()))
+        return percentile([s["total"] for s in samples if not s["error"]], pct)
+
+    def __bool__(self):
+        with self._lock:
+            return bool(self._samples)
+
+
+llm_metrics = LlmMetrics()
@@ -0,0 +1,298 @@
+"""Shared HTTP client for the NCM API (and the other local lyric services).
+
+One ``requests.Session`` per base URL, so keep-alive connections are pooled
+across the sync pipeline's worker threads instead of a new TCP connection per
+call.  Connection errors, timeouts, 429 and 5xx are retried a bounded number
+of times with jittered exponential backoff (``Retry-After`` is honoured);
+every endpoint has its own (connect, read) timeout.  Per-endpoint latency is
+kept for ``latency()`` / the sync summary.
+
+Resolved song ids are remembered in ``NCM_CACHE_PATH`` (append-only JSONL,
+keyed by song name and by search keyword) and lyrics fetched anywhere are
+written to ``LYRICS_DIR/<name>.lrc``, so sync, ``lyrics``, the watcher and
+``tools/lyrics_sync.py`` pay for at most one search per song between them.
+"""
+import os
+import re
+import json
+import time
+import random
+import threading
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from core.log import log
+from core.metrics import percentile
+from core.config import NCM_BASE_URL, NCM_CACHE_PATH, LYRICS_DIR
+
+POOL_SIZE = 16              # ≥ metasync 中 NCM search + lyric 的线程数
+MAX_RETRIES = 2             # 首次请求之外最多重试几次
+BACKOFF_BASE = 0.3          # 秒；第 n 次重试等待 base * 2^n * (0.5~1.5)
+BACKOFF_MAX = 5.0
+LATENCY_SAMPLES = 256       # 每个 endpoint 保留最近多少次耗时
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# (connect, read) 秒
+NCM_TIMEOUTS = {
+    "search": (3.05, 5),
+    "lyric": (3.05, 5),
+    "song/detail": (3.05, 5),
+}
+DEFAULT_TIMEOUT = (3.05, 10)
+
+
+class HttpClient:
+    """GET-only JSON client bound to one base URL."""
+
+    def __init__(self, base_url, timeouts=None, default_timeout=DEFAULT_TIMEOUT,
+                 pool_size=POOL_SIZE, retries=MAX_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._stats = {}  # endpoint -> {"calls", "errors", "retries", "samples"}
+
+    def _record(self, endpoint, elapsed=None, error=False, retried=False):
+        with self._lock:
+            st = self._stats.setdefault(endpoint, {
+                "calls": 0, "errors": 0, "retries": 0, "samples": deque(maxlen=LATENCY_SAMPLES),
+            })
+            if retried:
+                st["retries"] += 1
+                return
+            st["calls"] += 1
+            if error:
+                st["errors"] += 1
+            elif elapsed is not None:
+                st["samples"].append(elapsed)
+
+    @staticmethod
+    def _backoff(attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(BACKOFF_MAX, float(retry_after))
+            except ValueError:
+                pass
+        return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def get(self, endpoint, params=None, timeout=None):
+        """GET base_url/endpoint；可重试的错误重试完仍失败时抛 requests.RequestException"""
+        url = f"{self.base_url}/{endpoint.lstrip('/')}"
+        endpoint = endpoint.strip("/")  # 统计 / 超时表的 key
+        timeout = timeout or self.timeouts.get(endpoint, self.default_timeout)
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                resp = self.session.get(url, params=params, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    self._record(endpoint, error=True)
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUS:
+                    self._record(endpoint, time.perf_counter() - start)
+                    return resp
+                if last:
+                    self._record(endpoint, error=True)
+                    resp.raise_for_status()
+                retry_after = resp.headers.get("Retry-After")
+            self._record(endpoint, retried=True)
+            time.sleep(self._backoff(attempt, retry_after))
+
+    def get_json(self, endpoint, params=None, timeout=None):
+        """get() + .json()；响应不是 JSON 时抛 ValueError"""
+        return self.get(endpoint, params=params, timeout=timeout).json()
+
+    def latency(self):
+        """{endpoint: {"calls", "errors", "retries", "p50", "p95"}}（秒）"""
+        with self._lock:
+            return {
+                ep: {
+                    "calls": st["calls"], "errors": st["errors"], "retries": st["retries"],
+                    "p50": percentile(st["samples"], 50), "p95": percentile(st["samples"], 95),
+                }
+                for ep, st in self._stats.items()
+            }
+
+    def latency_summary(self):
+        """一行摘要，例如 "search p50 120ms / p95 480ms (2 err)"；没有请求时返回空串"""
+        parts = []
+        for ep, st in sorted(self.latency().items()):
+            if st["p50"] is None:
+                parts.append(f"{ep} {st['errors']} err")
+                continue
+            part = f"{ep} p50 {st['p50'] * 1000:.0f}ms / p95 {st['p95'] * 1000:.0f}ms"
+            if st["errors"] or st["retries"]:
+                part += f" ({st['errors']} err, {st['retries']} retried)"
+            parts.append(part)
+        return ", ".join(parts)
+
+
+_ncm = None
+_ncm_lock = threading.Lock()
+
+
+def ncm_client():
+    """进程内共享的 NCM 客户端（首次调用时创建）"""
+    global _ncm
+    with _ncm_lock:
+        if _ncm is None:
+            _ncm = HttpClient(NCM_BASE_URL, NCM_TIMEOUTS)
+        return _ncm
+
+
+def latency_summary():
+    """共享 NCM 客户端的耗时摘要；本进程还没请求过 NCM 时返回空串"""
+    return _ncm.latency_summary() if _ncm is not None else ""
+
+
+class ResolutionCache:
+    """{song name: id} + {search keyword: id}，首次访问时从 JSONL 载入，写入即追加"""
+
+    def __init__(self, path=NCM_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._names = None
+        self._keywords = None
+
+    def _load(self):
+        # 调用方持有 self._lock
+        if self._names is not None:
+            return
+        self._names, self._keywords = {}, {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if "id" not in record:
+                        continue
+                    if "name" in record:
+                        self._names[record["name"]] = record["id"]
+                    elif "keyword" in record:
+                        self._keywords[record["keyword"]] = record["id"]
+        except OSError as e:
+            log(f"[yellow]⚠️ Failed to read NCM id cache: {e}[/]")
+
+    def by_name(self, name):
+        with self._lock:
+            self._load()
+            return self._names.get(name)
+
+    def by_keyword(self, keyword):
+        with self._lock:
+            self._load()
+            return self._keywords.get(keyword)
+
+    def put(self, sid, name=None, keyword=None):
+        records = []
+        with self._lock:
+            self._load()
+            if name is not None and self._names.get(name) != sid:
+                self._names[name] = sid
+                records.append({"name": name, "id": sid})
+            if keyword is not None and self._keywords.get(keyword) != sid:
+                self._keywords[keyword] = sid
+                records.append({"keyword": keyword, "id": sid})
+            if not records:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+            except OSError as e:
+                log(f"[yellow]⚠️ Failed to write NCM id cache: {e}[/]")
+
+
+resolution_cache = ResolutionCache()
+
+
+def search_song(keyword):
+    """NCM 搜索第一条结果的 song id（同一关键词只搜一次）；没有结果返回 None"""
+    sid = resolution_cache.by_keyword(keyword)
+    if sid is not None:
+        return sid
+    res = ncm_client().get_json("search", {"keywords": keyword, "limit": 1})
+    if res.get('code') == 200 and res.get('result', {}).get('songCount', 0) > 0:
+        sid = res['result']['songs'][0]['id']
+        resolution_cache.put(sid, keyword=keyword)
+        return sid
+    return None
+
+
+def resolve(name, keywords=()):
+    """歌曲名 → song id：先查缓存，再依次搜索 keywords（为空时搜 name），命中后记住 name"""
+    sid = resolution_cache.by_name(name) if name else None
+    if sid is not None:
+        return sid
+    for keyword in keywords or (name,):
+        sid = search_song(keyword)
+        if sid is not None:
+            if name:
+                resolution_cache.put(sid, name=name)
+            return sid
+    return None
+
+
+def fetch_lyric(sid):
+    """NCM 歌词原文（LRC）；接口失败或没有歌词返回 None"""
+    res = ncm_client().get_json("lyric", {"id": sid})
+    if res.get('code') != 200:
+        return None
+    return res.get('lrc', {}).get('lyric') or None
+
+
+# --- LYRICS_DIR ---
+
+def lyric_path(name):
+    """LYRICS_DIR/<name>.lrc（去掉文件系统非法字符，与 tools/lyrics_sync.py 一致）"""
+    safe = re.sub(r'[\\/*?:"<>|]', "", name)
+    return os.path.join(LYRICS_DIR, f"{safe}.lrc")
+
+
+def cached_lyric(name):
+    """已下载的歌词文本，没有返回 None"""
+    try:
+        with open(lyric_path(name), "r", encoding="utf-8") as f:
+            return f.read() or None
+    except OSError:
+        return None
+
+
+def save_lyric(name, lyric):
+    """写入 LYRICS_DIR（tmp + os.replace），失败返回 False"""
+    path = lyric_path(name)
+    tmp = path + ".tmp"
+    try:
+        os.makedirs(LYRICS_DIR, exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(lyric)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        return False
+
+
+def download_lyric(name, keywords=()):
+    """已有 .lrc 则直接读取，否则 resolve → fetch_lyric → 存入 LYRICS_DIR；没有歌词返回 None"""
+    lyric = cached_lyric(name)
+    if lyric:
+        return lyric
+    sid = resolve(name, keywords)
+    if sid is None:
+        return None
+    lyric = fetch_lyric(sid)
+    if lyric:
+        save_lyric(name, lyric)
+    return lyric
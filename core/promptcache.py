@@ -0,0 +1,92 @@
+"""Byte-stable library prefix for provider prompt caching.
+
+DeepSeek and most OpenAI-compatible APIs cache repeated prompt prefixes:
+cached tokens are cheaper and the first token arrives sooner.  The system
+message holding the whole library is by far the largest prefix, but it was
+re-rendered every session, so a single added song (or a changed tag) moved
+every byte after it and the cache missed.
+
+The rendered system message is persisted in ``PROMPT_PREFIX_PATH`` together
+with the song names it lists and a digest of each song's rendered line.  A
+new conversation reuses it verbatim as long as the prompt template / injects /
+protocol are unchanged, no listed song's line (genre, emotion, review …) has
+changed, and the library has drifted by at most ``MAX_DRIFT``; songs added
+since are announced in the first user message (like ``announce_additions``),
+songs removed since are harmless because replies are validated against the
+live library.  Otherwise the prefix is rebuilt and saved again.
+"""
+import os
+import json
+import hashlib
+from core.log import log
+from core.config import PROMPT_PREFIX_PATH
+
+PREFIX_VERSION = 2   # 2: 按歌记录渲染行的指纹
+MAX_DRIFT = 0.05    # 新增 + 移除的歌曲占比超过它就重建前缀
+
+
+def prefix_signature(*parts):
+    """渲染前缀的全部输入（模板、injects、协议……）的指纹；任何一项变化都必须重建"""
+    blob = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:16]
+
+
+def _entry_digest(line):
+    return hashlib.sha1(line.encode("utf-8")).hexdigest()[:12]
+
+
+def _load(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        log(f"[yellow]⚠️ Failed to read {path}: {e}[/]")
+        return None
+    return data if isinstance(data, dict) and data.get("version") == PREFIX_VERSION else None
+
+
+def _save(path, data):
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        log(f"[yellow]⚠️ Failed to save prompt prefix: {e}[/]")
+
+
+def stable_prefix(signature, entries, render, path=PROMPT_PREFIX_PATH):
+    """
+    entries = {name: 该歌在曲库中渲染出的一行}。返回 (system content, 前缀中缺少的歌, reused)。
+    render(lines) → 新的 system content（lines 为按名排序后拼好的曲库）；只有无法复用旧前缀时才会调用。
+    """
+    digests = {name: _entry_digest(line) for name, line in entries.items()}
+    saved = _load(path)
+    if saved and saved.get("signature") == signature:
+        listed = saved.get("entries", {})
+        added = digests.keys() - listed.keys()
+        drift = len(added) + len(listed.keys() - digests.keys())
+        # 仍在库中的歌其 genre / emotion / review 等有任何变化，旧前缀就过期了
+        stale = any(digests[name] != d for name, d in listed.items() if name in digests)
+        if not stale and drift <= MAX_DRIFT * max(1, len(digests)):
+            return saved["content"], sorted(added), True
+
+    content = render("\n".join(entries[name] for name in sorted(entries)))
+    _save(path, {"version": PREFIX_VERSION, "signature": signature,
+                 "entries": digests, "content": content})
+    return content, [], False
+
+
+def usage_cache_hits(usage):
+    """从 usage 中读出命中缓存的 prompt token 数：DeepSeek 与 OpenAI 字段名不同；都没有时返回 None"""
+    hits = getattr(usage, "prompt_cache_hit_tokens", None)  # DeepSeek
+    if hits is not None:
+        return hits
+    details = getattr(usage, "prompt_tokens_details", None)  # OpenAI 及多数兼容实现
+    if details is not None:
+        cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+        if cached is not None:
+            return cached
+    return None
@@ -0,0 +1,133 @@
+"""Local retrieval stage — BM25 over song names, tags and reviews.
+
+With ``preferences.library_mode = "retrieval"`` the library is no longer
+pinned into the system prompt on turn 1.  Each request is scored against
+this index instead and only the top ``retrieval_k`` songs are sent with that
+user message, so prompt size stays flat however large the library gets.
+``DJSession.parse_raw_playlist`` still validates the reply against the whole
+library.
+
+Documents are tokenised for mixed-script metadata: lower-cased Latin words,
+plus CJK unigrams and bigrams (no segmenter needed).  The index is updated
+incrementally — ``sync()`` only re-tokenises songs whose metadata changed.
+"""
+import math
+import random
+import re
+from collections import Counter
+from core.analyse import TAG_FIELDS, song_tags
+
+DEFAULT_K = 200
+MIN_K, MAX_K = 20, 2000
+BM25_K1 = 1.5
+BM25_B = 0.75
+NAME_WEIGHT = 2  # 歌名 / 歌手词重复计入，比标签和评语更重要
+
+_WORD = re.compile(r"[a-z0-9]+")
+_CJK_RUN = re.compile(r"[぀-ヿ一-鿿가-힯]+")
+
+
+def tokenize(text):
+    """Latin 单词 + CJK 单字与相邻二字组"""
+    text = str(text).lower()
+    tokens = _WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def song_document(name, meta):
+    """一首歌的检索词：歌名（加权）、规范化标签、LLM 原始 genre / emotion 与 review"""
+    tokens = tokenize(name) * NAME_WEIGHT
+    if isinstance(meta, dict):
+        for field in TAG_FIELDS:
+            for tag in song_tags(meta, field):
+                tokens.extend(tokenize(tag))
+        for field in ("genre", "emotion", "review"):
+            raw = meta.get(field)
+            if raw:
+                tokens.extend(tokenize(", ".join(map(str, raw)) if isinstance(raw, list) else raw))
+    return tokens
+
+
+class Bm25Index:
+    """增量维护的 BM25 倒排索引：{token: {name: tf}}"""
+
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}     # name -> 文档长度
+        self._terms = {}      # name -> 该文档的词集合（remove 时只动相关 postings）
+        self._sources = {}    # name -> 建索引时的 meta 对象，对象换了才重建该文档
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, name, tokens):
+        self.remove(name)
+        counts = Counter(tokens)
+        for token, tf in counts.items():
+            self.postings.setdefault(token, {})[name] = tf
+        self._terms[name] = set(counts)
+        self.lengths[name] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, name):
+        length = self.lengths.pop(name, None)
+        if length is None:
+            return
+        self.total_length -= length
+        self._sources.pop(name, None)
+        for token in self._terms.pop(name, ()):
+            docs = self.postings.get(token)
+            if docs is not None and docs.pop(name, None) is not None and not docs:
+                del self.postings[token]
+
+    def sync(self, names, metadata):
+        """让索引与 names（当前可点播的歌）一致；返回新增 / 重建的文档数"""
+        names = set(names)
+        for gone in [n for n in self.lengths if n not in names]:
+            self.remove(gone)
+        changed = 0
+        for name in names:
+            meta = metadata.get(name)
+            if name in self.lengths and self._sources.get(name) is meta:
+                continue
+            self.add(name, song_document(name, meta))
+            self._sources[name] = meta
+            changed += 1
+        return changed
+
+    def search(self, query, k):
+        """[(name, score)]，按分数降序，只含至少命中一个词的歌"""
+        n = len(self.lengths)
+        if not n:
+            return []
+        avg = self.total_length / n or 1.0
+        scores = Counter()
+        for token in set(tokenize(query)):
+            docs = self.postings.get(token)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for name, tf in docs.items():
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[name] / avg)
+                scores[name] += idf * tf * (BM25_K1 + 1) / norm
+        return scores.most_common(k)
+
+
+def candidates(index, query, k, exclude=()):
+    """
+    本轮发给 AI 的候选歌：BM25 前 k 首（跳过 exclude，即已播放的），
+    命中不足 k 首时用其余歌曲随机补齐，让“随便来点”之类的请求也有足够选择。
+    返回 (names, hits)，hits 为真正命中检索词的数量。
+    """
+    exclude = set(exclude)
+    ranked = [name for name, _ in index.search(query, k + len(exclude)) if name not in exclude][:k]
+    hits = len(ranked)
+    if hits < k:
+        chosen = set(ranked)
+        rest = [name for name in index.lengths if name not in chosen and name not in exclude]
+        ranked.extend(random.sample(rest, min(k - hits, len(rest))))
+    return ranked, hits
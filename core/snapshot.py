@@ -0,0 +1,160 @@
+"""Warm-start snapshot — pickled runtime catalog, memory-mapped on startup.
+
+Holds the library index, ``music_paths``, the JSONL metadata dict and the
+play counts, each stamped with the (inode, size, mtime) of the file(s) it was
+loaded from.  On startup every part whose source file is unchanged is taken
+from the snapshot instead of being re-parsed; anything stale falls back to
+the normal loader.  Metadata appended to the JSONL since the snapshot is
+replayed from the recorded byte offset, so a sync alone does not force a
+cold start.
+"""
+import os
+import json
+import mmap
+import pickle
+from core.log import log
+from core.config import (
+    SNAPSHOT_PATH, LIBRARY_INDEX_PATH, METADATA_JSONL_PATH, FREQ_CSV_PATH, PLAY_LOG_PATH,
+    load_cached_metadata, load_frequency,
+)
+
+SNAPSHOT_VERSION = 3
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class RuntimeSnapshot:
+    """One snapshot file; ``load()`` once, then ask each part for its data."""
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self.data = {}
+        self.warm = []          # 从快照恢复的部分（用于启动提示）
+        self.jsonl_mark = None  # (inode, offset)：内存 metadata 已覆盖到 JSONL 的位置
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = pickle.loads(mm)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return False
+        if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+            return False
+        self.data = data
+        return True
+
+    # --- parts ---
+
+    def library(self):
+        """LibraryIndex：索引文件未变则直接用快照，否则 LibraryIndex.load()"""
+        from core.library import LibraryIndex
+        part = self.data.get("library")
+        if part and part["stamp"] == _stamp(LIBRARY_INDEX_PATH):
+            index = LibraryIndex(LIBRARY_INDEX_PATH)
+            index.roots = part["roots"]
+            index.dirs = part["dirs"]
+            index.files = part["files"]
+            index.catalog = part["catalog"]
+            index.keys = part["keys"]
+            self.warm.append("library")
+            return index
+        return LibraryIndex.load()
+
+    def music_files(self, library):
+        """库在本次启动中未变更（rescan / reconcile 后仍 clean）时复用快照里的 music_paths"""
+        part = self.data.get("library")
+        if "library" in self.warm and not library.dirty and part.get("musics") is not None:
+            return dict(part["musics"])
+        return library.music_files()
+
+    def metadata(self, backend):
+        """JSONL backend：快照 + 回放快照之后追加的行；inode 变化（被重写）则全量解析"""
+        part = self.data.get("metadata")
+        if backend == "jsonl" and part:
+            replayed = self._replay_jsonl(part["metadata"], part["mark"])
+            if replayed is not None:
+                self.warm.append("metadata")
+                return replayed
+        if backend == "jsonl":
+            # 先 stat 再解析：之间追加的行下次会被重复回放（幂等），不会丢
+            st = _stamp(METADATA_JSONL_PATH)
+            self.jsonl_mark = (st[0], st[1]) if st else None
+        return load_cached_metadata(backend)
+
+    def jsonl_rewritten(self):
+        """JSONL 刚由内存中的 metadata 整体重写：内存内容即覆盖到文件末尾"""
+        st = _stamp(METADATA_JSONL_PATH)
+        self.jsonl_mark = (st[0], st[1]) if st else None
+
+    def _replay_jsonl(self, metadata, mark):
+        st = _stamp(METADATA_JSONL_PATH)
+        if st is None or mark is None or st[0] != mark[0] or st[1] < mark[1]:
+            return None
+        offset = mark[1]
+        if st[1] > offset:
+            try:
+                with open(METADATA_JSONL_PATH, "rb") as f:
+                    f.seek(offset)
+                    for raw in f:
+                        if not raw.endswith(b"\n"):
+                            break
+                        offset += len(raw)
+                        try:
+                            record = json.loads(raw)
+                        except (json.JSONDecodeError, UnicodeDecodeError):
+                            continue
+                        if "name" in record and "metadata" in record:
+                            metadata[record["name"]] = record["metadata"]
+            except OSError:
+                return None
+        self.jsonl_mark = (st[0], offset)
+        return metadata
+
+    def frequency(self):
+        part = self.data.get("freq")
+        if part and part["freq"] is not None and part["stamp"] == self._freq_stamp():
+            self.warm.append("play counts")
+            return part["freq"]
+        return load_frequency()
+
+    @staticmethod
+    def _freq_stamp():
+        return (_stamp(FREQ_CSV_PATH), _stamp(PLAY_LOG_PATH))
+
+    # --- write ---
+
+    def save(self, library, musics, metadata, freq):
+        """
+        写快照。调用前 library 须已 save()、freq 须已落盘，
+        这样各部分的 stamp 与其源文件内容一致。
+        """
+        data = {"version": SNAPSHOT_VERSION}
+        with library.lock:
+            if not library.dirty:
+                data["library"] = {
+                    "stamp": _stamp(LIBRARY_INDEX_PATH),
+                    "roots": list(library.roots),
+                    "dirs": dict(library.dirs),
+                    "files": dict(library.files),
+                    "catalog": dict(library.catalog),
+                    "keys": dict(library.keys),
+                    "musics": dict(musics),
+                }
+        if isinstance(metadata, dict) and self.jsonl_mark is not None:
+            data["metadata"] = {"mark": self.jsonl_mark, "metadata": dict(metadata)}
+        if freq is not None:
+            data["freq"] = {"stamp": self._freq_stamp(), "freq": freq}
+
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+        except (OSError, pickle.PicklingError) as e:
+            log(f"[yellow]⚠️ Failed to write startup snapshot: {e}[/]")
@@ -0,0 +1,84 @@
+"""Stable numeric song IDs for the compact prompt protocol.
+
+With ``preferences.song_ids`` on, library / candidate lines are written as
+``#12 | name | tags`` and the model answers with bare IDs (``12``), so the
+reply costs a few tokens per song and ``parse_raw_playlist`` resolves each
+line with a dict lookup instead of a fuzzy search.  Lines that are not an
+ID still go through the fuzzy matcher.
+
+IDs are assigned on first use and never reused, and the map is persisted in
+``SONG_IDS_PATH`` so a song keeps its ID across sessions (and prompt caches).
+"""
+import os
+import re
+import json
+import threading
+from core.log import log
+from core.config import SONG_IDS_PATH
+
+IDS_VERSION = 1
+
+# 模型可能写成 "12"、"#12"、"[12]"、"12." 或 "#12 | 歌名"
+ID_LINE = re.compile(r"^\[?#?(\d+)\]?\.?(?:\s*\|.*)?$")
+
+
+class SongIdMap:
+    """{name: id} 及其反向表，只增不减，原子写入 JSON"""
+
+    def __init__(self, path=SONG_IDS_PATH):
+        self.path = path
+        self.ids = {}
+        self.names = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path=SONG_IDS_PATH):
+        id_map = cls(path)
+        if not os.path.exists(path):
+            return id_map
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == IDS_VERSION:
+                id_map.ids = {name: int(sid) for name, sid in data.get("ids", {}).items()}
+                id_map.names = {sid: name for name, sid in id_map.ids.items()}
+                id_map.next_id = max(data.get("next_id", 1), max(id_map.names, default=0) + 1)
+        except (OSError, json.JSONDecodeError, ValueError, AttributeError) as e:
+            log(f"[yellow]⚠️ Failed to read {path}: {e}[/]")
+        return id_map
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {"version": IDS_VERSION, "next_id": self.next_id, "ids": dict(self.ids)}
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as e:
+            log(f"[red]❌ Failed to save song id map: {e}[/]")
+
+    def id_for(self, name):
+        """name 的 ID，没有则分配一个新的"""
+        with self.lock:
+            sid = self.ids.get(name)
+            if sid is None:
+                sid = self.next_id
+                self.next_id += 1
+                self.ids[name] = sid
+                self.names[sid] = name
+                self.dirty = True
+            return sid
+
+    def name_for(self, sid):
+        return self.names.get(sid)
+
+    def lookup(self, line):
+        """回复中的一行 → 歌名；不是 ID 或 ID 未知时返回 None"""
+        m = ID_LINE.match(line.strip())
+        return self.names.get(int(m.group(1))) if m else None
@@ -0,0 +1,123 @@
+"""Embedded tags + duration via mutagen, cached in the library index.
+
+``index_tags`` reads title / artist / album / genre / duration (and whether
+the file carries embedded lyrics) for every indexed file that has not been
+read yet, in parallel, and stores them under ``LibraryIndex.files[path]["tags"]``.
+Metadata sync uses them to skip the NCM search when a file already has its
+own lyrics, search by "title artist" instead of the file stem, and skip
+asking the LLM for a genre the tags already state.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import mutagen
+from core.log import log
+
+TAG_WORKERS = 8
+
+# 各格式的字段名：ID3 帧 / Vorbis comment / MP4 atom
+_FIELDS = {
+    "title":  ("TIT2", "title", "\xa9nam"),
+    "artist": ("TPE1", "artist", "\xa9ART"),
+    "album":  ("TALB", "album", "\xa9alb"),
+    "genre":  ("TCON", "genre", "\xa9gen"),
+}
+_LYRIC_KEYS = ("lyrics", "unsyncedlyrics", "LYRICS", "UNSYNCEDLYRICS", "\xa9lyr")
+
+# 这些 genre 标签等于没写
+_JUNK_GENRES = {"", "other", "others", "unknown", "genre", "misc", "none", "null", "未知", "其他"}
+
+
+def _first(value):
+    if value is None:
+        return None
+    if hasattr(value, "genres"):     # ID3 TCON: "(13)" → "Pop"
+        value = value.genres
+    elif hasattr(value, "text"):     # 其他 ID3 文本帧
+        value = value.text
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    s = str(value).strip() if value is not None else ""
+    return s or None
+
+
+def _get(tags, key):
+    try:
+        return tags.get(key)
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def _lyrics_from(tags):
+    if hasattr(tags, "getall"):  # ID3
+        for frame in tags.getall("USLT"):
+            if frame.text and frame.text.strip():
+                return frame.text
+        return None
+    for key in _LYRIC_KEYS:
+        text = _first(_get(tags, key))
+        if text:
+            return text
+    return None
+
+
+def read_tags(path):
+    """{"title", "artist", "album", "genre", "duration", "has_lyrics"} 中能读到的部分；读不了返回 {}"""
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return {}
+    if audio is None:
+        return {}
+    result = {}
+    length = getattr(getattr(audio, "info", None), "length", None)
+    if length:
+        result["duration"] = round(float(length), 2)
+    tags = audio.tags
+    if tags:
+        for field, keys in _FIELDS.items():
+            for key in keys:
+                value = _first(_get(tags, key))
+                if value:
+                    result[field] = value
+                    break
+        if _lyrics_from(tags):
+            result["has_lyrics"] = True
+    return result
+
+
+def embedded_lyrics(path):
+    """文件内嵌歌词（ID3 USLT / Vorbis LYRICS / MP4 ©lyr），没有则返回 None"""
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return None
+    if audio is None or not audio.tags:
+        return None
+    return _lyrics_from(audio.tags)
+
+
+def reliable_genre(tags):
+    """标签里的 genre 可直接采用时返回它，否则 None（ID3v1 数字编号、占位词等）"""
+    genre = (tags or {}).get("genre")
+    if not genre or genre.strip().lower() in _JUNK_GENRES or genre.strip("() ").isdigit():
+        return None
+    return genre.strip()
+
+
+def index_tags(library, workers=TAG_WORKERS):
+    """并行读取索引中尚未读过标签的文件，写入 files[path]["tags"]，返回读取数量"""
+    with library.lock:
+        todo = [p for p, st in library.files.items() if "tags" not in st]
+    if not todo:
+        return 0
+    if len(todo) > 200:
+        log(f"[dim]🏷️  Reading tags of {len(todo)} tracks...[/]")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(read_tags, todo))
+
+    with library.lock:
+        for p, tags in zip(todo, results):
+            if p in library.files:
+                library.files[p]["tags"] = tags
+        library.dirty = True
+    return len(todo)
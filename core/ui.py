@@ -57,9 +57,24 @@ def print_dj_intro(intro_text):
             padding=(1, 2)
         ))
 
-def print_playlist(playlist, metadata, title_suffix="List"):
-    t = Table(show_header=True, title=f"Playlist ({len(playlist)}) - {title_suffix}", show_lines=True)
+def fmt_duration(seconds):
+    """123.4 → "2:03"；一小时以上 → "1:02:03"；未知 → "-" """
+    if seconds is None:
+        return "-"
+    seconds = int(round(seconds))
+    h, rem = divmod(seconds, 3600)
+    m, sec = divmod(rem, 60)
+    return f"{h}:{m:02d}:{sec:02d}" if h else f"{m}:{sec:02d}"
+
+def print_playlist(playlist, metadata, title_suffix="List", durations=None):
+    durations = durations or {}
+    lengths = [durations.get(item['name']) for item in playlist]
+    known = [d for d in lengths if d is not None]
+    total = f" · {fmt_duration(sum(known))}" if known else ""
+    t = Table(show_header=True, title=f"Playlist ({len(playlist)}{total}) - {title_suffix}", show_lines=True)
     t.add_column("Track", style="bold green", no_wrap=True)
+    if known:
+        t.add_column("Length", style="dim", justify="right")
     t.add_column("Language", style="cyan")
     t.add_column("Genre", style="magenta")
     t.add_column("Emotion", style="yellow")
@@ -70,12 +85,13 @@ def print_playlist(playlist, metadata, title_suffix="List"):
         if isinstance(val, list): return ", ".join(str(x) for x in val)
         return str(val)
 
-    for item in playlist:
+    for item, length in zip(playlist, lengths):
         name = item['name']
         info = metadata.get(name, {})
 
+        row = [name] + ([fmt_duration(length)] if known else [])
         t.add_row(
-            name, 
+            *row,
             safe_fmt(info.get('language')), 
             safe_fmt(info.get('genre')), 
             safe_fmt(info.get('emotion')), 
@@ -101,11 +117,14 @@ def print_status(config, ai_settings, playlist_len):
     trigger = pref.get('saved_trigger') or "OFF"
     mf = config.get('music_folders', [])
     mf_label = f"{len(mf)} folders" if mf else "None"
+    watch = pref.get('library_watch', False)
 
     playback_rows = [
         fmt_row("DBus Target", dbus_tgt),
         fmt_row("Saved Trigger", trigger),
         fmt_row("Music Folders", mf_label),
+        fmt_row("Library Watch", on_off(watch, "WATCHING", "off")),
+        fmt_row("Metadata Store", pref.get('metadata_backend', 'jsonl')),
         fmt_row("Playlist Cache", f"{playlist_len} tracks"),
     ]
     sections = [make_section("🔊 PLAYBACK", playback_rows)]
@@ -129,11 +148,16 @@ def print_status(config, ai_settings, playlist_len):
     # --- AI ---
     model = pref.get('model') or "default"
     conc = pref.get('metadata_concurrency', 1)
+    lib_mode = pref.get('library_mode', 'full')
     ai_rows = [
         fmt_row("API Endpoint", ai_settings.get('base_url', '—')),
         fmt_row("Chat Model", model),
         fmt_row("Metadata Model", ai_settings.get('metadata_model', '—')),
-        fmt_row("Sync Concurrency", str(conc)),
+        fmt_row("Sync Concurrency", f"{conc} (adaptive, ≤16)"),
+        fmt_row("Sync Batch Size", str(pref.get('metadata_batch', 1))),
+        fmt_row("Library Mode", lib_mode if lib_mode != "retrieval"
+                else f"retrieval (top {pref.get('retrieval_k', 200)})"),
+        fmt_row("Song ID Protocol", on_off(pref.get('song_ids', False))),
     ]
     sections.append(make_section("🧠 AI", ai_rows, border="magenta"))
 
@@ -174,6 +198,22 @@ def print_metadata(name, data):
         t.add_row("Raw Data", str(data))
     console.print(t)
 
+def print_llm_latency(title, stats, key_label):
+    """llm_metrics.by_model() / by_command() 的表格：TTFT、总耗时 p50/p95，tok/s，缓存，错误"""
+    def secs(v):
+        return f"{v:.2f}s" if v is not None else "—"
+
+    t = Table(title=title, border_style="magenta")
+    t.add_column(key_label, style="bold cyan")
+    for col in ("Calls", "TTFT p50", "TTFT p95", "Total p50", "Total p95", "tok/s", "Cached", "Errors"):
+        t.add_column(col, justify="right")
+    for key, st in stats.items():
+        tps = f"{st['tps_p50']:.0f}" if st['tps_p50'] is not None else "—"
+        errors = f"[red]{st['errors']}[/]" if st['errors'] else "0"
+        t.add_row(key, str(st['calls']), secs(st['ttft_p50']), secs(st['ttft_p95']),
+                  secs(st['total_p50']), secs(st['total_p95']), tps, str(st['cached']), errors)
+    console.print(t)
+
 def print_active_players(players, preferred_target):
     t = Table(title="📡 Active Players")
     t.add_column("Name")
@@ -0,0 +1,359 @@
+"""Live library watcher — inotify (via ctypes, Linux only) + background ingest.
+
+New audio files dropped into ``music_folders`` (e.g. by tools/download_music)
+become requestable right away: they are added to ``DJSession.music_paths`` and
+the library index in place, then queued for metadata sync, lyric fetch and
+loudness analysis on a single background worker.
+"""
+import os
+import sys
+import time
+import queue
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import requests
+from core.log import log
+from core.config import MUSIC_EXTS, append_metadata_jsonl
+from core.analyse import normalise_record
+from core import ncm
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# 文件最后一次修改后需静置多久才开始 ingest（下载器可能会二次写入标签）
+SETTLE_SECONDS = 2.0
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None and sys.platform.startswith("linux"):
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            lib.inotify_init1  # 确认符号存在
+            _libc = lib
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+def watcher_available():
+    return _get_libc() is not None
+
+
+def _fetch_lyrics(name):
+    """NCM 搜索 + 下载歌词，写入 LYRICS_DIR/<文件名>.lrc（与 tools/lyrics_sync.py 一致）"""
+    try:
+        return ncm.download_lyric(name) is not None
+    except (requests.RequestException, ValueError, KeyError):
+        return False
+
+
+class LibraryWatcher:
+    """Watches every indexed music directory and ingests new files in the background."""
+
+    def __init__(self, aidj, library, config, get_freq=None):
+        self.aidj = aidj
+        self.library = library
+        self.config = config
+        # 返回会话中正在使用的播放次数（ctx._freq，可能为 None）；改名迁移必须改它，
+        # 否则退出时 save_frequency 会用旧数据覆盖 frequency.csv
+        self.get_freq = get_freq or (lambda: None)
+        self._fd = None
+        self._wds = {}          # wd -> directory
+        self._queue = queue.Queue()
+        self._pending = set()   # 已排队但尚未 ingest 的路径（去重）
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self.ingested = 0
+
+    @property
+    def running(self):
+        return self._fd is not None
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    @property
+    def watch_count(self):
+        return len(self._wds)
+
+    def start(self):
+        libc = _get_libc()
+        if libc is None:
+            raise OSError("inotify is not available on this platform")
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._fd = fd
+        self._stop.clear()
+        with self.library.lock:
+            dirs = list(self.library.dirs)
+        for d in dirs:
+            self._add_watch(d)
+        for target in (self._event_loop, self._ingest_loop):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self._threads.append(t)
+        return len(self._wds)
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=2)
+        self._threads = []
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._wds.clear()
+
+    def _add_watch(self, d):
+        wd = _get_libc().inotify_add_watch(self._fd, os.fsencode(d), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            log(f"[yellow]⚠️ Cannot watch {d}: {os.strerror(err)}[/]")
+            return False
+        self._wds[wd] = d
+        return True
+
+    # --- inotify thread ---
+
+    def _event_loop(self):
+        while not self._stop.is_set():
+            try:
+                ready, _, _ = select.select([self._fd], [], [], 0.5)
+                if not ready:
+                    continue
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError, TypeError):
+                break  # fd 已关闭
+
+            offset = 0
+            while offset + _EVENT.size <= len(buf):
+                wd, mask, _cookie, length = _EVENT.unpack_from(buf, offset)
+                raw_name = buf[offset + _EVENT.size: offset + _EVENT.size + length]
+                offset += _EVENT.size + length
+                try:
+                    self._handle(wd, mask, os.fsdecode(raw_name.rstrip(b"\0")))
+                except Exception as e:
+                    log(f"[dim]⚠️ Watcher event error: {e}[/]")
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log("[yellow]⚠️ Watcher queue overflow — run [bold]sync[/] to catch up.[/]")
+            return
+        if mask & IN_IGNORED:
+            self._wds.pop(wd, None)
+            return
+        d = self._wds.get(wd)
+        if d is None or not name:
+            return
+        path = os.path.join(d, name)
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unwatch_tree(path)
+            return
+
+        if not name.lower().endswith(MUSIC_EXTS):
+            return
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._on_added(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._on_removed(path)
+
+    def _watch_tree(self, root):
+        """新目录：加 watch，并收录其中已存在的文件（整目录移入时不会有逐文件事件）"""
+        for cur, subdirs, files in os.walk(root):
+            self._add_watch(cur)
+            for f in files:
+                if f.lower().endswith(MUSIC_EXTS):
+                    self._on_added(os.path.join(cur, f))
+
+    def _unwatch_tree(self, root):
+        """目录被删除 / 移出：其下曲目全部下架，并撤掉相关 watch"""
+        prefix = root.rstrip(os.sep) + os.sep
+        for wd, d in list(self._wds.items()):
+            if d == root or d.startswith(prefix):
+                _get_libc().inotify_rm_watch(self._fd, wd)  # 已删除的目录会返回 EINVAL，忽略
+                self._wds.pop(wd, None)
+        for path in self.library.forget_tree(root):
+            self._on_removed(path)
+
+    def _key_of(self, path):
+        """music_paths 中指向 path 的 song key；调用方持有 aidj.lock"""
+        for key, p in self.aidj.music_paths.items():
+            if p == path:
+                return key
+        return None
+
+    def _on_added(self, path):
+        if not self.library.record_file(path):
+            return
+        with self.aidj.lock:
+            # 与 LibraryIndex.music_files 相同的命名：沿用已分配的 key，
+            # stem 已被别的文件占用时用 "stem (父目录名)"
+            name = self._key_of(path)
+            is_new = name is None
+            if is_new:
+                name = self.library.assign_key(path, self.aidj.music_paths)
+                self.aidj.music_paths[name] = path
+                self.aidj.library_version += 1
+        with self._pending_lock:
+            if path in self._pending:
+                return
+            self._pending.add(path)
+        self._queue.put(path)
+        if is_new:
+            log(f"[dim]📥 New track detected: {name}[/]")
+
+    def _on_removed(self, path):
+        self.library.forget_file(path)
+        with self.aidj.lock:
+            name = self._key_of(path)
+            if name is not None:
+                del self.aidj.music_paths[name]
+                self.aidj.library_version += 1
+                log(f"[dim]🗑️  Track removed: {name}[/]")
+
+    # --- ingest thread ---
+
+    def _ingest_loop(self):
+        while not self._stop.is_set():
+            try:
+                path = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            # 等待文件静置，避免下载器还在写标签
+            try:
+                age = time.time() - os.path.getmtime(path)
+            except OSError:
+                with self._pending_lock:
+                    self._pending.discard(path)
+                continue
+            if age < SETTLE_SECONDS:
+                self._stop.wait(SETTLE_SECONDS - age)
+
+            with self._pending_lock:
+                self._pending.discard(path)
+            try:
+                self._ingest_one(path)
+            except Exception as e:
+                log(f"[yellow]⚠️ Ingest failed for {os.path.basename(path)}: {e}[/]")
+            self.library.save()
+
+    def _ingest_one(self, path):
+        from core.dj_core import fetch_song_metadata
+        from core.catalog import adopt, content_hash
+        from core.tags import read_tags
+
+        with self.aidj.lock:
+            name = self._key_of(path)
+        if name is None:
+            return  # 静置期间已被删除 / 移走
+        steps = []
+
+        # 与 music_files() 一致：内容相同的副本只保留已在库中的那份
+        h = content_hash(path)
+        duplicate = self._duplicate_of(path, h)
+        if duplicate:
+            with self.aidj.lock:
+                if self.aidj.music_paths.get(name) == path:
+                    del self.aidj.music_paths[name]
+                    self.aidj.library_version += 1
+            with self.library.lock:
+                if path in self.library.files:
+                    self.library.files[path]["hash"] = h
+                    self.library.dirty = True
+            log(f"[dim]♊ {os.path.basename(path)} is a copy of {os.path.basename(duplicate)} — not added.[/]")
+            return
+
+        tags = read_tags(path)
+        with self.library.lock:
+            if path in self.library.files:
+                self.library.files[path]["tags"] = tags
+                self.library.dirty = True
+        if "duration" in tags:
+            with self.aidj.lock:
+                self.aidj.durations[name] = tags["duration"]
+
+        # 改名 / 移动过来的已知内容：直接沿用旧名下的数据
+        with self.aidj.lock:
+            old_name = adopt(self.library, path, name, self.aidj.metadata, self.get_freq(), h=h)
+        if old_name:
+            steps.append(f"carried over from '{old_name}'")
+            self.aidj.announce_additions([name])
+
+        if name not in self.aidj.metadata:
+            model = self.config['ai_settings'].get('metadata_model', 'deepseek-chat')
+            meta = fetch_song_metadata(self.aidj.client, name, model, path, tags)
+            if meta:
+                normalise_record(meta)
+                with self.aidj.lock:
+                    self.aidj.metadata[name] = meta
+                append_metadata_jsonl(name, meta)
+                self.aidj.announce_additions([name])
+                steps.append("metadata")
+
+        if _fetch_lyrics(name):
+            steps.append("lyrics")
+
+        if self.config['preferences'].get('dynamic_balance_volume', False):
+            from core.loudness import prewarm
+            if prewarm(path) is not None:
+                steps.append("loudness")
+
+        self.ingested += 1
+        done = ", ".join(steps) if steps else "no metadata found"
+        log(f"[green]✨ Ingested:[/] [bold]{name}[/] [dim]({done})[/]")
+
+    def _duplicate_of(self, path, h):
+        """库中（仍可点播的）另一个内容 hash 相同的文件，没有返回 None"""
+        if not h:
+            return None
+        with self.library.lock:
+            others = [p for p, st in self.library.files.items() if p != path and st.get("hash") == h]
+        if not others:
+            return None
+        with self.aidj.lock:
+            live = set(self.aidj.music_paths.values())
+        return next((p for p in others if p in live), None)
+
+
+def start_watcher(aidj, library, config, get_freq=None):
+    """Create + start a watcher; logs and returns None when inotify is unavailable."""
+    if not watcher_available():
+        log("[yellow]⚠️ Library watch needs Linux inotify — not available here.[/]")
+        return None
+    watcher = LibraryWatcher(aidj, library, config, get_freq)
+    try:
+        count = watcher.start()
+    except OSError as e:
+        log(f"[red]❌ Failed to start library watcher: {e}[/]")
+        return None
+    log(f"[green]👀 Watching {count} music directories for new files.[/]")
+    return watcher
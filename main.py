@@ -7,13 +7,21 @@ import questionary
 # [新增] 引入 Completer 接口
 from prompt_toolkit.completion import WordCompleter, Completer 
 from prompt_toolkit.history import FileHistory
+from prompt_toolkit.patch_stdout import patch_stdout
 from questionary import Style
 from datetime import datetime
 
 # 引入模块
 from core.log import set_log_fn
-from core.config import load_config, CFG_KEY_MF, ensure_playlist_dir
-from core.dj_core import DJSession, scan_music_files, load_cached_metadata, sync_metadata
+from core.config import load_config, CFG_KEY_MF, ensure_playlist_dir, flush_metadata_jsonl, renormalise_metadata
+from core.dj_core import DJSession
+from core.metasync import BackgroundSync
+from core.library import diff_summary
+from core.catalog import reconcile, reconcile_summary
+from core.watcher import start_watcher
+from core.snapshot import RuntimeSnapshot
+from core.tags import index_tags
+from core.failures import FailureLedger
 from games.wait_games import run_waiting_game
 from core.player import DBusManager
 import core.ui as ui
@@ -96,32 +104,76 @@ def main():
     client = openai.OpenAI(api_key=api_key, base_url=base_url)
     dbus_manager = DBusManager(preferred_target=config['preferences'].get('dbus_target'))
     
-    # 2. 准备数据
-    musics = scan_music_files(config.get(CFG_KEY_MF, []))
-    metadata = load_cached_metadata()
+    # 2. 准备数据（warm start：源文件未变的部分直接取自快照；增量扫描只重新列出 mtime 变化的目录）
+    backend = config["preferences"].get("metadata_backend", "jsonl")
+    snapshot = RuntimeSnapshot()
+    snapshot.load()
+    library = snapshot.library()
+    first_scan = not library.files
+    diff = library.rescan(config.get(CFG_KEY_MF, []))
+    metadata = snapshot.metadata(backend)
+    # 预计算的规范化标签：映射表变化时批量重算并重写；个别旧记录只追加
+    _, rewritten = renormalise_metadata(metadata)
+    if rewritten:
+        snapshot.jsonl_rewritten()
+    # 内容 hash：去重，并把改名/移动的曲目接回已有的 metadata / 播放次数 / 歌词
+    report = reconcile(library, metadata)
+    # 内嵌标签 / 时长：只读取尚未读过的文件（并行）
+    index_tags(library)
+    library_changed = library.dirty
+    musics = snapshot.music_files(library)
+    library.save()
+    if snapshot.warm:
+        console.print(f"[dim]⚡ Warm start from snapshot ({', '.join(snapshot.warm)})[/]")
+    if first_scan:
+        console.print(f"[dim]📂 Library index built ({len(musics)} tracks)[/]")
+    elif diff_summary(diff):
+        console.print(diff_summary(diff))
+    for line in reconcile_summary(report):
+        console.print(line)
     
-    # 3. 元数据同步
-    missing = {k:v for k,v in musics.items() if k not in metadata}
-    if missing:
-        model = ai_settings.get("metadata_model", "deepseek-chat")
-        metadata = sync_metadata(client, missing, metadata, model,
-                                  concurrency=config['preferences'].get('metadata_concurrency', 1))
+    # 3. 待同步的元数据（近期失败过、尚未到期的曲目跳过，见 failed 命令）
+    failures = FailureLedger.load()
+    failures.prune(musics)
+    missing, known_bad = failures.split({k:v for k,v in musics.items() if k not in metadata})
+    if known_bad:
+        console.print(f"[dim]⏭️  Skipping {len(known_bad)} songs that failed recently (see [bold]failed[/bold])[/]")
+    failures.save()
     
     ensure_playlist_dir()
     
     # 4. 创建 Session
     aidj = DJSession(client, metadata, musics, config, inject_pre, run_waiting_game, inject_aft)
+    aidj.durations = library.durations(musics)
     
     # 5. 构建 Context
-    ctx = Context(aidj, dbus_manager, config)
+    ctx = Context(aidj, dbus_manager, config, library=library)
+    ctx.failures = failures
 
     # 5.1 如果 record_freq 已启用，加载频率数据
     if config['preferences'].get('record_freq', False):
-        from core.config import load_frequency
-        ctx._freq = load_frequency()
+        ctx._freq = snapshot.frequency()
         console.print(f"[green]📊 Frequency tracking loaded ({len(ctx._freq)} songs)[/]")
     else:
         ctx._freq = None
+
+    # 5.2 冷启动 / 曲库有变化：立即刷新快照，下次启动即为 warm start
+    if library_changed or "library" not in snapshot.warm or (backend == "jsonl" and "metadata" not in snapshot.warm):
+        snapshot.save(library, musics, metadata, ctx._freq)
+
+    # 5.3 元数据同步在后台进行：REPL 立即可用，已同步的歌曲马上能点
+    if missing:
+        ctx.sync_job = BackgroundSync(
+            aidj, missing, ai_settings.get("metadata_model", "deepseek-chat"),
+            concurrency=config['preferences'].get('metadata_concurrency', 1),
+            tags={k: library.tags(p) for k, p in missing.items()},
+            batch_size=config['preferences'].get('metadata_batch', 1),
+            ledger=failures,
+        ).start()
+
+    # 5.4 曲库监视：新文件自动入库
+    if config['preferences'].get('library_watch', False):
+        ctx.watcher = start_watcher(aidj, library, config, lambda: ctx._freq)
     
     # 6. UI Banner
     ui.print_banner(config, musics, metadata)
@@ -146,15 +198,18 @@ def main():
             freq_on = config['preferences'].get('record_freq', False)
             trig_part = f"[⚡ {curr_trig}] " if curr_trig else ""
             freq_part = "[●] " if freq_on else ""
-            prefix = trig_part + freq_part
+            sync_part = ctx.sync_job.prompt_prefix() if ctx.sync_job else ""
+            prefix = sync_part + trig_part + freq_part
             
-            user_input = questionary.text(
-                f"{prefix}AIDJ >",
-                qmark="🎤",
-                style=style,
-                history=history,
-                completer=smart_completer # [修改] 使用智能补全器
-            ).ask()
+            # patch_stdout: 后台线程（watcher 等）的输出打印在输入行上方，不会打乱提示符
+            with patch_stdout(raw=True):
+                user_input = questionary.text(
+                    f"{prefix}AIDJ >",
+                    qmark="🎤",
+                    style=style,
+                    history=history,
+                    completer=smart_completer # [修改] 使用智能补全器
+                ).ask()
             
             if user_input is None: 
                 console.print("[bold red]👋 Bye![/]")
@@ -173,5 +228,22 @@ def main():
             console.print(f"[red]CRITICAL ERROR: {e}[/]")
             traceback.print_exc()
 
+    if ctx.sync_job:
+        ctx.sync_job.stop()
+    if ctx.watcher:
+        ctx.watcher.stop()
+    flush_metadata_jsonl(fsync=True)
+    library.save()
+    if ctx._freq:
+        from core.config import save_frequency
+        save_frequency(ctx._freq)
+    # 批量同步可能超过 stop() 的等待时间仍在写 metadata：在锁内拷一份再 pickle。
+    # sqlite 后端不进快照，不必把整库读进内存
+    metadata = None
+    if backend == "jsonl":
+        with ctx.aidj.lock:
+            metadata = dict(ctx.aidj.metadata)
+    snapshot.save(library, library.music_files(), metadata, ctx._freq)
+
 if __name__ == "__main__":
     main()
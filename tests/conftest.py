@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 仓库不是安装包：让 tests 能直接 import core.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
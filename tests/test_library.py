@@ -0,0 +1,68 @@
+import os
+import pytest
+from core.library import LibraryIndex
+
+
+def _touch(path, data=b"audio"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def root(tmp_path):
+    return str(tmp_path / "music")
+
+
+def _index(tmp_path):
+    return LibraryIndex(str(tmp_path / "library_index.json"))
+
+
+def test_rescan_detects_move(tmp_path, root):
+    src, dst = os.path.join(root, "a", "song.mp3"), os.path.join(root, "b", "renamed.mp3")
+    _touch(src)
+    _touch(os.path.join(root, "b", "other.flac"), b"other")
+    index = _index(tmp_path)
+    diff = index.rescan([root])
+    assert sorted(diff["added"]) == sorted([src, os.path.join(root, "b", "other.flac")])
+
+    os.renames(src, dst)  # rename 保留 size / mtime
+    _touch(os.path.join(root, "c", "new.mp3"), b"new!")
+    diff = index.rescan([root])
+    assert diff["moved"] == [(src, dst)]
+    assert diff["added"] == [os.path.join(root, "c", "new.mp3")]
+    assert diff["removed"] == []
+
+
+def test_rescan_detects_removal(tmp_path, root):
+    path = os.path.join(root, "gone.mp3")
+    _touch(path)
+    index = _index(tmp_path)
+    index.rescan([root])
+    os.remove(path)
+    diff = index.rescan([root])
+    assert diff["removed"] == [path] and not diff["moved"] and not diff["added"]
+
+
+def test_rescan_skips_symlink_loops_and_bare_extensions(tmp_path, root):
+    _touch(os.path.join(root, "a", "song.mp3"))
+    _touch(os.path.join(root, "a", "mp3"))
+    os.symlink("..", os.path.join(root, "a", "loop"))
+    index = _index(tmp_path)
+    index.rescan([root])
+    assert list(index.files) == [os.path.join(root, "a", "song.mp3")]
+
+
+def test_song_keys_are_stable_across_scans(tmp_path, root):
+    old = os.path.join(root, "b", "song.mp3")
+    _touch(old)
+    index = _index(tmp_path)
+    index.rescan([root])
+    assert index.music_files() == {"song": old}
+    index.save()
+
+    new = os.path.join(root, "a", "song.mp3")  # 扫描顺序排在旧文件之前
+    _touch(new, b"different")
+    index = LibraryIndex.load(index.path)
+    index.rescan([root])
+    assert index.music_files() == {"song": old, "song (a)": new}
@@ -0,0 +1,40 @@
+from core.matcher import PlaylistMatcher, normalise_key
+
+KEYS = ["周杰伦 - 晴天", "Coldplay - Yellow", "ＡＢＣ Song", "後來", "Don't Stop Me Now"]
+
+
+def test_normalise_key():
+    assert normalise_key("ＡＢＣ Song") == "abc song"
+    assert normalise_key("後來") == normalise_key("后来")
+    assert normalise_key("Don't  Stop—Me Now!") == "dont stop me now"
+
+
+def test_match_passes():
+    matcher = PlaylistMatcher(KEYS)
+    lines = [
+        "Coldplay - Yellow",      # exact
+        "abc song",               # 全角 / 大小写
+        "后来",                    # 繁简
+        "Dont Stop Me Now",       # 标点
+        "Coldplay - Yelow",       # 拼写错误 → fuzzy
+        "completely unrelated",   # 匹配不上
+    ]
+    assert matcher.match(lines) == [
+        ("Coldplay - Yellow", "exact"),
+        ("ＡＢＣ Song", "normalised"),
+        ("後來", "normalised"),
+        ("Don't Stop Me Now", "normalised"),
+        ("Coldplay - Yellow", "fuzzy"),
+        (None, None),
+    ]
+
+
+def test_ambiguous_normalised_keys_fall_back_to_fuzzy():
+    matcher = PlaylistMatcher(["Hello", "hello!"])
+    assert "hello" not in matcher.normalised
+    key, how = matcher.match(["Hello!!"])[0]
+    assert key in ("Hello", "hello!") and how == "fuzzy"
+
+
+def test_empty_library():
+    assert PlaylistMatcher([]).match(["anything"]) == [(None, None)]
@@ -0,0 +1,37 @@
+import json
+from core.config import compact_metadata_jsonl, _read_metadata_jsonl
+
+
+def _write(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for name, meta in records:
+            f.write(json.dumps({"name": name, "metadata": meta}, ensure_ascii=False) + "\n")
+        f.write("not json\n\n")
+
+
+def test_compact_keeps_last_record_per_song(tmp_path):
+    path = str(tmp_path / "meta.jsonl")
+    _write(path, [("a", {"v": 1}), ("b", {"v": 1}), ("a", {"v": 2}), ("c", {"v": 1}), ("b", {"v": 3})])
+
+    stats = compact_metadata_jsonl(path)
+
+    assert stats["lines_before"] == 6 and stats["lines_after"] == 3
+    assert stats["bytes_after"] < stats["bytes_before"]
+    metadata, lines = _read_metadata_jsonl(path)
+    assert metadata == {"a": {"v": 2}, "c": {"v": 1}, "b": {"v": 3}}
+    assert lines == 3
+
+
+def test_compact_is_idempotent(tmp_path):
+    path = str(tmp_path / "meta.jsonl")
+    _write(path, [("x", {"genre": "Rock"}), ("x", {"genre": "Pop"})])
+    compact_metadata_jsonl(path)
+    with open(path, encoding="utf-8") as f:
+        first = f.read()
+    compact_metadata_jsonl(path)
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == first
+
+
+def test_compact_missing_file(tmp_path):
+    assert compact_metadata_jsonl(str(tmp_path / "nope.jsonl")) is None
@@ -0,0 +1,60 @@
+"""parse_raw_playlist (whole reply) vs PlaylistStream (chunk by chunk) must pick the same songs."""
+import re
+import pytest
+from core.config import SEPARATOR
+from core.dj_core import DJSession, PlaylistStream
+
+SONGS = ["晴天", "Yellow", "Bohemian Rhapsody", "夜に駆ける", "Shape of You"]
+
+
+@pytest.fixture
+def session():
+    metadata = {name: {"genre": "Pop"} for name in SONGS}
+    music_paths = {name: f"/music/{name}.mp3" for name in SONGS}
+    return DJSession(None, metadata, music_paths, {"preferences": {"verbose": False}}, None, None, None)
+
+
+def _clean(raw):
+    # 与 next_step 相同：完整回复先去掉 <think> 再交给 parse_raw_playlist
+    text = re.sub(r'<think>.*?</think>', '', raw, flags=re.DOTALL)
+    return re.sub(r'<think>.*', '', text, flags=re.DOTALL).strip()
+
+
+def _stream(session, raw, chunk):
+    got = []
+    stream = PlaylistStream(session, lambda track: got.append(track["name"]))
+    for i in range(0, len(raw), chunk):
+        stream.feed(raw[i:i + chunk])
+    stream.finish()
+    return got
+
+
+REPLIES = [
+    f"Here you go!\n{SEPARATOR}\n晴天\nYellow\nBohemian Rhapsody\n",
+    f"No trailing newline\n{SEPARATOR}\n夜に駆ける\nShape of You",
+    f"<think>maybe use {SEPARATOR} then 晴天</think>Enjoy\n{SEPARATOR}\nYellow\n晴天\n",
+    f"Two lists\n{SEPARATOR}\nYellow\n{SEPARATOR}\nShape of You\n",
+    f"Fuzzy keys\n{SEPARATOR}\nyellow\nbohemian rhapsody\nnot a song at all\n晴天\n晴天\n",
+    "Just chatting, no playlist.",
+]
+
+
+@pytest.mark.parametrize("raw", REPLIES)
+@pytest.mark.parametrize("chunk", [1, 3, 7, 1000])
+def test_stream_matches_full_parse(session, raw, chunk):
+    playlist, _ = session.parse_raw_playlist(_clean(raw))
+    assert _stream(session, raw, chunk) == [track["name"] for track in playlist]
+
+
+def test_separator_inside_think_is_ignored(session):
+    raw = f"<think>{SEPARATOR}\nYellow\n</think>Intro\n{SEPARATOR}\n晴天\n"
+    assert _stream(session, raw, 5) == ["晴天"]
+    playlist, intro = session.parse_raw_playlist(_clean(raw))
+    assert [t["name"] for t in playlist] == ["晴天"]
+    assert intro == "Intro"
+
+
+def test_unmatched_lines_are_dropped(session):
+    playlist, intro = session.parse_raw_playlist(f"Hi\n{SEPARATOR}\n# comment\nzzzz qqqq\nYellow\n")
+    assert intro == "Hi"
+    assert playlist == [{"name": "Yellow", "path": "/music/Yellow.mp3"}]
@@ -3,10 +3,12 @@ import json
 import time
 import re
 import random
-import requests
 import glob
+import sys
 from pathlib import Path
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 # 尝试引入 Rich，如果环境没装则报错提示
 try:
     from rich.console import Console
@@ -16,14 +18,10 @@ except ImportError:
     print("请先安装 rich: pip install rich")
     exit(1)
 
-# 引入项目配置
-try:
-    from core.config import LYRICS_DIR, NCM_BASE_URL
-except ImportError:
-    #以此作为 fallback，防止单独运行找不到 config.py
-    LYRICS_DIR = "./data/lyrics"
-    NCM_BASE_URL = "http://localhost:3000"
-    CONFIG_FILE = "./data/config.json"
+# 引入项目模块（扫描器、NCM 客户端都来自 core，上面已把仓库根目录加入 sys.path）
+from core.config import LYRICS_DIR, CONFIG_PATH as CONFIG_FILE
+from core.library import scan_audio_files
+from core import ncm
 
 console = Console()
 
@@ -49,17 +47,8 @@ def load_library_paths():
 
 def scan_music_files(paths):
     """扫描所有路径下的音频文件"""
-    music_files = []
-    for p in paths:
-        if not os.path.exists(p):
-            continue
-        # 递归扫描
-        for root, dirs, files in os.walk(p):
-            for file in files:
-                if os.path.splitext(file)[1].lower() in AUDIO_EXTENSIONS:
-                    full_path = os.path.join(root, file)
-                    music_files.append(full_path)
-    return music_files
+    # 与主程序共用并行扫描器：多 root 并发，卡住的挂载点会被跳过
+    return scan_audio_files(paths, AUDIO_EXTENSIONS)
 
 def clean_filename(filename):
     """清洗文件名以便搜索 (移除扩展名、括号内容等)"""
@@ -74,31 +63,18 @@ def clean_filename(filename):
     # 移除多余空格
     return " ".join(name.split())
 
-def fetch_lyric_ncm(keyword):
-    """调用 NCM API 下载歌词"""
+def fetch_lyric_ncm(keyword, name=None):
+    """调用 NCM API 下载歌词（共用 core/ncm.py 的连接池、重试与 song id 缓存）"""
     try:
-        # 1. 搜索歌曲 ID
-        search_url = f"{NCM_BASE_URL}/search"
-        params = {"keywords": keyword, "limit": 1}
-        resp = requests.get(search_url, params=params, timeout=5)
-        data = resp.json()
-        
-        if data.get('code') != 200 or data['result']['songCount'] == 0:
+        # 1. 搜索歌曲 ID（主程序同步时按文件名解析过的直接复用）
+        song_id = ncm.resolve(name, [keyword])
+        if song_id is None:
             return None
-        
-        song_id = data['result']['songs'][0]['id']
-        
+
         # 2. 获取歌词
-        lrc_url = f"{NCM_BASE_URL}/lyric"
-        resp = requests.get(lrc_url, params={"id": song_id}, timeout=5)
-        lrc_data = resp.json()
-        
-        if lrc_data.get('code') == 200:
-            lyric = lrc_data.get('lrc', {}).get('lyric')
-            return lyric
+        return ncm.fetch_lyric(song_id)
     except Exception:
         return None
-    return None
 
 def main():
     console.clear()
@@ -162,7 +138,7 @@ def main():
             search_kw = clean_filename(file_name)
             
             # 下载
-            lyric_content = fetch_lyric_ncm(search_kw)
+            lyric_content = fetch_lyric_ncm(search_kw, os.path.splitext(file_name)[0])
             
             if lyric_content:
                 try:
@@ -16,9 +16,12 @@ import re
 import time
 import random
 import json
+import sys
 import requests
 from pathlib import Path
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 try:
     from rich.console import Console
     from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeRemainingColumn
@@ -27,11 +30,17 @@ except ImportError:
     print("请先安装 rich: uv sync")
     exit(1)
 
+# 引入项目模块（扫描器、HTTP 客户端都来自 core，上面已把仓库根目录加入 sys.path）
+from core.config import LYRICS_DIR, CONFIG_PATH as CONFIG_FILE
+from core.library import scan_audio_files
+from core.ncm import HttpClient
+
 LYRICA_BASE_URL = "http://localhost:2778"
-LYRICS_DIR = "./data/lyrics"
-CONFIG_FILE = "./data/config.json"
 AUDIO_EXTENSIONS = {'.mp3', '.flac', '.wav', '.m4a', '.ogg', '.opus'}
 
+# 与 NCM 客户端共用连接池 / 重试；Lyrica 抓取较慢，读超时放宽到 30s
+lyrica = HttpClient(LYRICA_BASE_URL, {"lyrics": (3.05, 30), "": (3.05, 3)})
+
 console = Console()
 
 
@@ -49,15 +58,8 @@ def load_library_paths():
 
 
 def scan_music_files(paths):
-    music_files = []
-    for p in paths:
-        if not os.path.exists(p):
-            continue
-        for root, dirs, files in os.walk(p):
-            for file in files:
-                if os.path.splitext(file)[1].lower() in AUDIO_EXTENSIONS:
-                    music_files.append(os.path.join(root, file))
-    return music_files
+    # 与主程序共用并行扫描器：多 root 并发，卡住的挂载点会被跳过
+    return scan_audio_files(paths, AUDIO_EXTENSIONS)
 
 
 def parse_artist_song(filename):
@@ -81,12 +83,10 @@ def parse_artist_song(filename):
 def fetch_lyric_lyrica(artist, song):
     """调用 Lyrica API 获取歌词 (带时间戳)"""
     try:
-        resp = requests.get(
-            f"{LYRICA_BASE_URL}/lyrics/",
+        data = lyrica.get_json(
+            "lyrics/",
             params={"artist": artist, "song": song, "timestamps": "true"},
-            timeout=30,
         )
-        data = resp.json()
 
         if data.get("status") == "success":
             lyric_data = data.get("data", {})
@@ -105,11 +105,11 @@ def main():
 
     # 检查 Lyrica 是否可达
     try:
-        r = requests.get(f"{LYRICA_BASE_URL}/", timeout=3)
+        r = lyrica.get("")
         if r.status_code != 200:
             console.print("[red]❌ Lyrica 未正常响应[/]")
             return
-    except requests.ConnectionError:
+    except requests.RequestException:
         console.print(f"[red]❌ 无法连接 Lyrica ({LYRICA_BASE_URL})，请先启动 Lyrica[/]")
         return
 